@@ -0,0 +1,317 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Benchmarks for geometry setup and the forward modelling backends.
+#
+## Times the main paths at increasing numbers of stations (and a sweep
+## over many points), writes the results as JSON and optionally compares
+## them against a stored baseline:
+##
+##  ./bench.py -o out/bench.json                    # run and save
+##  ./bench.py -b baseline.json                     # compare, exit 1 on regression
+##  ./bench.py -s ../stubs -o out/bench_stubs.json  # use stub executables
+##
+## Benchmarks needing a binary that is not in PATH are skipped. A run is
+## only compared against a baseline from the same host with the same use of
+## stubs (override with -f). A benchmark is a regression when its median
+## is slower than the median of the baseline by more than the threshold
+## plus the spread (interquartile range) of either run.
+
+import os, sys
+import argparse
+import json
+import time
+import shutil
+import platform
+import tempfile
+import logging as ll
+
+import numpy as np
+import scipy as sc
+
+root = os.path.abspath (os.path.join (os.path.dirname (__file__), '..'))
+sys.path.append (root)
+
+from hyp_alg_comp   import *
+from taup           import *
+from hypomod        import *
+from geometry       import *
+from sweep          import *
+from modelstore     import *
+from locator        import *
+
+parser = argparse.ArgumentParser (description = "Benchmark geometry setup and the forward modelling backends.")
+
+parser.add_argument ('-o', '--out', default = None,
+    help = 'Write results to this JSON file.')
+parser.add_argument ('-b', '--baseline', default = None,
+    help = 'Compare results against this JSON file (from an earlier --out).')
+parser.add_argument ('-t', '--threshold', default = 0.10, type = float,
+    help = 'Relative slow down, beyond the noise of the runs, that counts as a regression (default: 0.10).')
+parser.add_argument ('-f', '--force', action = 'store_true',
+    help = 'Compare against a baseline from another host or another use of stubs.')
+parser.add_argument ('-n', '--stations', default = '10,100,1000',
+    help = 'Comma separated list of station counts (default: 10,100,1000).')
+parser.add_argument ('-p', '--points', default = 1000, type = int,
+    help = 'Number of points in the sweep benchmark (default: 1000, 0 to skip).')
+parser.add_argument ('-r', '--repeat', default = 5, type = int,
+    help = 'Number of timed repetitions per benchmark (default: 5).')
+parser.add_argument ('-s', '--stubs', default = None,
+    help = 'Directory with stub executables to put first in PATH.')
+parser.add_argument ('-k', '--only', default = None,
+    help = 'Comma separated list of benchmarks to run (default: all).')
+parser.add_argument ('-w', '--workdir', default = None,
+    help = 'Directory for generated files (default: temporary directory).')
+parser.add_argument ('-v', '--verbose', action = 'store_true',
+    help = 'Log from the backends.')
+
+benchmarks = ['geometry_setup', 'taup_calculate_times', 'hypomod_calculate_times',
+              'hypomod_parse_times', 'locate', 'sweep']
+
+def timeit (f, repeat, setup = None, mintime = .05):
+  """
+  run setup () and time f () repeat times, returns list of seconds per
+  call. f is called once first to warm up, if that takes less than
+  mintime every repetition is the mean of enough calls to take mintime,
+  so that short benchmarks are not dominated by timer and scheduler noise.
+  """
+  def once ():
+    if setup is not None:
+      setup ()
+    t0 = time.perf_counter ()
+    f ()
+    return time.perf_counter () - t0
+
+  loops = max (1, int(np.ceil (mintime / max (once (), 1e-9))))
+
+  t = []
+  for i in range (repeat):
+    t.append (sum (once () for k in range (loops)) / loops)
+  return t
+
+def summary (t):
+  q1, q3 = np.percentile (t, [25, 75])
+  return { 'min'     : min (t),
+           'median'  : float (np.median (t)),
+           'mean'    : float (np.mean (t)),
+           'q1'      : float (q1),
+           'q3'      : float (q3),
+           'repeat'  : len(t) }
+
+def random_stations (n, seed = 0):
+  """ n stations spread over 100 x 100 km, named B0000 .. """
+  rs = np.random.RandomState (seed)
+  xy = rs.uniform (-50., 50., (n, 2))
+  return [["B%04d" % i, x, y, 0.] for i, (x, y) in enumerate(xy)]
+
+class Bench:
+  def __init__ (self, workdir, repeat, storedir):
+    self.workdir  = workdir
+    self.repeat   = repeat
+    self.storedir = storedir
+    self.results  = {}
+
+    geometryf = os.path.join (root, 'geometry_setup.job')
+    self.phasef = os.path.join (root, 'phases.dat')
+
+    with HyComp (os.path.join (workdir, 'hycomp'), geometryf,
+                 os.path.join (root, 'vel.csv'), self.phasef, storedir = storedir) as hc:
+      self.reference  = hc.geometry.reference
+      self.earthquake = hc.geometry.earthquake
+      self.velocities = hc.geometry.velocities
+
+  def record (self, name, n, t):
+    s = summary (t)
+    s['n'] = n
+    self.results['%s/%d' % (name, n)] = s
+    print ("  {:<40s} min: {:10.5f} s, median: {:10.5f} s".format ('%s/%d' % (name, n), s['min'], s['median']))
+
+  def skip (self, name, binary):
+    if shutil.which (binary) is None:
+      print ("  {:<40s} skipped: no {} in PATH".format (name, binary))
+      return True
+    return False
+
+  def geometry (self, stations):
+    return Geometry (self.reference, stations, self.earthquake, self.velocities)
+
+  def geometry_setup (self, n):
+    stations = random_stations (n)
+    self.record ('geometry_setup', n, timeit (lambda: self.geometry (stations), self.repeat))
+
+  def taup_calculate_times (self, n):
+    if self.skip ('taup_calculate_times', 'taup_time'):
+      return
+
+    outdir = os.path.join (self.workdir, 'taup')
+    os.makedirs (outdir, exist_ok = True)
+
+    g = self.geometry (random_stations (n))
+    w = TauPWorker (outdir, self.phasef)
+    try:
+      t = TauP (outdir, g, self.phasef, worker = w, store = ModelStore (self.storedir))
+      t.calculate_times () # start worker
+      self.record ('taup_calculate_times', n, timeit (t.calculate_times, self.repeat))
+    finally:
+      w.stop ()
+
+  def hypomod_calculate_times (self, n):
+    if self.skip ('hypomod_calculate_times', 'hypomod'):
+      return
+
+    outdir = os.path.join (self.workdir, 'hypomod')
+    os.makedirs (outdir, exist_ok = True)
+
+    # alternate between two geometries, so that every call writes the
+    # input files
+    gs = [self.geometry (random_stations (n, seed = i)) for i in range (2)]
+    h  = Hypomod (outdir)
+
+    def run ():
+      gs.reverse ()
+      h.set_geometry (gs[0])
+      h.calculate_times ()
+
+    self.record ('hypomod_calculate_times', n, timeit (run, self.repeat))
+
+  def hypomod_parse_times (self, n):
+    if self.skip ('hypomod_parse_times', 'hypomod'):
+      return
+
+    outdir = os.path.join (self.workdir, 'hypomod')
+    os.makedirs (outdir, exist_ok = True)
+
+    h = Hypomod (outdir, self.geometry (random_stations (n)))
+    h.calculate_times ()
+    self.record ('hypomod_parse_times', n, timeit (h.parse_times, self.repeat))
+
+  def locate (self, n, events = 1000):
+    """ locate events from synthetic picks (layered) at n stations """
+    g  = self.geometry (random_stations (n))
+    rs = np.random.RandomState (0)
+    hypo = np.column_stack ([rs.uniform (-40., 40., (events, 2)), rs.uniform (1., 25., events)])
+
+    l = Locator (g)
+    t = l.backend.traveltimes (np.hypot (g.sta['x'] - hypo[:, 0, None], g.sta['y'] - hypo[:, 1, None]),
+                               np.repeat (hypo[:, 2, None], n, axis = 1), l.phases)
+    picks = np.moveaxis (t, 0, 1)
+
+    self.record ('locate', n, timeit (lambda: l.locate (picks), self.repeat))
+
+  def sweep (self, points):
+    if self.skip ('sweep', 'taup_time'):
+      return
+
+    eq  = np.array (self.earthquake, dtype = np.float64)
+    pts = [([['STA', d, 0., 0.]], eq) for d in np.linspace (eq[0], eq[0] + 100., points)]
+    s   = Sweep (os.path.join (self.workdir, 'sweep'), self.phasef, self.reference,
+                 self.velocities, backends = ['taup', 'layered'], storedir = self.storedir)
+
+    # a sweep is expensive, it is only run once
+    self.record ('sweep', points, timeit (lambda: s.run (pts), min (self.repeat, 3)))
+
+def comparable (meta, baseline):
+  """ reasons the run (meta) can not be compared to baseline (its meta) """
+  reasons = []
+  for k in ['stubs', 'host']:
+    if meta.get (k) != baseline.get (k):
+      reasons.append ("{}: {} in run, {} in baseline".format (k, meta.get (k), baseline.get (k)))
+  return reasons
+
+def compare (results, baseline, threshold):
+  """
+  compare median times against baseline, returns list of regressions.
+  the allowed slow down is threshold plus the larger relative
+  interquartile range of the run and the baseline, and the interquartile
+  ranges of the two must not overlap.
+  """
+  regressions = []
+  print ("comparing against baseline (threshold: {:.0f}% + noise):".format (threshold * 100))
+  for k, r in sorted (results.items ()):
+    b = baseline.get (k)
+    if b is None:
+      print ("  {:<40s} not in baseline".format (k))
+      continue
+
+    noise = max ((s['q3'] - s['q1']) / s['median'] if 'q3' in s else 0. for s in (r, b))
+    ratio = r['median'] / b['median']
+    flag  = ''
+    if ratio > 1. + threshold + noise and r['q1'] > b.get ('q3', b['median']):
+      flag = 'REGRESSION'
+      regressions.append (k)
+    elif ratio < 1. - threshold - noise and r['q3'] < b.get ('q1', b['median']):
+      flag = 'faster'
+
+    print ("  {:<40s} {:10.5f} s -> {:10.5f} s ({:+6.1f}%, noise: {:.1f}%) {}".format (
+           k, b['median'], r['median'], (ratio - 1.) * 100, noise * 100, flag))
+
+  return regressions
+
+if __name__ == '__main__':
+  args = parser.parse_args ()
+
+  if not args.verbose:
+    ll.getLogger ().setLevel (ll.WARNING)
+
+  if args.stubs is not None:
+    os.environ['PATH'] = os.path.abspath (args.stubs) + os.pathsep + os.environ['PATH']
+
+  only      = args.only.split (',') if args.only is not None else benchmarks
+  stations  = [int(n) for n in args.stations.split (',')]
+
+  workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp (prefix = 'hyp_bench_')
+  workdir = os.path.abspath (workdir)
+  os.makedirs (workdir, exist_ok = True)
+
+  # a separate model store, so that a shared one is not affected by stubs
+  storedir = os.path.join (workdir, 'store')
+
+  b = Bench (workdir, args.repeat, storedir)
+
+  print ("benchmarks (workdir: %s):" % workdir)
+  for name in benchmarks:
+    if name not in only:
+      continue
+
+    if name == 'sweep':
+      if args.points > 0:
+        b.sweep (args.points)
+    else:
+      for n in stations:
+        getattr (b, name) (n)
+
+  out = { 'meta'    : { 'time'      : time.strftime ('%Y-%m-%dT%H:%M:%S'),
+                        'host'      : platform.node (),
+                        'python'    : platform.python_version (),
+                        'numpy'     : np.__version__,
+                        'stubs'     : args.stubs is not None,
+                        'binaries'  : { k : binary_version (k) for k in ['taup_time', 'taup_create', 'hypomod'] } },
+          'results' : b.results }
+
+  if args.out is not None:
+    d = os.path.dirname (os.path.abspath (args.out))
+    os.makedirs (d, exist_ok = True)
+    with open (args.out, 'w') as fd:
+      json.dump (out, fd, indent = 2, sort_keys = True)
+    print ("results written to: %s" % args.out)
+
+  if args.workdir is None:
+    shutil.rmtree (workdir, ignore_errors = True)
+
+  if args.baseline is not None:
+    with open (args.baseline, 'r') as fd:
+      baseline = json.load (fd)
+
+    reasons = comparable (out['meta'], baseline.get ('meta', {}))
+    if len(reasons) > 0:
+      print ("baseline %s is not comparable to this run:" % args.baseline)
+      for r in reasons:
+        print ("  " + r)
+
+      if not args.force:
+        sys.exit (2)
+
+    if len(compare (b.results, baseline['results'], args.threshold)) > 0:
+      sys.exit (1)
+
@@ -0,0 +1,169 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Content addressed on-disk cache for forward modelling results
+#
+
+import os, sys
+import json
+import pickle
+import hashlib
+import shutil
+
+import logging as ll
+
+class ResultCache:
+  """
+  Persistent cache of parsed backend results. Entries are keyed by a hash
+  of the backend name, backend version and a canonical (JSON) form of the
+  inputs. The least recently used entries are evicted when the cache
+  grows beyond max_entries or max_bytes.
+
+  The number and size of the entries are counted as they are added, the
+  cache directory is only listed when opening the cache and when evicting.
+  Eviction goes down to low (fraction) of the limits, so it does not run
+  on every put once the cache is full. Entries written by other processes
+  are only counted at the next eviction.
+  """
+
+  # format of the cached values, part of every key
+  format_version = 1
+
+  def __init__ (self, cachedir, max_entries = 10000, max_bytes = 512 * 1024**2, low = .9):
+    self.cachedir     = cachedir
+    self.max_entries  = max_entries
+    self.max_bytes    = max_bytes
+    self.low          = low
+
+    self.hits   = 0
+    self.misses = 0
+
+    os.makedirs (cachedir, exist_ok = True)
+
+    e = self.entries ()
+    self.count  = len(e)
+    self.size   = sum (k[1] for k in e)
+
+  def key (self, backend, version, inputs):
+    """ hash of cache format, backend, version and inputs """
+    s = json.dumps ([self.format_version, backend, version, inputs], sort_keys = True, separators = (',', ':'))
+    return hashlib.sha256 (s.encode ('utf-8')).hexdigest ()
+
+  def path (self, key):
+    return os.path.join (self.cachedir, key + '.pickle')
+
+  def get (self, key):
+    """ return cached value for key or None """
+    f = self.path (key)
+    try:
+      with open (f, 'rb') as fd:
+        value = pickle.load (fd)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      self.misses += 1
+      return None
+
+    # mark as recently used, the entry may have been evicted by another
+    # process since it was read
+    try:
+      os.utime (f, None)
+    except FileNotFoundError:
+      self.misses += 1
+      return None
+
+    self.hits += 1
+    ll.debug ("cache: hit: %s" % key)
+    return value
+
+  def put (self, key, value):
+    f = self.path (key)
+    tmpf = f + ".%d.tmp" % os.getpid ()
+    try:
+      with open (tmpf, 'wb') as fd:
+        pickle.dump (value, fd, protocol = pickle.HIGHEST_PROTOCOL)
+        n = fd.tell ()
+
+      try:
+        old = os.stat (f).st_size
+      except FileNotFoundError:
+        old = None
+
+      os.replace (tmpf, f)
+
+    finally:
+      # the value could not be written, or not moved in place
+      if os.path.exists (tmpf):
+        os.remove (tmpf)
+
+    if old is None:
+      self.count += 1
+    else:
+      self.size -= old
+    self.size += n
+
+    if self.count > self.max_entries or self.size > self.max_bytes:
+      self.evict ()
+
+  def entries (self):
+    """ list of (mtime, size, path) for all entries, oldest first """
+    e = []
+    for f in os.listdir (self.cachedir):
+      if f.endswith ('.pickle'):
+        f = os.path.join (self.cachedir, f)
+        try:
+          st = os.stat (f)
+        except OSError:
+          continue
+        e.append ((st.st_mtime, st.st_size, f))
+
+    e.sort ()
+    return e
+
+  def evict (self):
+    """ remove the least recently used entries until below low of the limits """
+    e = self.entries ()
+    size = sum (k[1] for k in e)
+
+    max_entries = int(self.max_entries * self.low)
+    max_bytes   = int(self.max_bytes * self.low)
+
+    e.reverse ()
+    while len(e) > 0 and (len(e) > max_entries or size > max_bytes):
+      _t, s, f = e.pop ()
+      ll.debug ("cache: evicting: %s" % f)
+      try:
+        os.remove (f)
+      except OSError:
+        pass
+      size -= s
+
+    self.count = len(e)
+    self.size  = size
+
+  def clear (self):
+    for _t, _s, f in self.entries ():
+      try:
+        os.remove (f)
+      except FileNotFoundError:
+        pass
+
+    self.count = 0
+    self.size  = 0
+
+def binary_version (name):
+  """
+  identify a backend binary without running it: resolved path, size and
+  modification time.
+  """
+  f = shutil.which (name)
+  if f is None:
+    return None
+
+  f  = os.path.realpath (f)
+  st = os.stat (f)
+  return [f, st.st_size, int(st.st_mtime)]
+
+def file_digest (f):
+  with open (f, 'rb') as fd:
+    return hashlib.sha256 (fd.read ()).hexdigest ()
+
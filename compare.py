@@ -0,0 +1,329 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Compare travel times from two backends
+#
+
+import os, sys
+import numpy as np
+import scipy as sc
+
+import logging as ll
+
+from results import *
+
+class Comparison:
+  """
+  Travel times from two backends (Results a and b) joined on (event,
+  station, phase). Where a backend has several arrivals of the same
+  phase for a station and event the first is used.
+
+  phases maps phase names in a to the names used for the same phase in
+  b, e.g. { 'p' : 'P', 's4.6p' : 'S' } for TauP vs. Layered; only those
+  phases are compared. If phases is None phases are matched by name.
+
+  After joining: self.event, self.station (index into a.stations),
+  self.phase (index into self.phases), self.distance (from a), self.ta,
+  self.tb and self.residual (ta - tb) are arrays with one element per
+  matched arrival.
+  """
+
+  def __init__ (self, a, b, phases = None):
+    self.a = a
+    self.b = b
+
+    if phases is None:
+      phases = { p : p for p in a.phases if p in b.phases }
+
+    self.phases = list(phases.keys ())
+    self.join (phases)
+
+  @staticmethod
+  def remap (codes, names, index):
+    """ map codes into names to codes in index, -1 where missing """
+    m = np.array ([index.get (n, -1) for n in names] + [-1], dtype = np.int64)
+    return m[codes]
+
+  @staticmethod
+  def first (keys, times):
+    """ sorted unique keys and the smallest time for each """
+    o = np.lexsort ((times, keys))
+    keys, times = keys[o], times[o]
+    u = np.ones (len(keys), dtype = bool)
+    u[1:] = keys[1:] != keys[:-1]
+    return keys[u], times[u], o[u]
+
+  def join (self, phases):
+    a, b = self.a, self.b
+
+    # express both sides in a's station codes and the compared phases
+    pidx = { p : i for i, p in enumerate(self.phases) }
+    bidx = { q : i for i, q in enumerate(phases.values ()) }
+
+    pa = self.remap (a.rows['phase'], a.phases, pidx)
+    pb = self.remap (b.rows['phase'], b.phases, bidx)
+    sa = a.rows['station'].astype (np.int64)
+    sb = self.remap (b.rows['station'], b.stations, a.station_index)
+
+    ma = pa >= 0
+    mb = (pb >= 0) & (sb >= 0)
+
+    ns  = max (len(a.stations), 1)
+    nph = max (len(self.phases), 1)
+
+    def key (e, s, p):
+      return (e.astype (np.int64) * ns + s) * nph + p
+
+    ka, ta, ia = self.first (key (a.rows['event'][ma], sa[ma], pa[ma]), a.rows['time'][ma])
+    kb, tb, _i = self.first (key (b.rows['event'][mb], sb[mb], pb[mb]), b.rows['time'][mb])
+
+    k, ja, jb = np.intersect1d (ka, kb, assume_unique = True, return_indices = True)
+
+    self.event    = k // (ns * nph)
+    self.station  = (k // nph) % ns
+    self.phase    = k % nph
+    self.distance = a.rows['distance'][ma][ia[ja]]
+    self.ta       = ta[ja]
+    self.tb       = tb[jb]
+    self.residual = self.ta - self.tb
+
+    ll.info ("compare: matched {} of {} and {} arrivals".format (len(k), len(ka), len(kb)))
+
+  def __len__ (self):
+    return len(self.residual)
+
+  def groups (self, by = None, bins = None, depth = None):
+    """
+    group index for every matched arrival and a label for every group.
+
+    by is one of None (all arrivals), 'phase', 'station', 'event',
+    'distance' (bins are the bin edges in km) or 'depth' (depth is the
+    source depth of every event, bins are optional bin edges).
+    """
+    n = len(self.residual)
+
+    if by is None:
+      return np.zeros (n, dtype = np.int64), ['all']
+
+    elif by == 'phase':
+      return self.phase, list(self.phases)
+
+    elif by == 'station':
+      return self.station, list(self.a.stations)
+
+    elif by == 'event':
+      return self.event, list(range (self.event.max () + 1 if n > 0 else 0))
+
+    elif by == 'distance' or by == 'depth':
+      if by == 'distance':
+        x = self.distance
+      else:
+        if depth is None:
+          raise ValueError ("compare: grouping by depth needs the depth of every event")
+        x = np.asarray (depth, dtype = np.float64)[self.event]
+
+      if bins is None:
+        labels, g = np.unique (x, return_inverse = True)
+        return g, labels.tolist ()
+
+      bins = np.asarray (bins, dtype = np.float64)
+      return bin_index (x, bins), [(float(bins[i]), float(bins[i+1])) for i in range (len(bins) - 1)]
+
+    else:
+      raise ValueError ("compare: unknown grouping: %s" % by)
+
+  def stats (self, by = None, bins = None, depth = None, percentiles = [50, 90, 99]):
+    """
+    residual statistics (ta - tb) for every group, see groups. returns a
+    list of dicts with group, n, mean, rms, max (absolute) and the
+    percentiles of the residual as pNN. empty groups are left out.
+    """
+    g, labels = self.groups (by, bins, depth)
+    m = (g >= 0) & np.isfinite (self.residual)
+    g = g[m].astype (np.int64)
+    r = self.residual[m]
+
+    s = grouped_stats (g, r, len(labels), percentiles)
+
+    out = []
+    for i, l in enumerate(labels):
+      if s['n'][i] > 0:
+        d = { 'group' : l }
+        for k, v in s.items ():
+          d[k] = v[i]
+        out.append (d)
+
+    return out
+
+  def report (self, by = None, bins = None, depth = None, percentiles = [50, 90, 99]):
+    """ log stats, returns them """
+    st = self.stats (by, bins, depth, percentiles)
+    ll.info ("compare: residuals by: %s" % (by if by is not None else 'all'))
+    for d in st:
+      ll.info ("  {group}: n: {n}, mean: {mean:.4f} s, rms: {rms:.4f} s, max: {max:.4f} s".format (**d))
+    return st
+
+def bin_index (x, bins):
+  """
+  index of the bin of every value in x, bins are the bin edges. as for
+  np.histogram the bins are half open, except the last which includes its
+  right edge. values outside the bins are -1.
+  """
+  x = np.asarray (x, dtype = np.float64)
+  g = np.digitize (x, bins) - 1
+  g[x == bins[-1]] = len(bins) - 2
+  g[(g < 0) | (g >= len(bins) - 1)] = -1
+  return g
+
+def grouped_stats (g, r, ngroups, percentiles = [50, 90, 99]):
+  """
+  n, mean, rms, max absolute and percentiles of r for every group, where
+  g is the group index (0 .. ngroups-1) of every value. returns a dict of
+  arrays with one element per group (nan for empty groups).
+  """
+  n   = np.bincount (g, minlength = ngroups)
+  s   = np.bincount (g, weights = r, minlength = ngroups)
+  ss  = np.bincount (g, weights = r**2, minlength = ngroups)
+
+  mx  = np.full (ngroups, -np.inf)
+  np.maximum.at (mx, g, np.abs (r))
+
+  with np.errstate (invalid = 'ignore', divide = 'ignore'):
+    st = { 'n'    : n,
+           'mean' : s / n,
+           'rms'  : np.sqrt (ss / n),
+           'max'  : np.where (n > 0, mx, np.nan) }
+
+  # percentiles by linear interpolation within each sorted group, like
+  # np.percentile.
+  o      = np.lexsort ((r, g))
+  rs     = r[o]
+  start  = np.concatenate ([[0], np.cumsum (n)[:-1]])
+
+  for p in percentiles:
+    pos = (n - 1) * p / 100.
+    lo  = np.floor (pos).astype (np.int64)
+    hi  = np.ceil (pos).astype (np.int64)
+    f   = pos - lo
+
+    v = np.full (ngroups, np.nan)
+    e = n > 0
+    v[e] = rs[start[e] + lo[e]] * (1 - f[e]) + rs[start[e] + hi[e]] * f[e]
+    st['p%g' % p] = v
+
+  return st
+
+
+class RunningStats:
+  """
+  Streaming residual statistics for ngroups groups: count, mean, variance
+  (merged as in Chan et al.), extremes and a histogram over fixed bin
+  edges (s) for approximate percentiles (none if edges is None). Memory
+  does not grow with the number of residuals added, and partial
+  statistics (e.g. from worker processes) are combined with merge.
+  """
+
+  def __init__ (self, labels, edges = np.linspace (-2., 2., 4001)):
+    self.labels = list(labels)
+    self.edges  = np.asarray (edges, dtype = np.float64) if edges is not None else None
+
+    g = len(self.labels)
+    self.n    = np.zeros (g, dtype = np.int64)
+    self.mean = np.zeros (g)
+    self.m2   = np.zeros (g)
+    self.min  = np.full (g, np.inf)
+    self.max  = np.full (g, -np.inf)
+
+    # under- and overflow in the first and last bin
+    self.hist = np.zeros ((g, len(self.edges) + 1), dtype = np.int64) if self.edges is not None else None
+
+  def add (self, g, r):
+    """ add residuals r in groups g (index into labels), g < 0 is left out """
+    g = np.asarray (g, dtype = np.int64)
+    r = np.asarray (r, dtype = np.float64)
+    m = (g >= 0) & np.isfinite (r)
+    g, r = g[m], r[m]
+
+    ng = len(self.labels)
+    b  = RunningStats.__new__ (RunningStats)
+    b.labels, b.edges = self.labels, self.edges
+
+    b.n = np.bincount (g, minlength = ng)
+    with np.errstate (invalid = 'ignore', divide = 'ignore'):
+      b.mean = np.where (b.n > 0, np.bincount (g, weights = r, minlength = ng) / b.n, 0.)
+    b.m2 = np.bincount (g, weights = (r - b.mean[g])**2, minlength = ng)
+
+    b.min = np.full (ng, np.inf)
+    b.max = np.full (ng, -np.inf)
+    np.minimum.at (b.min, g, r)
+    np.maximum.at (b.max, g, r)
+
+    b.hist = None
+    if self.hist is not None:
+      b.hist = np.zeros_like (self.hist)
+      np.add.at (b.hist, (g, np.searchsorted (self.edges, r, side = 'right')), 1)
+
+    self.merge (b)
+
+  def merge (self, other):
+    """
+    add the statistics of other (with the same groups, and the same edges
+    unless self has no histogram)
+    """
+    n = self.n + other.n
+    d = other.mean - self.mean
+    with np.errstate (invalid = 'ignore', divide = 'ignore'):
+      f = np.where (n > 0, other.n / n, 0.)
+
+    self.m2   = self.m2 + other.m2 + d**2 * self.n * f
+    self.mean = self.mean + d * f
+    self.n    = n
+    self.min  = np.minimum (self.min, other.min)
+    self.max  = np.maximum (self.max, other.max)
+    if self.hist is not None:
+      self.hist = self.hist + other.hist
+
+  def percentile (self, p):
+    """ approximate percentile p for every group, linear within a bin """
+    v = np.full (len(self.labels), np.nan)
+    if self.hist is None:
+      return v
+
+    c = np.cumsum (self.hist, axis = 1)
+    for i in np.flatnonzero (self.n > 0):
+      q = p / 100. * self.n[i]
+      k = min (np.searchsorted (c[i], q), len(self.edges))
+      if k == 0 or k == len(self.edges):
+        # outside the edges
+        v[i] = self.min[i] if k == 0 else self.max[i]
+        continue
+
+      below = c[i][k - 1]
+      f = (q - below) / max (self.hist[i][k], 1)
+      v[i] = np.clip (self.edges[k - 1] + f * (self.edges[k] - self.edges[k - 1]),
+                      self.min[i], self.max[i])
+
+    return v
+
+  def stats (self, percentiles = [50, 90, 99]):
+    """
+    list of dicts with group, n, mean, std, rms, min, max and the
+    percentiles as pNN (as Comparison.stats). empty groups are left out.
+    """
+    with np.errstate (invalid = 'ignore', divide = 'ignore'):
+      std = np.sqrt (self.m2 / self.n)
+      rms = np.sqrt (self.m2 / self.n + self.mean**2)
+
+    ps = { 'p%g' % p : self.percentile (p) for p in percentiles }
+
+    out = []
+    for i, l in enumerate(self.labels):
+      if self.n[i] > 0:
+        d = { 'group' : l, 'n' : int(self.n[i]), 'mean' : self.mean[i], 'std' : std[i],
+              'rms' : rms[i], 'min' : self.min[i], 'max' : self.max[i] }
+        for k, v in ps.items ():
+          d[k] = v[i]
+        out.append (d)
+
+    return out
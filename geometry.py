@@ -6,9 +6,12 @@
 #
 
 import sys, os
+import itertools
 
 from coordinates import *
 
+import tracing
+
 import logging as ll
 
 import numpy as np
@@ -17,35 +20,202 @@ import scipy as sc
 from pyproj import Geod
 g = Geod (ellps = 'WGS84')
 
+# stations: name, position in km from reference (x, y, z) and position in
+# degrees (lon, lat).
+station_name_length = 16
+station_dtype = np.dtype ([('name', 'U%d' % station_name_length),
+                           ('x', np.float64), ('y', np.float64), ('z', np.float64),
+                           ('lon', np.float64), ('lat', np.float64)])
+
+def read_velocity (f):
+  """ velocity model from file (see vel.csv): list of [depth, velp, vels, identifier] """
+  velocity = []
+  with open(f, 'r') as fd:
+    for l in fd.readlines():
+      l = l.strip()
+      if len(l) > 0 and l[0] != "#":
+        s = [ss.strip() for ss in l.split (',')]
+        velocity.append ( [float(s[0]), float(s[1]), float(s[2]), s[3]] )
+
+  return velocity
+
 class Geometry:
-  def __init__ (self, reference, stations, earthquake, velocities):
-    self.setup (reference, stations, earthquake, velocities)
+  """
+  Stations and earthquake given as offsets in km from a reference point,
+  with positions in degrees. The stations are held in a structured array
+  (self.sta, see station_dtype) and all geodesic calculations are done
+  for all stations at once.
+
+  Every change bumps the revision of the parts it affects, consumers
+  keep the revisions they last used and ask for the stale parts.
+  """
+
+  # parts of the geometry that derived files depend on
+  parts = ['names', 'stations', 'earthquake', 'velocity']
+
+  # revisions are unique across all geometries, so revisions seen from
+  # another geometry are always stale.
+  counter = itertools.count (1)
+
+  def __init__ (self, reference, stations, earthquake, velocities, validate = True):
+    self.revision = {}
+    self.setup (reference, stations, earthquake, velocities, validate)
 
-  def setup (self, reference, stations, earthquake, velocities):
+  def touch (self, *parts):
+    """ mark parts as changed """
+    r = next (self.counter)
+    for p in parts:
+      self.revision[p] = r
+
+  def revisions (self):
+    """ current revisions, to be passed back to stale () later """
+    return dict(self.revision)
+
+  def stale (self, seen):
+    """ set of parts that changed since revisions seen """
+    return set (p for p in self.parts if seen.get (p) != self.revision.get (p))
+
+  def setup (self, reference, stations, earthquake, velocities, validate = True):
+    """
+    stations is either a list of [name, x, y, z] or a structured array
+    with at least the fields name, x, y and z. validate checks that the
+    distances in degrees match the distances in km.
+    """
     ll.info ("geometry: setting up..")
     self.reference = reference
-    self.stations  = stations
     self.earthquake = earthquake
     self.velocities = velocities
+    self.validate   = validate
+    self.touch (*self.parts)
 
-    self.calculate_distances ()
-    self.calculate_degrees ()
-    self.assert_degree_distances ()
+    if isinstance (stations, np.ndarray) and stations.dtype.names is not None:
+      names = stations['name'].tolist ()
+    else:
+      names = [s[0] for s in stations]
 
-  def calculate_distances (self):
-    ## figure out distances between earthquakes to stations
-    self.distances = []
-    for s in self.stations:
-      dist = np.linalg.norm(np.array(self.earthquake[:2]) - np.array(s[1:3]))
-      self.distances.append (dist)
+    # longer names would be truncated silently, and could then collide
+    toolong = [n for n in names if len(n) > station_name_length]
+    if len(toolong) > 0:
+      raise ValueError ("geometry: station names longer than %d characters: %s" % (
+                        station_name_length, ', '.join (toolong)))
+
+    self.sta = np.zeros (len(stations), dtype = station_dtype)
+    if isinstance (stations, np.ndarray) and stations.dtype.names is not None:
+      for f in ['name', 'x', 'y', 'z']:
+        self.sta[f] = stations[f]
+    elif len(stations) > 0:
+      self.sta['name'] = names
+      self.sta['x']    = [s[1] for s in stations]
+      self.sta['y']    = [s[2] for s in stations]
+      self.sta['z']    = [s[3] for s in stations]
+
+    with tracing.span ('geometry.distances', stations = len(self.sta)):
+      self.calculate_distances ()
+    with tracing.span ('geometry.degrees', stations = len(self.sta)):
+      self.calculate_degrees ()
+    if validate:
+      with tracing.span ('geometry.validate', stations = len(self.sta)):
+        self.assert_degree_distances ()
+
+  def station_index (self, name):
+    i = np.flatnonzero (self.sta['name'] == name)
+    if len(i) == 0:
+      raise KeyError ("geometry: no such station: %s" % name)
+    return i
+
+  def move_station (self, name, x, y, z = None):
+    """
+    move station to x, y (and z) km from reference, only the position
+    and distance of this station is recalculated.
+    """
+    ll.debug ("geometry: moving station: %s to: %f, %f" % (name, x, y))
+    i = self.station_index (name)
+    self.sta['x'][i] = x
+    self.sta['y'][i] = y
+    if z is not None:
+      self.sta['z'][i] = z
 
-    ll.info ("=> distances: " + str(self.distances))
+    with tracing.span ('geometry.move_station', station = name):
+      self.calculate_distances (i)
+      self.calculate_station_degrees (i)
+      if self.validate:
+        self.assert_degree_distances (i)
 
-  def assert_degree_distances (self):
+    self.touch ('stations')
+
+  def move_earthquake (self, x, y, z):
+    """
+    move earthquake to x, y, z km from reference. distances are only
+    recalculated if the epicenter moved, the station positions are not
+    recalculated.
+    """
+    ll.debug ("geometry: moving earthquake to: %f, %f, %f" % (x, y, z))
+    moved = x != self.earthquake[0] or y != self.earthquake[1]
+
+    if isinstance (self.earthquake, np.ndarray):
+      self.earthquake = np.array ([x, y, z], dtype = self.earthquake.dtype)
+    else:
+      self.earthquake = [x, y, z]
+
+    if moved:
+      self.calculate_distances ()
+      self.calculate_earthquake_degrees ()
+      self.calculate_station_distances ()
+      if self.validate:
+        self.assert_degree_distances ()
+    else:
+      self.earthquaked[2] = z
+
+    self.touch ('earthquake')
+
+  def calculate_station_distances (self, idx = None):
+    """ distance (km) along the ellipsoid from the earthquake to all stations or the stations in idx """
+    if idx is None:
+      idx = np.arange (len(self.sta))
+
+    sta = self.sta[idx]
+    n   = len(sta)
+    if n > 0:
+      _a, _b, dist = g.inv (sta['lon'], sta['lat'],
+                            np.full (n, self.earthquaked[0]), np.full (n, self.earthquaked[1]))
+      self.distancesd[idx] = np.asarray (dist) / 1000.0
+
+  def set_velocities (self, velocities):
+    self.velocities = velocities
+    self.touch ('velocity')
+
+  @property
+  def stations (self):
+    """ stations as a list of [name, x, y, z] """
+    return [[n, x, y, z] for n, x, y, z in zip (self.sta['name'].tolist (),
+            self.sta['x'].tolist (), self.sta['y'].tolist (), self.sta['z'].tolist ())]
+
+  @property
+  def stationsd (self):
+    """ stations as a list of [name, lon, lat, z] """
+    return [[n, lon, lat, z] for n, lon, lat, z in zip (self.sta['name'].tolist (),
+            self.sta['lon'].tolist (), self.sta['lat'].tolist (), self.sta['z'].tolist ())]
+
+  def calculate_distances (self, idx = None):
+    ## figure out distances between earthquakes to stations
+    if idx is None:
+      self.distances = np.hypot (self.sta['x'] - self.earthquake[0],
+                                 self.sta['y'] - self.earthquake[1])
+      if ll.getLogger ().isEnabledFor (ll.DEBUG):
+        ll.debug ("=> distances: " + str(self.distances))
+    else:
+      self.distances[idx] = np.hypot (self.sta['x'][idx] - self.earthquake[0],
+                                      self.sta['y'][idx] - self.earthquake[1])
+
+  def assert_degree_distances (self, idx = None):
+    """ check all stations, or only the stations in idx """
     ll.debug ("=> asserting that distances between polar coordinates match distances in cartesian coordinates..")
 
+    if idx is None:
+      idx = slice (None)
+
     rtol = .01 * 1e-3 # 10 cm tolerance
-    np.testing.assert_allclose (self.distances, self.distancesd, rtol)
+    np.testing.assert_allclose (self.distances[idx], self.distancesd[idx], rtol)
 
     # test distance to reference
     d  = np.linalg.norm(np.array(self.earthquake[0:2]))
@@ -54,15 +224,27 @@ class Geometry:
     np.testing.assert_almost_equal (d, dist)
 
     # stations
-    d  = [np.linalg.norm(np.array(s[1:3])) for s in self.stations]
+    sta = self.sta[idx]
+    n   = len(sta)
+    d   = np.hypot (sta['x'], sta['y'])
 
-    dists = [ k[2] / 1000.0 for k in [list(g.inv(self.reference[0], self.reference[1], s[1], s[2])) for s in self.stationsd ]]
+    _a, _b, dists = g.inv (np.full (n, self.reference[0]), np.full (n, self.reference[1]),
+                           sta['lon'], sta['lat'])
+    dists = np.asarray (dists) / 1000.0
 
     np.testing.assert_allclose (d, dists)
 
   def calculate_degrees (self):
     """ calculate station positions in degrees as offset km from reference point """
+    self.calculate_earthquake_degrees ()
+    self.calculate_station_degrees ()
+
+    if ll.getLogger ().isEnabledFor (ll.DEBUG):
+      ll.debug ("=> stations (deg):")
+      for s in self.stationsd:
+        ll.debug ("  {}: {:.3f}, {:.3f}, {:.3f}".format(*s))
 
+  def calculate_earthquake_degrees (self):
     # azimuths: direction of vectors is used as azimuth
     #           since the reference point is set to be in
     #           coordinates 0, 0.
@@ -75,24 +257,27 @@ class Geometry:
     ll.debug ("  {}, az: {:.3f}, ds: {:.3f}".format(self.earthquake[0:2], az, d))
     ll.debug ("  position: {:.3f}, {:.3f}, {:.3f}".format (*self.earthquaked))
 
+  def calculate_station_degrees (self, idx = None):
+    """ calculate positions and distance to earthquake for all stations or the stations in idx """
     ll.debug ("=> calulcating station positions in degrees..")
-    self.stationsd = []
-    self.distancesd = []
-    for s in self.stations:
-      d  = np.linalg.norm(np.array(s[1:3]))
-      az = np.arctan2(s[1], s[2]) * 180 / np.pi
+    if idx is None:
+      idx = np.arange (len(self.sta))
+      self.distancesd = np.zeros (len(self.sta))
 
-      lon, lat, backaz = g.fwd (self.reference[0], self.reference[1], az, d * 1000.0)
-      self.stationsd.append ([s[0], lon, lat, s[3]])
+    sta = self.sta[idx]
+    n   = len(sta)
+    d   = np.hypot (sta['x'], sta['y'])
+    az  = np.arctan2 (sta['x'], sta['y']) * 180 / np.pi
 
-      # distance to earthquake
-      _a, _b, dist = g.inv (lon, lat, self.earthquaked[0], self.earthquaked[1])
-      dist = dist / 1000.0
-      self.distancesd.append (dist)
-      ll.debug ("  {}: {}, az: {:.3f}, ds: {:.3f}, epicenter: {:.3f}".format(s[0], s[1:3], az, d, dist))
+    if n > 0:
+      lon, lat, backaz = g.fwd (np.full (n, self.reference[0]), np.full (n, self.reference[1]),
+                                az, d * 1000.0)
+      self.sta['lon'][idx] = lon
+      self.sta['lat'][idx] = lat
 
-    ll.info ("=> stations (deg):")
-    for s in self.stationsd:
-      ll.info ("  {}: {:.3f}, {:.3f}, {:.3f}".format(*s))
+    self.calculate_station_distances (idx)
 
+    if ll.getLogger ().isEnabledFor (ll.DEBUG):
+      for s, a, ds, dist in zip (self.sta[idx], az, d, self.distancesd[idx]):
+        ll.debug ("  {}: {}, az: {:.3f}, ds: {:.3f}, epicenter: {:.3f}".format(s['name'], [float(s['x']), float(s['y'])], a, ds, dist))
 
@@ -20,17 +20,25 @@
 
 import os, sys
 import argparse
+import asyncio
 import logging as ll
 
 import numpy as np
 import scipy as sc
 
-from subprocess import check_call
+from subprocess import check_call, check_output
 
 from taup       import *
 from hypomod    import *
 from ttlayer    import *
+from layered    import *
 from geometry   import *
+from cache      import *
+from modelstore import *
+from runner     import *
+from sink       import *
+
+import tracing
 
 parser = argparse.ArgumentParser (description = "Test HYPOSAT against the HYPOCENTER and TauP packages (author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-07)")
 
@@ -43,6 +51,18 @@ parser.add_argument ('-o', '--out', default = 'out',
 
 parser.add_argument ("-pf", "--phase-file", default = 'phases.dat',
     help = "File with list of phases.")
+parser.add_argument ('-c', '--cache', default = None,
+    help = 'Directory for caching backend results between runs (default: no cache).')
+parser.add_argument ('-m', '--model-store', default = None,
+    help = 'Directory for compiled TauP models (default: %s).' % ModelStore.default_storedir)
+parser.add_argument ('--concurrent', action = 'store_true',
+    help = 'Run the external backends concurrently.')
+parser.add_argument ('-t', '--timeout', default = None, type = float,
+    help = 'Timeout in seconds for each backend when running concurrently.')
+parser.add_argument ('-r', '--results', default = None,
+    help = 'Append results of all backends to binary result file (RESULTS.bin and RESULTS.json).')
+parser.add_argument ('--trace', default = None,
+    help = 'Write a Chrome trace (JSON) of the run to this file, see chrome://tracing or ui.perfetto.dev.')
 
 
 ## Output
@@ -55,13 +75,23 @@ consoleHandler.setFormatter(logFormatter)
 rootLogger.addHandler(consoleHandler)
 
 class HyComp:
-  def __init__ (self, outdir, geometryf, vel, phasef):
+  taup        = None
+  taup_worker = None
+  hypomod     = None
+  layered     = None
+  sink        = None
+  event       = 0
+
+  def __init__ (self, outdir, geometryf, vel, phasef, cachedir = None, storedir = None, sink = None):
     ll.info ("output directory: %s" % outdir)
 
     self.outdir     = outdir
     self.geometryf  = geometryf
     self.vel        = vel
     self.phasef     = phasef
+    self.cache      = ResultCache (cachedir) if cachedir is not None else None
+    self.store      = ModelStore (storedir)
+    self.sink       = ResultSink (sink) if sink is not None else None
 
     # do a few simple sanity checks..
     for f in [geometryf, vel, phasef]:
@@ -131,39 +161,200 @@ class HyComp:
 
     ## Load velocity model
     ll.info ("loading velocity model: %s.. (km and km/s)" % vel)
-    velocity = []
-    with open(vel, 'r') as fd:
-      for l in fd.readlines():
-        l = l.strip()
-        if len(l) > 0 and l[0] != "#":
-          s = [ss.strip() for ss in l.split (',')]
-          velocity.append ( [float(s[0]), float(s[1]), float(s[2]), s[3]] )
+    velocity = read_velocity (vel)
 
     for l in velocity:
       ll.info ("  depth: {:>4}, velp: {:>5}, vels: {:>5} ({})".format(*l))
 
-    self.geometry = Geometry (reference, stations, earthquake, velocity)
-
-  def calculate_ttimes (self, regen_velocity = True):
-    ## Calculate traveltimes using TauP
-    self.taup = TauP (self.outdir, self.geometry, os.path.abspath(self.phasef), regen_velocity)
-
-    self.taup_ttimes = self.taup.calculate_times ()
-
-    ## write out traveltimes from TauP
-    taup_ttimes_f = os.path.join (self.outdir, "taup_ttimes.dat")
-    with open(taup_ttimes_f, 'w') as fd:
-      for ph in self.taup.times:
-        fd.write ("{station},{phase},{time},{distance}\n".format(
-                  station = ph[0], phase = ph[1], time = ph[2],
-                  distance = ph[3]))
-
-    ## set up HYPOMOD
-    self.hypomod = Hypomod (self.outdir, self.geometry)
-    self.hypomod_ttimes = self.hypomod.calculate_times ()
-
-    ### set up TTLAYER
-    #self.ttlayer = TTlayer (self.outdir, self.geometry)
+    with tracing.span ('geometry.setup', stations = len(stations)):
+      self.geometry = Geometry (reference, stations, earthquake, velocity)
+
+  def cache_inputs (self):
+    """ canonical form of everything the backend results depend on """
+    return { 'velocity'   : [[float(v[0]), float(v[1]), float(v[2]), v[3]] for v in self.geometry.velocities],
+             'reference'  : [float(r) for r in self.geometry.reference],
+             'stations'   : [[s[0], float(s[1]), float(s[2]), float(s[3])] for s in self.geometry.stations],
+             'earthquake' : [float(e) for e in self.geometry.earthquake],
+             'phases'     : file_digest (self.phasef) }
+
+  def cached (self, backend, binary, calculate):
+    """
+    look up results for backend in the cache, or calculate and store
+    them.
+    """
+    if self.cache is None:
+      return calculate ()
+
+    key = self.cache.key (backend, binary_version (binary), self.cache_inputs ())
+    r   = self.cache.get (key)
+    if r is None:
+      r = calculate ()
+      self.cache.put (key, r)
+    else:
+      ll.info ("=> %s: using cached results" % backend)
+
+    return r
+
+  async def cached_async (self, backend, binary, calculate):
+    """
+    as cached, but calculate returns a coroutine. the phase file and the
+    cache files are read and written in a thread so that the event loop
+    is not blocked.
+    """
+    if self.cache is None:
+      return await calculate ()
+
+    loop = asyncio.get_running_loop ()
+    key  = await loop.run_in_executor (None, lambda: self.cache.key (backend,
+                    binary_version (binary), self.cache_inputs ()))
+    r    = await loop.run_in_executor (None, self.cache.get, key)
+    if r is None:
+      r = await calculate ()
+      await loop.run_in_executor (None, self.cache.put, key, r)
+    else:
+      ll.info ("=> %s: using cached results" % backend)
+
+    return r
+
+  async def setup_async (self, setup, timeout):
+    """
+    set up a backend in a thread (it writes its input files and may
+    compile the TauP model), then calculate its times asynchronously.
+    """
+    b = await asyncio.get_running_loop ().run_in_executor (None, setup)
+    return await b.calculate_times_async (timeout)
+
+  def calculate_ttimes (self, regen_velocity = True, concurrent = False, timeouts = {}):
+    """
+    calculate travel times with all backends. the compiled TauP model is
+    taken from the model store, regen_velocity is kept for compatibility
+    and ignored.
+
+    if concurrent is True the external backends are run at the same time,
+    see calculate_ttimes_async.
+
+    every call is a new event (self.event) in the sink and the trace.
+    """
+    with tracing.span ('hycomp.calculate_ttimes', event = self.event):
+      if concurrent:
+        with tracing.span ('hycomp.backends (concurrent)'):
+          r = asyncio.run (self.calculate_ttimes_async (timeouts))
+        self.taup_ttimes    = r['taup']
+        self.hypomod_ttimes = r['hypomod']
+
+      else:
+        ## Calculate traveltimes using TauP, the worker keeps taup_time
+        ## running between calls.
+        with tracing.span ('hycomp.taup'):
+          self.taup_ttimes = self.cached ('taup', 'taup_time', self.calculate_taup)
+
+        ## set up HYPOMOD
+        with tracing.span ('hycomp.hypomod'):
+          self.hypomod_ttimes = self.cached ('hypomod', 'hypomod', self.calculate_hypomod)
+
+      ## write out traveltimes from TauP
+      with tracing.span ('hycomp.write_taup_ttimes'):
+        taup_ttimes_f = os.path.join (self.outdir, "taup_ttimes.dat")
+        with open(taup_ttimes_f, 'w') as fd:
+          for ph in self.taup_ttimes:
+            fd.write ("{station},{phase},{time},{distance}\n".format(
+                      station = ph[0], phase = ph[1], time = ph[2],
+                      distance = ph[3]))
+
+      ## in-process layered model
+      with tracing.span ('hycomp.layered'):
+        if self.layered is None:
+          self.layered = Layered (self.geometry)
+        else:
+          self.layered.set_geometry (self.geometry)
+
+        self.layered_ttimes = self.layered.calculate_times ()
+
+      if self.sink is not None:
+        with tracing.span ('hycomp.sink'):
+          self.append_results ()
+
+      ### set up TTLAYER
+      #self.ttlayer = TTlayer (self.outdir, self.geometry)
+
+    self.event += 1
+
+  def append_results (self):
+    """ append travel times of all backends to the sink as the next event """
+    names = [s[0] for s in self.geometry.stations]
+    dists = self.geometry.distances
+
+    self.sink.append ('taup', Results.from_rows (self.taup_ttimes, names, dists, self.event))
+    self.sink.append ('hypomod', Results.from_rows (
+                      [t for pht in self.hypomod_ttimes for t in pht], names, dists, self.event))
+    self.sink.append ('layered', Results.from_rows (self.layered_ttimes, names, dists, self.event))
+
+  async def calculate_ttimes_async (self, timeouts = {}):
+    """
+    run the external backends concurrently as asyncio subprocesses, with
+    an optional timeout (seconds) per backend in timeouts. if a backend
+    fails or times out the others are cancelled and the error is raised.
+
+    returns a dict of backend -> travel times.
+    """
+    ll.info ("=> running backends concurrently..")
+    jobs = {
+      'taup'    : self.cached_async ('taup', 'taup_time',
+                    lambda: self.setup_async (self.setup_taup, timeouts.get ('taup'))),
+      'hypomod' : self.cached_async ('hypomod', 'hypomod',
+                    lambda: self.setup_async (self.setup_hypomod, timeouts.get ('hypomod'))),
+    }
+
+    return await run_backends (jobs)
+
+  def setup_taup (self):
+    if self.taup_worker is None:
+      self.taup_worker = TauPWorker (self.outdir, os.path.abspath(self.phasef))
+
+    if self.taup is None:
+      self.taup = TauP (self.outdir, self.geometry, os.path.abspath(self.phasef), worker = self.taup_worker, store = self.store)
+    else:
+      self.taup.set_geometry (self.geometry)
+
+    return self.taup
+
+  def calculate_taup (self):
+    return self.setup_taup ().calculate_times ()
+
+  def setup_hypomod (self):
+    if self.hypomod is None:
+      self.hypomod = Hypomod (self.outdir, self.geometry)
+    else:
+      self.hypomod.set_geometry (self.geometry)
+
+    return self.hypomod
+
+  def calculate_hypomod (self):
+    return self.setup_hypomod ().calculate_times ()
+
+  def close (self):
+    """ shut down any running backend processes """
+    if self.taup_worker is not None:
+      self.taup_worker.stop ()
+      self.taup_worker = None
+
+    # the TauP instance holds the stopped worker, a new one is set up
+    # with a new worker by setup_taup.
+    if self.taup is not None:
+      self.taup.worker = None
+      self.taup = None
+
+    if self.sink is not None:
+      self.sink.close ()
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, *args):
+    self.close ()
+
+  def __del__ (self):
+    self.close ()
 
 if __name__ == '__main__':
   args        = parser.parse_args ()
@@ -171,7 +362,19 @@ if __name__ == '__main__':
   geometry    = args.geometry
   vel         = args.vel
   phasef      = args.phase_file
+  cachedir    = args.cache
+  storedir    = args.model_store
+  timeouts    = { 'taup' : args.timeout, 'hypomod' : args.timeout }
+  sink        = args.results
+
+  if args.trace is not None:
+    tracing.start ()
+
+  with HyComp (outdir, geometry, vel, phasef, cachedir, storedir, sink) as hc:
+    hc.calculate_ttimes (concurrent = args.concurrent, timeouts = timeouts)
+
+  usage.report ()
 
-  hc = HyComp (outdir, geometry, vel, phasef)
-  hc.calculate_ttimes ()
+  if args.trace is not None:
+    tracing.save (args.trace)
 
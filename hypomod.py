@@ -6,33 +6,85 @@
 #
 
 import os, sys
+import mmap
 import numpy as np
 import scipy as sc
 
 import logging as ll
 
-from subprocess import check_call, check_output
-
 from coordinates import *
+from geometry import Geometry
+from runner import run, run_async
+from results import Results
+
+import tracing
 
 class Hypomod:
-  def __init__ (self, outdir, geometry):
+  # input files and the parts of the geometry they depend on
+  files = { 'hyposat-parameter' : ['earthquake'],
+            'regional.vmod'     : ['velocity'],
+            'hyposat-in'        : ['names'],
+            'stations.dat'      : ['stations'] }
+
+  def __init__ (self, outdir, geometry = None):
+    """
+    set up HYPOMOD in outdir, input files are written when a geometry
+    is set.
+    """
     ll.info ("== setting up HYPOMOD")
     self.outdir = outdir
     self.bin    = 'hypomod'
 
-    self.set_geometry (geometry)
+    self.geometry = None
+    self.seen     = {}
+    self.written  = {} # file -> key of the inputs it was last written from
+
+    if geometry is not None:
+      self.set_geometry (geometry)
+
+  @staticmethod
+  def file_keys (geometry):
+    """ keys of the inputs each input file is generated from """
+    return { 'hyposat-parameter' : tuple (geometry.earthquaked),
+             'regional.vmod'     : tuple (tuple (v) for v in geometry.velocities),
+             'hyposat-in'        : geometry.sta['name'].tobytes (),
+             'stations.dat'      : geometry.sta[['name', 'lon', 'lat', 'z']].tobytes () }
 
   def set_geometry (self, geometry):
+    """
+    set up input files for geometry. if this is the geometry used last
+    time only the files depending on parts that changed are considered,
+    and files are only rewritten if the inputs they were last written
+    from changed.
+    """
+    if geometry is not self.geometry:
+      self.seen = {}
+
     self.geometry   = geometry
     self.velocity   = geometry.velocities
     self.stations   = geometry.stations
     self.earthquake = geometry.earthquake
 
-    self.create_parameter_file ()
-    self.create_velocity_file ()
-    self.create_input_file ()
-    self.create_stations_file ()
+    stale = geometry.stale (self.seen)
+    self.seen = geometry.revisions ()
+
+    create = { 'hyposat-parameter' : self.create_parameter_file,
+               'regional.vmod'     : self.create_velocity_file,
+               'hyposat-in'        : self.create_input_file,
+               'stations.dat'      : self.create_stations_file }
+
+    keys = None
+    for f in ['hyposat-parameter', 'regional.vmod', 'hyposat-in', 'stations.dat']:
+      if stale.intersection (self.files[f]):
+        keys = keys if keys is not None else self.file_keys (geometry)
+
+        if self.written.get (f) != keys[f] or not os.path.exists (os.path.join (self.outdir, f)):
+          with tracing.span ('hypomod.write', file = f):
+            create[f] ()
+          self.written[f] = keys[f]
+          continue
+
+      ll.debug ("hypomod: %s is up to date" % f)
 
   def create_parameter_file (self):
     ll.debug ("hypomod: creating parameter file..: hyposat-parameter")
@@ -173,43 +225,147 @@ OUTPUT LEVEL                       : 4
         llat += lat[k:]
         lat = llat
 
-        print (lat, lon)
         sfd.write ("{0:<5s} {1:>9}{2:>10} {3:6.1f}\n".format(s[0], lat, lon, s[3]))
 
   def calculate_times (self, timeout = None):
     ll.info ("=> hypomod: running HYPOMOD..")
-    check_output ("hypomod", cwd = self.outdir, shell = True, timeout = timeout)
+    with tracing.span ('hypomod', stations = len(self.stations)):
+      run ([self.bin], self.outdir, timeout = timeout)
+
+    with tracing.span ('hypomod.parse'):
+      return self.parse_times ()
+
+  async def calculate_times_async (self, timeout = None):
+    ll.info ("=> hypomod: running HYPOMOD (async)..")
+    with tracing.span ('hypomod', stations = len(self.stations)):
+      await run_async ([self.bin], self.outdir, timeout = timeout)
+
+    with tracing.span ('hypomod.parse'):
+      return self.parse_times ()
+
+  def sweep (self, earthquake, distances, direction = [0., -1.]):
+    """
+    run HYPOMOD once for receivers at each of distances (km) from
+    earthquake, placed along direction (x, y) at the surface. every
+    receiver is a separate station (S0000, S0001, ..) in the same run.
+
+    returns a list with the travel times ([station, phase, time] rows) for
+    each distance.
+    """
+    ll.info ("=> hypomod: sweep over {} distances in one run..".format (len(distances)))
+
+    if len(distances) > 10000:
+      raise ValueError ("hypomod: station names are limited to 5 characters, max 10000 distances")
+
+    direction = np.asarray (direction, dtype = np.float64)
+    direction = direction / np.linalg.norm (direction)
+
+    stations = []
+    for i, d in enumerate(distances):
+      x, y = d * direction + np.asarray (earthquake[:2])
+      stations.append (["S%04d" % i, x, y, 0.])
+
+    g = Geometry (self.geometry.reference, stations, earthquake, self.geometry.velocities)
+    self.set_geometry (g)
+
+    return self.calculate_times ()
+
+  def read_output (self, f = None):
+    """
+    parse the station lines of hypomod-out in a single pass (over an
+    mmap of the file). returns a dict with the arrays station, phase,
+    delta (degrees) and time (s, the negated residual) with one element
+    per line, an index of station -> rows and a list of (line number,
+    line) for lines that could not be parsed.
+    """
+    f = f if f is not None else os.path.join (self.outdir, 'hypomod-out')
+
+    stations  = []
+    phases    = []
+    deltas    = []
+    times     = []
+    index     = {}
+    malformed = []
+
+    with open (f, 'rb') as fd:
+      size = os.fstat (fd.fileno ()).st_size
+      m = mmap.mmap (fd.fileno (), 0, access = mmap.ACCESS_READ) if size > 0 else None
+
+      try:
+        start = False
+        n     = 0
+        for l in iter (m.readline, b'') if m is not None else []:
+          n += 1
+          if b'Stat' in l:
+            start = True
+            continue
+
+          if not start:
+            continue
+
+          if b'Travel-time differences:' in l:
+            break
 
-    return self.parse_times ()
+          k = l.split ()
+          if len(k) == 0:
+            continue
+
+          try:
+            # station name, delta, azimuth, phase name, .., residual
+            t = -float(k[8])
+            d = float(k[1])
+          except (IndexError, ValueError):
+            malformed.append ((n, l.decode ('ascii', 'replace').rstrip ()))
+            continue
+
+          s = k[0].decode ('ascii')
+          index.setdefault (s, []).append (len(times))
+          stations.append (s)
+          phases.append (k[3].decode ('ascii'))
+          deltas.append (d)
+          times.append (t)
+      finally:
+        if m is not None:
+          m.close ()
+
+    for n, l in malformed:
+      ll.warning ("hypomod: malformed line %d in %s: %s" % (n, f, l))
+
+    return { 'station'    : np.array (stations),
+             'phase'      : np.array (phases),
+             'delta'      : np.array (deltas, dtype = np.float64),
+             'time'       : np.array (times, dtype = np.float64),
+             'index'      : index,
+             'malformed'  : malformed }
 
   def parse_times (self):
     ll.debug ("=> hypomod: parsing result..")
-    stationlines = []
-    with open(os.path.join (self.outdir, 'hypomod-out'), 'r') as ofd:
-      start = False
-      for l in ofd.readlines ():
-        if 'Stat' in l:
-          start = True
-          continue
+    out = self.read_output ()
+    self.out       = out
+    self.malformed = out['malformed']
 
-        if start:
-          if 'Travel-time differences:' in l:
-            break
-          elif len(l.strip ()) > 0:
-            stationlines.append (l)
-
-    stationlines = [[k.strip() for k in l.split (' ') if len(k.strip()) > 0] for l in stationlines]
+    phases = out['phase'].tolist ()
+    times  = out['time'].tolist ()
 
     ttimes = []
     for s in self.stations:
-      pht = []
-      for l in (ll for ll in stationlines if ll[0] == s[0]):
+      with tracing.span ('hypomod.parse_station', station = s[0]):
         # station name, phase name, ttime
-        pht.append ([s[0], l[3], -float(l[8])])
-      ttimes.append (pht)
+        ttimes.append ([[s[0], phases[i], times[i]] for i in out['index'].get (s[0], [])])
 
+    self.times = ttimes
     return ttimes
 
+  def results (self, event = 0):
+    """ travel times of the last run as Results, in the order of hypomod-out """
+    out   = self.out
+    names = [s[0] for s in self.stations]
+
+    # lines of other stations are left out, as by parse_times
+    m = np.isin (out['station'], names)
+    return Results.from_columns (names, self.geometry.distances,
+                                 out['station'][m], out['phase'][m], out['time'][m], event)
+
   def create_input_file (self):
     # set up stations
     ll.debug ("hypomod: create input file..")
@@ -0,0 +1,296 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# In-process travel times for a flat 1-D layered velocity model
+#
+
+import os, sys
+import numpy as np
+import scipy as sc
+
+import logging as ll
+
+from results import Results
+
+class Layered:
+  """
+  Travel times for a flat earth made of constant velocity layers,
+  built from the same velocity model as the other backends. All
+  calculations are vectorized over epicentral distance and source
+  depth, receivers are placed at the surface (as TauP does).
+
+  Phases:
+
+    P,  S     first arrival
+    Pg, Sg    direct wave
+    Pn, Sn    earliest head wave along any layer boundary below the source
+    PmP, SmS  earliest reflection off a discontinuity below the source
+  """
+
+  known_phases = ['P', 'S', 'Pg', 'Sg', 'Pn', 'Sn', 'PmP', 'SmS']
+
+  # kind of arrival for phase suffix
+  kinds = { '' : 'first', 'g' : 'direct', 'n' : 'head', 'mP' : 'reflected', 'mS' : 'reflected' }
+
+  # radius of earth used for converting km to degrees (as taup_time)
+  radius = 6371.0
+
+  # maximum number of newton iterations and tolerance (km) used for
+  # finding the ray parameter
+  iterations = 50
+  tolerance  = 1e-9
+
+  def __init__ (self, geometry, phases = ['P', 'S'], dz = None, maxdepth = None):
+    """
+    dz:       split layers with a velocity gradient into sub layers of at
+              most dz km, gives better accuracy at higher cost.
+    maxdepth: ignore the model below this depth (km), default is to stop
+              at the first liquid layer.
+    """
+    ll.info ("== setting up layered model")
+    self.phases     = phases
+    self.dz         = dz
+    self.maxdepth   = maxdepth
+
+    for p in phases:
+      if p not in self.known_phases:
+        raise ValueError ("layered: unknown phase: %s" % p)
+
+    self.set_geometry (geometry)
+
+  def set_geometry (self, geometry):
+    self.geometry   = geometry
+    self.stations   = geometry.stations
+    self.earthquake = geometry.earthquake
+
+    if getattr (self, 'velocity', None) is not geometry.velocities:
+      self.velocity = geometry.velocities
+      self.create_layers ()
+
+  def create_layers (self):
+    """
+    set up layers between consecutive depths of the velocity model, the
+    velocity of a layer is the mean of the velocity at its top and bottom.
+    """
+    ll.debug ("layered: creating layers..")
+    top = []
+    vp  = []
+    vs  = []
+    disc = []   # layer top is a discontinuity
+    name = []   # name of discontinuity
+
+    v = self.velocity
+    for i in range(len(v) - 1):
+      z0, z1 = v[i][0], v[i+1][0]
+      if z1 <= z0:
+        continue
+
+      if self.maxdepth is not None and z0 >= self.maxdepth:
+        break
+
+      if v[i][2] <= 0 or v[i+1][2] <= 0:
+        # liquid, S is not defined below here
+        break
+
+      n = 1
+      if self.dz is not None and (v[i][1] != v[i+1][1] or v[i][2] != v[i+1][2]):
+        n = int(np.ceil ((z1 - z0) / self.dz))
+
+      for k in range(n):
+        a = (k + .5) / n
+        top.append (z0 + (z1 - z0) * k / n)
+        vp.append (v[i][1] + (v[i+1][1] - v[i][1]) * a)
+        vs.append (v[i][2] + (v[i+1][2] - v[i][2]) * a)
+        disc.append (k == 0 and i > 0 and v[i-1][0] == z0)
+        name.append (v[i-1][3] if (k == 0 and i > 0 and v[i-1][0] == z0) else '')
+
+    self.top    = np.array (top)
+    self.bottom = np.append (self.top[1:], np.inf)
+    self.vp     = np.array (vp)
+    self.vs     = np.array (vs)
+    self.disc   = np.array (disc, dtype = bool)
+    self.names  = name
+
+    ll.debug ("layered: {} layers".format (len(self.top)))
+
+  def km2deg (self, dist):
+    return dist / self.radius * 180.0 / np.pi
+
+  def thickness (self, z0, z1):
+    """
+    thickness of every layer between depths z0 and z1 (arrays of N),
+    returns an N x L array.
+    """
+    z0 = np.asarray (z0, dtype = np.float64)[:, None]
+    z1 = np.asarray (z1, dtype = np.float64)[:, None]
+    return np.clip (np.minimum (z1, self.bottom) - np.maximum (z0, self.top), 0, None)
+
+  def ray (self, x, h, v):
+    """
+    travel time of a ray that travels through layer thicknesses h (N x L)
+    with velocities v (L) and covers epicentral distance x (N).
+
+    the ray is parameterized by w, the tangent of the angle from the
+    vertical in the fastest layer passed, r = v / vmax:
+
+      x (w) = w * sum (h r / sqrt (1 + w^2 (1 - r^2)))
+      t (w) = sum (h / v * sqrt (1 + w^2) / sqrt (1 + w^2 (1 - r^2)))
+
+    x (w) is concave and increasing, so newton iterations starting at w = 0
+    converge monotonically from below.
+    """
+    # source and receiver both at the surface: horizontal ray in the
+    # top layer
+    flat = np.sum (h, axis = 1) == 0
+    tflat = x / v[0]
+
+    # leave out layers that are not passed by any ray
+    cols = np.any (h > 0, axis = 0)
+    if not np.any (cols):
+      return tflat
+
+    h = h[:, cols]
+    v = v[cols]
+
+    vmax = np.max (np.where (h > 0, v, 0), axis = 1)
+    vmax = np.where (vmax > 0, vmax, 1.)
+    r    = np.where (h > 0, v / vmax[:, None], 0.)
+    hr   = h * r
+    a    = 1. - r**2
+
+    w = np.zeros (len(x))
+    for _i in range(self.iterations):
+      w2 = (w**2)[:, None]
+      c  = 1. + w2 * a
+      g  = hr / np.sqrt (c)
+      xx = w * np.sum (g, axis = 1)
+      dx = np.sum (g / c, axis = 1)
+
+      e = x - xx
+      w = w + np.where (dx > 0, e / np.where (dx > 0, dx, 1.), 0.)
+
+      if np.all (np.abs (e) < self.tolerance):
+        break
+
+    w2 = (w**2)[:, None]
+    t  = np.sum (h / v * np.sqrt ((1. + w2) / (1. + w2 * a)), axis = 1)
+
+    return np.where (flat, tflat, t)
+
+  def ttimes (self, dist, depth, wave = 'P', kinds = ['direct', 'head', 'reflected', 'first']):
+    """
+    travel times of the direct, head and reflected waves and the first
+    arrival for arrays of epicentral distance and source depth (km).
+
+    returns a dict with arrays for the requested kinds (direct, head,
+    reflected and first). unavailable arrivals are inf.
+    """
+    dist, depth = np.broadcast_arrays (np.asarray (dist, dtype = np.float64),
+                                       np.asarray (depth, dtype = np.float64))
+    shape = dist.shape
+    x = dist.ravel ()
+    z = np.clip (depth.ravel (), 0, None)
+    v = self.vp if wave == 'P' else self.vs
+
+    zero = np.zeros (len(x))
+
+    r = {}
+    first = 'first' in kinds
+
+    # direct wave
+    if first or 'direct' in kinds:
+      r['direct'] = self.ray (x, self.thickness (zero, z), v)
+
+    # head waves along the top of every layer below the source, receiver
+    # leg plus source leg.
+    head = np.full (len(x), np.inf)
+    for k in range(1, len(self.top) if (first or 'head' in kinds) else 0):
+      zk = self.top[k]
+      below = z <= zk
+      if not np.any (below):
+        continue
+
+      if np.max (v[:k]) >= v[k]:
+        # not faster than everything above
+        continue
+
+      h = self.thickness (zero[:1], [zk])[:, :k] + self.thickness (z, np.full (len(x), zk))[:, :k]
+
+      s  = v[:k] / v[k]
+      t  = x / v[k] + np.sum (h * np.sqrt (1. / v[:k]**2 - 1. / v[k]**2), axis = 1)
+      xc = np.sum (h * s / np.sqrt (1. - s**2), axis = 1)
+      t  = np.where (below & (x >= xc), t, np.inf)
+      head = np.minimum (head, t)
+
+    r['head'] = head
+
+    # reflections off discontinuities below the source
+    if 'reflected' in kinds:
+      reflected = np.full (len(x), np.inf)
+      for k in np.flatnonzero (self.disc):
+        zk = self.top[k]
+        below = z <= zk
+        if not np.any (below):
+          continue
+
+        h = self.thickness (zero, np.full (len(x), zk)) + self.thickness (z, np.full (len(x), zk))
+        t = np.where (below, self.ray (x, h, v), np.inf)
+        reflected = np.minimum (reflected, t)
+
+      r['reflected'] = reflected
+
+    if first:
+      r['first'] = np.minimum (r['direct'], r['head'])
+
+    return { k : r[k].reshape (shape) for k in kinds }
+
+  def traveltimes (self, dist, depth, phases):
+    """
+    travel times for each of phases at arrays of epicentral distance and
+    source depth (km).
+
+    returns an array of shape (len(phases),) + shape of dist and depth,
+    missing arrivals are nan (as TauP.traveltimes).
+    """
+    for p in phases:
+      if p not in self.known_phases:
+        raise ValueError ("layered: unknown phase: %s" % p)
+
+    t = []
+    for p in phases:
+      k = self.kinds[p[1:]]
+      t.append (self.ttimes (dist, depth, p[0], [k])[k])
+
+    t = np.array (t)
+    return np.where (np.isfinite (t), t, np.nan)
+
+  def calculate_times (self):
+    """
+    calculate travel times for all stations, returns rows of:
+    [station, phase, time, distance (degrees)] like TauP.calculate_times.
+    """
+    ll.info ("layered: calculating travel times for: {} stations".format (len(self.stations)))
+    dist  = np.array (self.geometry.distances, dtype = np.float64)
+    depth = np.full (len(dist), -self.earthquake[2], dtype = np.float64)
+
+    t = {}
+    for w in ['P', 'S']:
+      kinds = list(set(self.kinds[p[1:]] for p in self.phases if p[0] == w))
+      if len(kinds) > 0:
+        t[w] = self.ttimes (dist, depth, w, kinds)
+
+    self.times = []
+    for i, s in enumerate(self.stations):
+      for p in self.phases:
+        tt = t[p[0]][self.kinds[p[1:]]][i]
+        if np.isfinite (tt):
+          self.times.append ([s[0], p, tt, self.km2deg (dist[i])])
+
+    return self.times
+
+  def results (self, event = 0):
+    """ travel times of the last calculation as Results """
+    return Results.from_rows (self.times, [s[0] for s in self.stations],
+                              self.geometry.distances, event)
+
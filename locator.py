@@ -0,0 +1,317 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Vectorized grid search hypocenter locator
+#
+
+import os, sys
+import numpy as np
+import scipy as sc
+
+import logging as ll
+
+import tracing
+
+from layered import *
+from tttable import *
+
+from pyproj import Geod
+g = Geod (ellps = 'WGS84')
+
+# one row per event: hypocenter in km from reference (x, y and depth, positive
+# down), position in degrees, origin time (in the time frame of the picks),
+# rms residual (s) and number of picks used.
+location_dtype = np.dtype ([('x', np.float64), ('y', np.float64), ('depth', np.float64),
+                            ('lon', np.float64), ('lat', np.float64), ('time', np.float64),
+                            ('rms', np.float64), ('n', np.int32)])
+
+class Locator:
+  """
+  Locate events from arrival time picks at the stations of a geometry by
+  a grid search over x, y (km from reference) and depth (km).
+
+  For every node the origin time minimizing the squared residuals is the
+  mean of pick - travel time, so only the hypocenter is searched. Misfits
+  of all events at all nodes of a coarse grid are found at once from a
+  table of travel times at the nodes. The starts best nodes of each event
+  are then refined levels times on local grids of refine nodes along each
+  axis, centered on the best node so far. A start keeps moving to the best
+  node of its local grid until it is the best (up to moves times) before
+  the spacing is halved, so a start is not confined to its coarse cell.
+  The first local grid spans the coarse cell around the node. A start that
+  meets a better start of the same event is dropped, and the best of the
+  refined starts is kept, which avoids most local minima of the misfit.
+
+  The backend is anything with a method:
+
+    traveltimes (dist, depth, phases)
+
+  as Layered (default) or TTtable. Unless tabulate is 0 the backend is
+  sampled once into a table (in memory) covering the distances and depths
+  of the grid, with tabulate km spacing, which is interpolated during the
+  search.
+
+  Picks are given as an array of shape (events, phases, stations) with
+  nan where there is no pick.
+  """
+
+  def __init__ (self, geometry, backend = None, phases = ['P', 'S'],
+                x = None, y = None, depth = (0., 30.), step = 5., levels = 6,
+                refine = 3, starts = 4, moves = 8, chunk = 512, tabulate = .5):
+    """
+    x, y:     range (km) of the grid, default is the extent of the stations
+              with step on every side.
+    depth:    range of depths (km).
+    step:     spacing (km) of the coarse grid.
+    levels:   number of refinements, the final spacing is step / 2**levels.
+    refine:   nodes along each axis of the refinement grids (odd).
+    starts:   number of best coarse nodes refined for every event.
+    moves:    maximum number of moves of a start at every level.
+    chunk:    number of events located at once.
+    tabulate: spacing (km) of the travel time table, 0 to use the backend
+              directly.
+    """
+    ll.info ("locator: setting up..")
+    self.geometry = geometry
+    self.phases   = list(phases)
+    self.backend  = backend if backend is not None else Layered (geometry, self.phases)
+    self.step     = step
+    self.levels   = levels
+    self.refine   = refine
+    self.starts   = starts
+    self.moves    = moves
+    self.chunk    = chunk
+
+    if refine < 3 or refine % 2 == 0:
+      raise ValueError ("locator: refine must be odd and at least 3: %d" % refine)
+
+    if levels < 1:
+      raise ValueError ("locator: levels must be at least 1: %d" % levels)
+
+    if starts < 1:
+      raise ValueError ("locator: starts must be at least 1: %d" % starts)
+
+    self.sx = np.array (geometry.sta['x'], dtype = np.float64)
+    self.sy = np.array (geometry.sta['y'], dtype = np.float64)
+
+    if x is None:
+      x = (np.min (self.sx) - step, np.max (self.sx) + step)
+    if y is None:
+      y = (np.min (self.sy) - step, np.max (self.sy) + step)
+
+    self.bounds = np.array ([x, y, depth], dtype = np.float64)
+
+    if tabulate > 0:
+      self.backend = self.tabulate (self.backend, tabulate)
+
+    self.create_grid ()
+
+  def tabulate (self, backend, spacing):
+    """ travel time table of backend covering all distances and depths of the grid """
+    dx = np.maximum (np.abs (self.sx - self.bounds[0, 0]), np.abs (self.sx - self.bounds[0, 1]))
+    dy = np.maximum (np.abs (self.sy - self.bounds[1, 0]), np.abs (self.sy - self.bounds[1, 1]))
+    dmax = np.max (np.hypot (dx, dy))
+
+    z0, z1 = self.bounds[2]
+    distances = np.arange (0., dmax + 2 * spacing, spacing)
+    depths    = np.linspace (z0, z1, max (int(np.ceil ((z1 - z0) / spacing)), 1) + 1)
+
+    with tracing.span ('locator.tabulate', distances = len(distances), depths = len(depths)):
+      t = TTtable (self.geometry.velocities, self.phases, distances, depths, backend)
+      t.build ()
+      t.setup_interpolators ()
+
+    return t
+
+  def create_grid (self):
+    """ coarse grid nodes and travel times (nodes x phases * stations) at them """
+    axes = [np.arange (b[0], b[1] + self.step / 2., self.step) for b in self.bounds]
+    x, y, z = np.meshgrid (*axes, indexing = 'ij')
+    self.nodes = np.stack ([x.ravel (), y.ravel (), z.ravel ()], axis = -1)
+
+    ll.info ("locator: coarse grid: {} x {} x {} nodes".format (*[len(a) for a in axes]))
+
+    with tracing.span ('locator.grid', nodes = len(self.nodes), stations = len(self.sx)):
+      self.times = self.traveltimes (self.nodes[None])[0]
+
+  def traveltimes (self, nodes):
+    """ travel times from nodes (E x N x 3) to all stations, returns E x N x (phases * stations) """
+    dist  = np.hypot (self.sx - nodes[..., 0, None], self.sy - nodes[..., 1, None])
+    depth = np.broadcast_to (nodes[..., 2, None], dist.shape)
+
+    t = np.asarray (self.backend.traveltimes (dist, depth, self.phases), dtype = np.float64)
+    t = np.moveaxis (t, 0, -2)
+    return t.reshape (t.shape[:-2] + (-1,))
+
+  def picks (self, results, events = None):
+    """
+    picks array from Results (e.g. synthetic arrivals from a backend),
+    the first arrival of each phase is used. stations and phases that are
+    not known to the locator are ignored.
+    """
+    if events is None:
+      events = int(np.max (results.rows['event'])) + 1 if len(results) > 0 else 0
+
+    names = { n : i for i, n in enumerate(self.geometry.sta['name'].tolist ()) }
+    st = np.array ([names.get (s, -1) for s in results.stations] + [-1], dtype = np.int64)
+    ph = np.array ([self.phases.index (p) if p in self.phases else -1
+                    for p in results.phases] + [-1], dtype = np.int64)
+
+    r = results.rows
+    s = st[r['station']]
+    p = ph[r['phase']]
+    keep = (s >= 0) & (p >= 0) & (r['event'] < events)
+
+    picks = np.full ((events, len(self.phases), len(self.sx)), np.inf)
+    np.minimum.at (picks, (r['event'][keep], p[keep], s[keep]), r['time'][keep])
+    picks[np.isinf (picks)] = np.nan
+    return picks
+
+  @staticmethod
+  def misfit (o, w, t):
+    """
+    sum of squared residuals and origin times of events with picks o and
+    weights w (E x K) at nodes with travel times t (N x K, shared by all
+    events, or E x N x K). nodes missing an arrival for a pick are inf.
+    """
+    n  = np.sum (w, axis = 1)
+    tv = np.isfinite (t)
+    t0 = np.where (tv, t, 0.)
+
+    if t.ndim == 2:
+      m    = np.sum (w * o, axis = 1)[:, None] - w @ t0.T
+      ss   = (np.sum (w * o**2, axis = 1)[:, None] - 2. * (w * o) @ t0.T + w @ (t0**2).T)
+      miss = w @ (~tv).T.astype (np.float64)
+    else:
+      d    = w[:, None, :] * (o[:, None, :] - t0)
+      m    = np.sum (d, axis = 2)
+      ss   = np.sum (d * (o[:, None, :] - t0), axis = 2)
+      miss = np.sum (w[:, None, :] * ~tv, axis = 2)
+
+    n  = np.where (n > 0, n, 1.)[:, None]
+    e  = np.clip (ss - m**2 / n, 0, None)
+    return np.where (miss > 0, np.inf, e), m / n
+
+  @staticmethod
+  def met (hypo, err, E, S, h):
+    """
+    starts (E * S, S per event) that are within h (km, along every axis)
+    of a start of the same event with a smaller misfit.
+    """
+    hs = hypo.reshape (E, S, 3)
+    es = err.reshape (E, S)
+    d  = np.max (np.abs (hs[:, :, None, :] - hs[:, None, :, :]), axis = 3)
+    i  = np.arange (S)
+    worse = (es[:, :, None] > es[:, None, :]) | ((es[:, :, None] == es[:, None, :]) & (i[:, None] > i[None, :]))
+    return np.any ((d <= h) & worse, axis = 2).ravel ()
+
+  def locate (self, picks):
+    """ locate events with picks (events x phases x stations), returns array of location_dtype """
+    picks = np.asarray (picks, dtype = np.float64)
+    if picks.ndim != 3 or picks.shape[1:] != (len(self.phases), len(self.sx)):
+      raise ValueError ("locator: picks must have shape (events, %d, %d): %s" % (
+                        len(self.phases), len(self.sx), picks.shape))
+
+    ll.info ("locator: locating {} events..".format (len(picks)))
+
+    loc = np.zeros (len(picks), dtype = location_dtype)
+    for i in range (0, len(picks), self.chunk):
+      with tracing.span ('locator.locate', events = min (self.chunk, len(picks) - i)):
+        self.locate_chunk (picks[i:i + self.chunk], loc[i:i + self.chunk])
+
+    self.calculate_degrees (loc)
+    return loc
+
+  def locate_chunk (self, picks, loc):
+    E = len(picks)
+    w = np.isfinite (picks).reshape (E, -1).astype (np.float64)
+
+    # picks relative to their mean, keeps the sums of squares small
+    p   = np.where (w > 0, picks.reshape (E, -1), 0.)
+    ref = np.sum (p, axis = 1) / np.maximum (np.sum (w, axis = 1), 1.)
+    o   = np.where (w > 0, p - ref[:, None], 0.)
+
+    with tracing.span ('locator.coarse'):
+      e, t0 = self.misfit (o, w, self.times)
+      e = np.where (np.isnan (e), np.inf, e)
+
+      # the starts best nodes of every event, refined as separate events
+      S = min (self.starts, len(self.nodes))
+      best = np.argpartition (e, S - 1, axis = 1)[:, :S] if S < len(self.nodes) else \
+             np.broadcast_to (np.arange (S), (E, S))
+      best = best.ravel ()
+      ke   = np.repeat (np.arange (E), S)
+
+    hypo = self.nodes[best]
+    err  = e[ke, best]
+    orig = t0[ke, best]
+    o, w = o[ke], w[ke]
+
+    # local grid offsets in units of the spacing
+    u = np.arange (self.refine) - (self.refine - 1) / 2.
+    u = np.stack ([a.ravel () for a in np.meshgrid (u, u, u, indexing = 'ij')], axis = -1)
+
+    k = np.arange (E * S)
+    h = self.step
+    for l in range (self.levels):
+      h = h / 2.
+      with tracing.span ('locator.refine', level = l, starts = len(k)):
+        # move the starts that improved to the best node of their local
+        # grid until none improves (or moves times), following valleys of
+        # the misfit.
+        a = k
+        for _m in range (self.moves):
+          nodes = hypo[a, None, :] + u * h
+          nodes = np.clip (nodes, self.bounds[:, 0], self.bounds[:, 1])
+
+          e, t0 = self.misfit (o[a], w[a], self.traveltimes (nodes))
+          j     = np.arange (len(a))
+          best  = np.argmin (e, axis = 1)
+
+          better = e[j, best] < err[a]
+          j, best, a = j[better], best[better], a[better]
+
+          hypo[a] = nodes[j, best]
+          orig[a] = t0[j, best]
+          err[a]  = e[j, best]
+
+          if S > 1:
+            # drop starts that have met a better start of the same event
+            drop = self.met (hypo, err, E, S, h)
+            a = a[~drop[a]]
+            k = k[~drop[k]]
+
+          if len(a) == 0:
+            break
+
+    # keep the best start of every event
+    i    = np.argmin (err.reshape (E, S), axis = 1) + np.arange (E) * S
+    hypo = hypo[i]
+    orig = orig[i]
+    err  = err[i]
+    w    = w[i]
+
+    n = np.sum (w, axis = 1)
+    loc['x']     = hypo[:, 0]
+    loc['y']     = hypo[:, 1]
+    loc['depth'] = hypo[:, 2]
+    ok = np.isfinite (err) & (n > 0)
+    loc['time']  = np.where (ok, orig + ref, np.nan)
+    loc['rms']   = np.where (ok, np.sqrt (err / np.where (n > 0, n, 1.)), np.nan)
+    loc['n']     = n
+
+  def calculate_degrees (self, loc):
+    """ positions in degrees of located events (as Geometry) """
+    n = len(loc)
+    if n == 0:
+      return
+
+    ref = self.geometry.reference
+    d   = np.hypot (loc['x'], loc['y'])
+    az  = np.arctan2 (loc['x'], loc['y']) * 180 / np.pi
+    lon, lat, _baz = g.fwd (np.full (n, ref[0]), np.full (n, ref[1]), az, d * 1000.0)
+
+    loc['lon'] = lon
+    loc['lat'] = lat
+
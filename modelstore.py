@@ -0,0 +1,90 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Shared store of compiled TauP velocity models
+#
+
+import os, sys
+import hashlib
+import shutil
+import tempfile
+
+import logging as ll
+
+from runner import run
+from cache  import binary_version
+
+class ModelStore:
+  """
+  Compiled TauP models, one for each distinct velocity model and
+  taup_create binary, kept in storedir/<hash of .nd model and binary>/.
+  A model is compiled with taup_create the first time it is asked for and
+  linked into the working directory of any TauP instance or worker after
+  that, a new taup_create compiles the models again.
+  """
+
+  default_storedir = os.environ.get ('TAUP_MODEL_STORE',
+      os.path.join (os.path.expanduser ('~'), '.cache', 'hyp_alg_comp', 'taup'))
+
+  def __init__ (self, storedir = None):
+    self.storedir = storedir if storedir is not None else self.default_storedir
+    os.makedirs (self.storedir, exist_ok = True)
+
+  def key (self, nd):
+    """ key of the .nd model, compiled by the taup_create in PATH """
+    v = repr (binary_version ('taup_create'))
+    return hashlib.sha1 ((v + "\n" + nd).encode ('utf-8')).hexdigest ()
+
+  def path (self, key):
+    return os.path.join (self.storedir, key)
+
+  def model (self, nd, name = 'taup_regional'):
+    """
+    return directory with the compiled model for the .nd model, compiling
+    it if it is not in the store.
+    """
+    key = self.key (nd)
+    d   = self.path (key)
+
+    if not os.path.exists (os.path.join (d, name + '.taup')):
+      ll.info ("modelstore: compiling model: %s.." % key)
+
+      # compile in a temporary directory and move it in place, a
+      # concurrent compile of the same model just loses the race.
+      tmpd = tempfile.mkdtemp (prefix = '.' + key, dir = self.storedir)
+      try:
+        with open (os.path.join (tmpd, name + '.nd'), 'w') as fd:
+          fd.write (nd)
+
+        run (['taup_create', '-nd', name + '.nd'], tmpd)
+
+        try:
+          os.rename (tmpd, d)
+        except OSError:
+          if not os.path.exists (os.path.join (d, name + '.taup')):
+            raise
+      finally:
+        shutil.rmtree (tmpd, ignore_errors = True)
+
+    return d
+
+  def link (self, nd, outdir, name = 'taup_regional'):
+    """
+    link the compiled model (and .nd file) into outdir, returns the key
+    of the model.
+    """
+    d = self.model (nd, name)
+
+    for f in [name + '.nd', name + '.taup']:
+      dst = os.path.join (outdir, f)
+      src = os.path.join (d, f)
+      if os.path.islink (dst) and os.readlink (dst) == src:
+        continue
+
+      tmp = dst + ".%d.tmp" % os.getpid ()
+      os.symlink (src, tmp)
+      os.replace (tmp, dst)
+
+    return self.key (nd)
+
@@ -0,0 +1,293 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Parallel Monte Carlo runs over perturbed velocity models and geometries
+#
+
+import os, sys
+import shutil
+import signal
+import tempfile
+import multiprocessing
+import multiprocessing.util
+
+import numpy as np
+
+import logging as ll
+
+from taup       import *
+from hypomod    import *
+from layered    import *
+from geometry   import *
+from modelstore import *
+from compare    import *
+from sandbox    import *
+from runner     import usage
+
+import tracing
+
+class MonteCarlo:
+  """
+  Sensitivity of the travel time differences between two backends (a and
+  b, default TauP and HYPOMOD) to errors in the velocity model and to pick
+  noise.
+
+  models velocity models are drawn by scaling the P and S velocities of
+  every row of the velocity model by 1 + N(0, sigma_velocity). For every
+  model draws geometries are drawn by moving the stations and the
+  earthquake by N(0, sigma_station) and N(0, sigma_earthquake) km (x, y, z),
+  and the travel times of b are taken as picks with N(0, sigma_pick) s
+  noise. The residuals (a - picks) are added to streaming statistics (see
+  RunningStats) per phase, or per phase and distance bin if bins (km) is
+  given, so memory does not grow with the number of draws.
+
+  The draws of a model are split in chunks of chunk draws that are run in
+  a pool of processes. Draws sharing a model are queued together, and the
+  TauP model is compiled once (into the model store) before its chunks
+  are queued. Every worker process runs the backends in a sandbox (see
+  SandboxPool) in outdir/chunks, staged for the unperturbed geometry.
+
+  phases maps phase names in a to the names in b, as for Comparison.
+  """
+
+  backends = ['taup', 'hypomod', 'layered']
+
+  def __init__ (self, outdir, phasef, reference, stations, earthquake, velocities,
+                a = 'taup', b = 'hypomod', phases = { 'p' : 'P', 's4.6p' : 'S' },
+                sigma_velocity = .02, sigma_station = 0., sigma_earthquake = [0., 0., 0.],
+                sigma_pick = .05, bins = None, chunk = 10, processes = None,
+                keep = False, storedir = None, seed = 0):
+    """
+    outdir:     directory for the sandboxes of the workers (outdir/chunks)
+    phasef:     TauP phase file
+    chunk:      number of draws run by a process at a time
+    processes:  number of worker processes (default: number of cores)
+    keep:       keep the sandboxes of the workers when they exit
+    storedir:   directory of the TauP model store (default: ModelStore default)
+    seed:       random seed, runs with the same seed draw the same models
+                and geometries
+    """
+    for k in [a, b]:
+      if k not in MonteCarlo.backends:
+        raise ValueError ("montecarlo: unknown backend: %s" % k)
+
+    if phases is None or len(phases) == 0:
+      raise ValueError ("montecarlo: no phases to compare")
+
+    self.outdir     = os.path.abspath (outdir)
+    self.phasef     = os.path.abspath (phasef)
+    self.reference  = reference
+    self.stations   = stations
+    self.earthquake = earthquake
+    self.velocities = velocities
+    self.a          = a
+    self.b          = b
+    self.phases     = phases
+    self.sigma_velocity   = sigma_velocity
+    self.sigma_station    = sigma_station
+    self.sigma_earthquake = np.broadcast_to (np.asarray (sigma_earthquake, dtype = np.float64), (3,))
+    self.sigma_pick = sigma_pick
+    self.bins       = np.asarray (bins, dtype = np.float64) if bins is not None else None
+    self.chunk      = chunk
+    self.processes  = processes if processes is not None else os.cpu_count ()
+    self.keep       = keep
+    self.storedir   = ModelStore (storedir).storedir
+    self.seed       = seed
+
+    self.chunks     = os.path.join (self.outdir, 'chunks')
+    os.makedirs (self.chunks, exist_ok = True)
+
+    self.stats  = None
+    self.models = []
+
+  def labels (self):
+    """ labels of the statistics groups: phase, or (phase, distance bin) """
+    phases = list(self.phases.keys ())
+    if self.bins is None:
+      return phases
+
+    return [(p, (float(self.bins[i]), float(self.bins[i+1])))
+            for p in phases for i in range (len(self.bins) - 1)]
+
+  def velocity_model (self, rs):
+    """ draw a velocity model, returns the model and the scale of every row """
+    f = 1. + rs.normal (0., self.sigma_velocity, len(self.velocities))
+    return [[v[0], v[1] * s, v[2] * s, v[3]] for v, s in zip (self.velocities, f)], f
+
+  def tasks (self, models, draws):
+    """
+    chunks of draws for every model in order, compiling the TauP model of
+    each model before its chunks are yielded. this runs in the task feeder
+    thread of the pool, so the next model is compiled while the workers run
+    the chunks of the previous.
+    """
+    rs    = np.random.RandomState (self.seed)
+    store = ModelStore (self.storedir)
+
+    for i in range (models):
+      v, _f = self.velocity_model (rs)
+
+      if 'taup' in [self.a, self.b]:
+        with tracing.span ('montecarlo.compile', model = i):
+          store.model (TauP.nd (v))
+
+      for k in range (0, draws, self.chunk):
+        yield (i, v, k, min (self.chunk, draws - k), rs.randint (2**31))
+
+  def run (self, models, draws):
+    """
+    run draws geometries for each of models velocity models. the
+    statistics of all draws are in self.stats, and those of every model in
+    self.models (a RunningStats each, without percentiles). returns
+    self.stats. the resource
+    usage of the backend processes is added to runner.usage.
+    """
+    labels = self.labels ()
+    self.stats  = RunningStats (labels)
+    self.models = [RunningStats (labels, None) for i in range (models)]
+
+    if models == 0 or draws == 0:
+      return self.stats
+
+    ll.info ("montecarlo: {} models x {} draws on {} processes..".format (models, draws, self.processes))
+    with multiprocessing.Pool (self.processes, initializer = _init_worker,
+                               initargs = (self.config (),)) as pool:
+      for i, s, u in pool.imap_unordered (_run_chunk, self.tasks (models, draws)):
+        usage.merge (u)
+        self.models[i].merge (s)
+        self.stats.merge (s)
+
+      pool.close ()
+      pool.join ()
+
+    return self.stats
+
+  def spread (self):
+    """
+    standard deviation (s) between the mean residuals of the models for
+    every group, the part of the differences caused by the velocity model.
+    """
+    n = np.array ([m.n for m in self.models])
+    m = np.array ([m.mean for m in self.models])
+
+    s = np.full (len(self.stats.labels), np.nan)
+    for g in range (len(s)):
+      k = n[:, g] > 0
+      if np.sum (k) > 1:
+        s[g] = np.std (m[k, g], ddof = 1)
+    return s
+
+  def report (self, percentiles = [50, 90, 99]):
+    """ log statistics of all draws, returns them """
+    st = self.stats.stats (percentiles)
+    sp = dict(zip ([str(l) for l in self.stats.labels], self.spread ()))
+
+    ll.info ("montecarlo: residuals ({} - {}) of {} models:".format (self.a, self.b, len(self.models)))
+    for d in st:
+      ll.info ("  {group}: n: {n}, mean: {mean:.4f} s, std: {std:.4f} s, min: {min:.4f} s, max: {max:.4f} s".format (**d))
+      ll.info ("    between models: {:.4f} s".format (sp[str(d['group'])]))
+
+    return st
+
+  def config (self):
+    return { 'chunks'     : self.chunks,
+             'phasef'     : self.phasef,
+             'reference'  : self.reference,
+             'stations'   : self.stations,
+             'earthquake' : self.earthquake,
+             'velocities' : self.velocities,
+             'a'          : self.a,
+             'b'          : self.b,
+             'phases'     : self.phases,
+             'labels'     : self.labels (),
+             'bins'       : self.bins,
+             'sigma'      : (self.sigma_station, self.sigma_earthquake, self.sigma_pick),
+             'storedir'   : self.storedir,
+             'keep'       : self.keep }
+
+## worker process state
+_state = None
+
+def _init_worker (config):
+  global _state
+  _state = dict(config)
+  _state['store'] = ModelStore (config['storedir'])
+
+  # exit on Pool.terminate () so the finalizers below run
+  signal.signal (signal.SIGTERM, _terminate_worker)
+
+  root = tempfile.mkdtemp (prefix = "w%d-" % os.getpid (), dir = config['chunks'])
+  if not config['keep']:
+    multiprocessing.util.Finalize (None, shutil.rmtree, args = (root, True), exitpriority = 5)
+
+  g = Geometry (config['reference'], config['stations'], config['earthquake'], config['velocities'])
+  _state['sandboxes'] = SandboxPool (1, root, geometry = g)
+
+  if 'taup' in [config['a'], config['b']]:
+    w = TauPWorker (config['chunks'], config['phasef'])
+    multiprocessing.util.Finalize (w, w.stop, exitpriority = 10)
+    _state['taup_worker'] = w
+
+def _terminate_worker (signum, frame):
+  sys.exit (1)
+
+def _geometry (c, velocities, rs):
+  """ draw a geometry """
+  ss, se, _sp = c['sigma']
+
+  stations = [[s[0], s[1], s[2], s[3]] for s in c['stations']]
+  if ss > 0:
+    d = rs.normal (0., ss, (len(stations), 2))
+    for s, (dx, dy) in zip (stations, d):
+      s[1] += dx
+      s[2] += dy
+
+  eq = np.array (c['earthquake'], dtype = np.float64) + rs.normal (0., 1., 3) * se
+  eq[2] = min (eq[2], 0.) # not above the surface
+
+  return Geometry (c['reference'], stations, eq, velocities)
+
+def _results (c, backend, h, g, event):
+  """ results of backend for g, h is the checked out sandbox """
+  if backend == 'taup':
+    t = TauP (h.outdir, g, c['phasef'], worker = c['taup_worker'], store = c['store'])
+    t.calculate_times ()
+    return t.results (event)
+
+  elif backend == 'hypomod':
+    h.calculate_times ()
+    return h.results (event)
+
+  else:
+    l = Layered (g)
+    l.calculate_times ()
+    return l.results (event)
+
+def _run_chunk (args):
+  i, velocities, k, n, seed = args
+  c  = _state
+  rs = np.random.RandomState (seed)
+
+  s = RunningStats (c['labels'])
+  for j in range (n):
+    with tracing.span ('montecarlo.draw', model = i, draw = k + j):
+      g  = _geometry (c, velocities, rs)
+      with c['sandboxes'].sandbox (g) as h:
+        ra = _results (c, c['a'], h, g, j)
+        rb = _results (c, c['b'], h, g, j)
+
+      cm = Comparison (ra, rb, c['phases'])
+      r  = cm.residual - rs.normal (0., c['sigma'][2], len(cm))
+
+      grp = cm.phase
+      if c['bins'] is not None:
+        nb  = len(c['bins']) - 1
+        b   = bin_index (cm.distance, c['bins'])
+        grp = np.where (b >= 0, cm.phase * nb + b, -1)
+
+      s.add (grp, r)
+
+  # child process usage is summed up in the main process
+  return i, s, usage.take ()
+
@@ -0,0 +1,179 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Typed columnar container for travel time results
+#
+
+import os, sys
+import numpy as np
+import scipy as sc
+
+import logging as ll
+
+# one row per arrival: event index, station index, phase code, travel time
+# (s) and epicentral distance (km).
+result_dtype = np.dtype ([('event', np.int32), ('station', np.int32), ('phase', np.int32),
+                          ('time', np.float64), ('distance', np.float64)])
+
+class Results:
+  """
+  Travel times from a backend as a structured array (self.rows, see
+  result_dtype). Station and phase names are interned: rows hold indices
+  into self.stations and self.phases.
+  """
+
+  def __init__ (self, stations = [], phases = []):
+    self.stations = []
+    self.phases   = []
+    self.station_index = {}
+    self.phase_index   = {}
+    self.rows = np.zeros (0, dtype = result_dtype)
+
+    for s in stations:
+      self.intern_station (s)
+    for p in phases:
+      self.intern_phase (p)
+
+  def intern_station (self, name):
+    i = self.station_index.get (name)
+    if i is None:
+      i = len(self.stations)
+      self.stations.append (name)
+      self.station_index[name] = i
+    return i
+
+  def intern_phase (self, name):
+    i = self.phase_index.get (name)
+    if i is None:
+      i = len(self.phases)
+      self.phases.append (name)
+      self.phase_index[name] = i
+    return i
+
+  @classmethod
+  def from_rows (cls, rows, stations, distances, event = 0):
+    """
+    rows of [station, phase, time, ..] (as returned by TauP, Layered or a
+    flattened Hypomod calculate_times), stations is a list of all station
+    names and distances the epicentral distance (km) to each of them.
+    """
+    if len(rows) == 0:
+      return cls (stations)
+
+    cols = list(zip (*rows))
+    return cls.from_columns (stations, distances, cols[0], cols[1], cols[2], event)
+
+  @classmethod
+  def from_columns (cls, stations, distances, station, phase, time, event = 0):
+    """
+    arrivals given as arrays (or sequences) of station names, phase names
+    and travel times (s). stations and distances are as for from_rows.
+    every distinct name is interned once (in order of appearance) and the
+    columns are assigned as arrays.
+    """
+    r = cls (stations)
+    n = len(time)
+    a = np.zeros (n, dtype = result_dtype)
+
+    if n > 0:
+      a['event']   = event
+      a['station'] = cls.intern (r.intern_station, station)
+      a['phase']   = cls.intern (r.intern_phase, phase)
+      a['time']    = np.asarray (time, dtype = np.float64)
+
+      d = np.full (len(r.stations), np.nan)
+      distances = np.asarray (distances, dtype = np.float64)
+      m = min (len(distances), len(d))
+      d[:m] = distances[:m]
+      a['distance'] = d[a['station']]
+
+    r.rows = a
+    return r
+
+  @staticmethod
+  def intern (intern, names):
+    """ codes of an array of names, interning each distinct name once """
+    u, first, inv = np.unique (np.asarray (names, dtype = str), return_index = True,
+                               return_inverse = True)
+    codes = np.zeros (len(u), dtype = np.int32)
+    for k in np.argsort (first, kind = 'stable'):
+      codes[k] = intern (str(u[k]))
+    return codes[inv.ravel ()]
+
+  def __len__ (self):
+    return len(self.rows)
+
+  @property
+  def time (self):
+    return self.rows['time']
+
+  @property
+  def distance (self):
+    return self.rows['distance']
+
+  def codes (self, index, names):
+    if isinstance (names, str):
+      names = [names]
+    return np.array ([index.get (n, -1) for n in names], dtype = np.int32)
+
+  def mask (self, station = None, phase = None, event = None):
+    """ station and phase are a name or a list of names """
+    m = np.ones (len(self.rows), dtype = bool)
+    if station is not None:
+      m &= np.isin (self.rows['station'], self.codes (self.station_index, station))
+    if phase is not None:
+      m &= np.isin (self.rows['phase'], self.codes (self.phase_index, phase))
+    if event is not None:
+      m &= self.rows['event'] == event
+    return m
+
+  def select (self, station = None, phase = None, event = None):
+    """ rows matching station, phase and event names (None matches all) """
+    r = Results ()
+    r.stations, r.station_index = self.stations, self.station_index
+    r.phases, r.phase_index     = self.phases, self.phase_index
+    r.rows = self.rows[self.mask (station, phase, event)]
+    return r
+
+  def first (self, phase, event = None, by = 'station', n = None):
+    """
+    time of the first arrival of phase (or any of a list of phases) for
+    every station (indexed as self.stations), or for every event if by is
+    'event'. nan if there is none.
+    """
+    if n is None:
+      if by == 'station':
+        n = len(self.stations)
+      else:
+        n = self.rows['event'].max () + 1 if len(self.rows) > 0 else 0
+
+    t = np.full (n, np.inf)
+    r = self.rows[self.mask (phase = phase, event = event)]
+    np.minimum.at (t, r[by], r['time'])
+    t[np.isinf (t)] = np.nan
+    return t
+
+  def extend (self, other, event = None):
+    """
+    append rows of other, re-mapping its station and phase codes. if
+    event is given it replaces the event index of the new rows.
+    """
+    smap = np.array ([self.intern_station (s) for s in other.stations], dtype = np.int32)
+    pmap = np.array ([self.intern_phase (p) for p in other.phases], dtype = np.int32)
+
+    rows = other.rows.copy ()
+    if len(rows) > 0:
+      rows['station'] = smap[rows['station']]
+      rows['phase']   = pmap[rows['phase']]
+    if event is not None:
+      rows['event'] = event
+
+    self.rows = np.concatenate ([self.rows, rows])
+    return self
+
+  def tolist (self):
+    """ rows as [station, phase, time, distance] """
+    return [[self.stations[s], self.phases[p], t, d] for s, p, t, d in
+            zip (self.rows['station'], self.rows['phase'], self.rows['time'], self.rows['distance'])]
+
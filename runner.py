@@ -0,0 +1,368 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Running external backend programs
+#
+
+import os, sys
+import time
+import signal
+import asyncio
+import warnings
+import threading
+
+import logging as ll
+
+from subprocess import Popen, PIPE, DEVNULL, CalledProcessError, TimeoutExpired
+
+class Usage:
+  """
+  Resource usage of child processes, summed per backend: number of runs,
+  wall time, user and system CPU time (s) and the largest peak resident
+  set size (KiB). On Linux the peak RSS of a child is never less than the
+  RSS of this process when the child was started.
+  """
+
+  def __init__ (self):
+    self.lock = threading.Lock ()
+    self.reset ()
+
+  def reset (self):
+    with self.lock:
+      self.backends = {}
+
+  def add (self, backend, wall, ru):
+    with self.lock:
+      u = self.backends.setdefault (backend, { 'runs' : 0, 'wall' : 0., 'user' : 0.,
+                                               'sys' : 0., 'maxrss' : 0 })
+      u['runs']   += 1
+      u['wall']   += wall
+      u['user']   += ru.ru_utime
+      u['sys']    += ru.ru_stime
+      u['maxrss']  = max (u['maxrss'], ru.ru_maxrss)
+
+    ll.debug ("runner: {}: wall: {:.3f} s, user: {:.3f} s, sys: {:.3f} s, maxrss: {} KiB".format (
+              backend, wall, ru.ru_utime, ru.ru_stime, ru.ru_maxrss))
+
+  def merge (self, summary):
+    """ add a summary from another Usage (e.g. in a worker process) """
+    with self.lock:
+      for b, s in summary.items ():
+        u = self.backends.setdefault (b, { 'runs' : 0, 'wall' : 0., 'user' : 0.,
+                                           'sys' : 0., 'maxrss' : 0 })
+        for k in ['runs', 'wall', 'user', 'sys']:
+          u[k] += s[k]
+        u['maxrss'] = max (u['maxrss'], s['maxrss'])
+
+  def take (self):
+    """ summary, and reset """
+    with self.lock:
+      s, self.backends = self.backends, {}
+    return s
+
+  def summary (self):
+    """ dict of backend -> usage, with mean wall time per run """
+    with self.lock:
+      s = { b : dict(u) for b, u in self.backends.items () }
+
+    for u in s.values ():
+      u['mean_wall'] = u['wall'] / u['runs']
+    return s
+
+  def report (self):
+    """ log summary, returns it """
+    s = self.summary ()
+    if len(s) > 0:
+      ll.info ("runner: child process usage:")
+    for b, u in sorted (s.items ()):
+      ll.info ("  {:<20s} runs: {runs:5d}, wall: {wall:8.3f} s (mean: {mean_wall:.3f} s), user: {user:8.3f} s, sys: {sys:8.3f} s, maxrss: {maxrss} KiB".format (b, **u))
+    return s
+
+# usage of all children started in this process
+usage = Usage ()
+
+def reap (proc, backend, t0, timeout = None):
+  """
+  wait for proc (Popen) to exit with os.wait4 and add its resource usage
+  to usage. raises TimeoutExpired if it has not exited after timeout
+  seconds. returns the exit code.
+  """
+  if proc.returncode is not None:
+    # already reaped (e.g. by Popen.poll), the usage is lost
+    return proc.returncode
+
+  deadline = time.monotonic () + timeout if timeout is not None else None
+  delay    = .0005
+  while True:
+    try:
+      pid, status, ru = os.wait4 (proc.pid, os.WNOHANG if deadline is not None else 0)
+    except ChildProcessError:
+      return proc.poll ()
+
+    if pid != 0:
+      break
+
+    if time.monotonic () > deadline:
+      raise TimeoutExpired (proc.args, timeout)
+
+    time.sleep (delay)
+    delay = min (delay * 2, .05)
+
+  proc.returncode = os.waitstatus_to_exitcode (status)
+  usage.add (backend, time.perf_counter () - t0, ru)
+  return proc.returncode
+
+class Child:
+  """
+  An external program (list of arguments, no shell) started in cwd in its
+  own process group (stderr is passed through), so that any children (e.g. the JVM started by the
+  taup_time script) can be killed with it. Its resource usage is added to
+  usage under backend (default: the program name) when it exits.
+  """
+
+  def __init__ (self, cmd, cwd, input = None, backend = None):
+    ll.debug ("runner: starting: %s" % ' '.join (cmd))
+    self.cmd     = cmd
+    self.input   = input
+    self.backend = backend if backend is not None else os.path.basename (cmd[0])
+    self.killed  = False
+
+    self.t0   = time.perf_counter ()
+    self.proc = Popen (cmd, cwd = cwd, stdin = PIPE if input is not None else DEVNULL,
+                       stdout = PIPE, start_new_session = True)
+
+  def kill (self):
+    if self.proc.returncode is None:
+      ll.warning ("runner: killing: %s" % self.cmd[0])
+      self.killed = True
+      try:
+        os.killpg (self.proc.pid, signal.SIGKILL)
+      except ProcessLookupError:
+        pass
+
+  def writer (self):
+    try:
+      self.proc.stdin.write (self.input)
+    except BrokenPipeError:
+      pass
+    finally:
+      try:
+        self.proc.stdin.close ()
+      except BrokenPipeError:
+        pass
+
+  def begin (self, timeout):
+    """ start writing input and the timeout timer """
+    self.timeout = timeout
+
+    self.w = None
+    if self.input is not None:
+      self.w = threading.Thread (target = self.writer, daemon = True)
+      self.w.start ()
+
+    self.timer = None
+    if timeout is not None:
+      self.timer = threading.Timer (timeout, self.kill)
+      self.timer.start ()
+
+  def finish (self, out, check = True):
+    """
+    reap the program after stdout has been read, raises TimeoutExpired if
+    it was killed after timeout seconds and CalledProcessError if it
+    failed (if check).
+    """
+    try:
+      self.proc.stdout.close ()
+      if self.w is not None:
+        self.w.join ()
+      code = reap (self.proc, self.backend, self.t0)
+    finally:
+      if self.timer is not None:
+        self.timer.cancel ()
+
+    if not check:
+      return
+
+    if self.killed:
+      raise TimeoutExpired (self.cmd, self.timeout, out)
+
+    if code != 0:
+      raise CalledProcessError (code, self.cmd, out)
+
+  def wait (self, timeout = None):
+    """
+    write input, read stdout until the program exits and return it, see
+    finish.
+    """
+    self.begin (timeout)
+    try:
+      out = self.proc.stdout.read ()
+    except BaseException:
+      self.kill ()
+      self.finish (None, False)
+      raise
+
+    self.finish (out)
+    return out
+
+  def lines (self, timeout = None):
+    """
+    generator of the lines (str) of stdout as they are written, the
+    program is reaped and checked when all output has been read (see
+    finish). it is killed if the generator is closed before that.
+    """
+    self.begin (timeout)
+    done = False
+    try:
+      for l in self.proc.stdout:
+        yield l.decode ('ascii')
+      done = True
+    finally:
+      if not done:
+        self.kill ()
+      self.finish (None, done)
+
+def run (cmd, cwd, input = None, timeout = None, backend = None):
+  """
+  run cmd (list of arguments, no shell) in cwd with input on stdin and
+  return stdout, see Child.
+  """
+  return Child (cmd, cwd, input, backend).wait (timeout)
+
+class UsageWatcher (asyncio.ThreadedChildWatcher):
+  """
+  asyncio child watcher that reaps children with os.wait4, as reap does,
+  and keeps their resource usage until it is taken by run_async.
+  """
+
+  def __init__ (self):
+    super ().__init__ ()
+    self.rusage = {}
+
+  def take (self, pid):
+    """ resource usage of the reaped child pid, None if unknown """
+    return self.rusage.pop (pid, None)
+
+  def _do_waitpid (self, loop, expected_pid, callback, args):
+    try:
+      pid, status, ru = os.wait4 (expected_pid, 0)
+      returncode = os.waitstatus_to_exitcode (status)
+      self.rusage[pid] = ru
+    except ChildProcessError:
+      # already reaped elsewhere, the usage is lost
+      pid = expected_pid
+      returncode = 255
+      ll.warning ("runner: unknown child process: %d" % pid)
+
+    if loop.is_closed ():
+      ll.warning ("runner: loop closed before child process %d exited" % pid)
+    else:
+      loop.call_soon_threadsafe (callback, pid, returncode, *args)
+
+    self._threads.pop (expected_pid)
+
+_watcher = None
+
+def usage_watcher ():
+  """
+  install the UsageWatcher for asyncio subprocesses (once) and return it,
+  None if asyncio has no child watchers (python 3.14 and later).
+  """
+  global _watcher
+  if not hasattr (asyncio, 'set_child_watcher'):
+    return None
+
+  if _watcher is None:
+    with warnings.catch_warnings ():
+      warnings.simplefilter ('ignore', DeprecationWarning)
+      _watcher = UsageWatcher ()
+      asyncio.set_child_watcher (_watcher)
+
+  return _watcher
+
+async def run_async (cmd, cwd, input = None, timeout = None, backend = None):
+  """
+  as run, but as an asyncio subprocess so that several can run
+  concurrently. the program is killed if it times out or the calling
+  task is cancelled. it is reaped by UsageWatcher, so its resource usage
+  is added to usage as for run.
+  """
+  watcher = usage_watcher ()
+  if watcher is None:
+    return await run_async_thread (cmd, cwd, input, timeout, backend)
+
+  backend = backend if backend is not None else os.path.basename (cmd[0])
+  ll.debug ("runner: starting: %s" % ' '.join (cmd))
+
+  t0   = time.perf_counter ()
+  proc = await asyncio.create_subprocess_exec (*cmd, cwd = cwd,
+                  stdin = PIPE if input is not None else DEVNULL, stdout = PIPE,
+                  start_new_session = True)
+  try:
+    out, _err = await asyncio.wait_for (proc.communicate (input), timeout)
+
+  except BaseException as e:
+    # timed out or cancelled: kill the process group (see Child)
+    ll.warning ("runner: killing: %s" % cmd[0])
+    try:
+      os.killpg (proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+    await proc.wait ()
+
+    if isinstance (e, asyncio.TimeoutError):
+      raise TimeoutExpired (cmd, timeout) from None
+    raise
+
+  finally:
+    ru = watcher.take (proc.pid)
+    if ru is not None:
+      usage.add (backend, time.perf_counter () - t0, ru)
+
+  if proc.returncode != 0:
+    raise CalledProcessError (proc.returncode, cmd, out)
+
+  return out
+
+async def run_async_thread (cmd, cwd, input = None, timeout = None, backend = None):
+  """
+  as run_async, but waits for the program with Child.wait in a thread, for
+  when asyncio has no child watcher to reap it with.
+  """
+  c = Child (cmd, cwd, input, backend)
+  f = asyncio.get_running_loop ().run_in_executor (None, c.wait, timeout)
+  try:
+    return await asyncio.shield (f)
+  except asyncio.CancelledError:
+    c.kill ()
+    await asyncio.gather (f, return_exceptions = True)
+    raise
+
+async def run_backends (jobs):
+  """
+  run the coroutines in jobs (dict of name -> coroutine) concurrently.
+  if one fails the others are cancelled and the exception is raised,
+  otherwise a dict of name -> result is returned.
+  """
+  # the task names label their rows in the trace
+  tasks = { name : asyncio.ensure_future (job) for name, job in jobs.items () }
+  for name, t in tasks.items ():
+    t.set_name (name)
+  if len(tasks) == 0:
+    return {}
+
+  done, pending = await asyncio.wait (tasks.values (), return_when = asyncio.FIRST_EXCEPTION)
+
+  if len(pending) > 0:
+    for t in pending:
+      t.cancel ()
+    await asyncio.gather (*pending, return_exceptions = True)
+
+  for name, t in tasks.items ():
+    if t.done () and not t.cancelled () and t.exception () is not None:
+      ll.error ("runner: %s failed: %r" % (name, t.exception ()))
+      raise t.exception ()
+
+  return { name : t.result () for name, t in tasks.items () }
+
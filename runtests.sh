@@ -7,3 +7,47 @@ popd
 pushd tests/hyposat_0deg
 python ./hyposat_0deg.py || exit 1
 popd
+
+pushd tests/result_cache
+python ./result_cache.py || exit 1
+popd
+
+pushd tests/result_sink
+python ./result_sink.py || exit 1
+popd
+
+pushd tests/comparison
+python ./comparison.py || exit 1
+popd
+
+pushd tests/locate
+python ./locate.py || exit 1
+popd
+
+pushd tests/layered_times
+python ./layered_times.py || exit 1
+popd
+
+pushd tests/sweep_journal
+python ./sweep_journal.py || exit 1
+popd
+
+pushd tests/hypomod_output
+python ./hypomod_output.py || exit 1
+popd
+
+pushd tests/taup_stream
+python ./taup_stream.py || exit 1
+popd
+
+pushd tests/montecarlo_stats
+python ./montecarlo_stats.py || exit 1
+popd
+
+pushd tests/sandbox_pool
+python ./sandbox_pool.py || exit 1
+popd
+
+pushd tests/geometry_stale
+python ./geometry_stale.py || exit 1
+popd
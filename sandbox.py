@@ -0,0 +1,120 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Pool of pre-staged HYPOMOD working directories
+#
+
+import os, sys
+import shutil
+import tempfile
+import threading
+import contextlib
+
+import logging as ll
+
+from concurrent.futures import ThreadPoolExecutor
+
+from hypomod import *
+
+import tracing
+
+class SandboxPool:
+  """
+  A pool of HYPOMOD working directories (sandboxes), optionally on a RAM
+  backed file system. Every sandbox remembers the inputs its files were
+  written from, so checking out a sandbox for a geometry only rewrites
+  the files that differ. A free sandbox with the most files already up to
+  date for the geometry is preferred.
+
+  Sandboxes are checked out and back in by threads, each sandbox runs
+  one hypomod at a time.
+
+  If a geometry is given the input files (parameters, velocity model and
+  stations) of every sandbox are written for it when the pool is created,
+  so a checkout for a similar geometry only rewrites what differs.
+  """
+
+  def __init__ (self, size, root = None, ram = False, geometry = None):
+    """
+    size:     number of sandboxes
+    root:     directory for sandboxes (default: a new temporary directory,
+              in /dev/shm if ram is True and it exists)
+    geometry: geometry to stage the input files of the sandboxes for
+    """
+    self.size = size
+    self.own  = root is None
+
+    if root is None:
+      d = '/dev/shm' if ram and os.path.isdir ('/dev/shm') else None
+      root = tempfile.mkdtemp (prefix = 'hypomod-', dir = d)
+
+    self.root = root
+    ll.info ("sandbox: setting up {} HYPOMOD sandboxes in: {}".format (size, root))
+
+    self.free = []
+    for i in range(size):
+      d = os.path.join (root, "%03d" % i)
+      os.makedirs (d, exist_ok = True)
+      self.free.append (Hypomod (d))
+
+    if geometry is not None:
+      with tracing.span ('sandbox.stage', sandboxes = size):
+        for h in self.free:
+          h.set_geometry (geometry)
+
+    self.cond = threading.Condition ()
+
+  def checkout (self, geometry, timeout = None):
+    """
+    check out a sandbox with the input files set up for geometry, waits
+    for a free sandbox up to timeout seconds.
+    """
+    keys = Hypomod.file_keys (geometry)
+
+    with self.cond:
+      if not self.cond.wait_for (lambda: len(self.free) > 0, timeout):
+        raise TimeoutError ("sandbox: no free sandbox")
+
+      score = [sum (h.written.get (f) == k for f, k in keys.items ()) for h in self.free]
+      h = self.free.pop (score.index (max (score)))
+
+    h.set_geometry (geometry)
+    return h
+
+  def checkin (self, h):
+    with self.cond:
+      self.free.append (h)
+      self.cond.notify ()
+
+  @contextlib.contextmanager
+  def sandbox (self, geometry, timeout = None):
+    h = self.checkout (geometry, timeout)
+    try:
+      yield h
+    finally:
+      self.checkin (h)
+
+  def calculate_times (self, geometry, timeout = None):
+    """ run HYPOMOD for geometry in a free sandbox """
+    with self.sandbox (geometry) as h:
+      return h.calculate_times (timeout)
+
+  def map (self, geometries, timeout = None):
+    """
+    run HYPOMOD for every geometry, using all sandboxes at once. returns
+    travel times in the order of geometries.
+    """
+    with ThreadPoolExecutor (self.size) as ex:
+      return list(ex.map (lambda g: self.calculate_times (g, timeout), geometries))
+
+  def close (self):
+    if self.own:
+      shutil.rmtree (self.root, ignore_errors = True)
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, *args):
+    self.close ()
+
@@ -0,0 +1,154 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Append-only binary file of travel time results
+#
+
+import os, sys
+import json
+import numpy as np
+import scipy as sc
+
+import logging as ll
+
+from results import *
+
+# rows on disk are Results rows with the backend code in front.
+sink_dtype = np.dtype ([('backend', np.int32)] + result_dtype.descr)
+
+class ResultSink:
+  """
+  Results appended to a file of fixed size records (path.bin, see
+  sink_dtype) as they are produced. Station, phase and backend names are
+  interned in a small JSON sidecar (path.json), which is replaced before
+  any rows referring to new names are written.
+
+  The record file has no header, so a reader can memory map it at any
+  time, also while a sweep is still appending, see ResultSink.load.
+  """
+
+  def __init__ (self, path, truncate = False):
+    self.path   = path
+    self.binf   = path + '.bin'
+    self.jsonf  = path + '.json'
+
+    d = os.path.dirname (os.path.abspath (path))
+    os.makedirs (d, exist_ok = True)
+
+    if truncate or not os.path.exists (self.binf):
+      self.names = { 'stations' : [], 'phases' : [], 'backends' : [] }
+      self.write_names ()
+      mode = 'wb'
+    else:
+      self.names = self.read_names (path)
+      mode = 'ab'
+
+    self.index = { k : { n : i for i, n in enumerate(v) } for k, v in self.names.items () }
+    self.fd    = open (self.binf, mode)
+
+    # drop any partial record left by an interrupted writer
+    size = self.fd.seek (0, os.SEEK_END)
+    if size % sink_dtype.itemsize != 0:
+      ll.warning ("sink: truncating partial record in: %s" % self.binf)
+      self.fd.truncate (size - size % sink_dtype.itemsize)
+      self.fd.seek (0, os.SEEK_END)
+
+    self.rows = self.fd.tell () // sink_dtype.itemsize
+
+  @staticmethod
+  def read_names (path):
+    with open (path + '.json', 'r') as fd:
+      return json.load (fd)
+
+  def write_names (self):
+    tmpf = self.jsonf + ".%d.tmp" % os.getpid ()
+    with open (tmpf, 'w') as fd:
+      json.dump (self.names, fd)
+    os.replace (tmpf, self.jsonf)
+
+  def intern (self, kind, names):
+    """ codes for names, new names are added to the sidecar """
+    idx = self.index[kind]
+    new = False
+    for n in names:
+      if n not in idx:
+        idx[n] = len(self.names[kind])
+        self.names[kind].append (n)
+        new = True
+
+    return np.array ([idx[n] for n in names], dtype = np.int32), new
+
+  def append (self, backend, results):
+    """ append Results from backend """
+    if len(results) == 0:
+      return
+
+    smap, news = self.intern ('stations', results.stations)
+    pmap, newp = self.intern ('phases', results.phases)
+    bmap, newb = self.intern ('backends', [backend])
+    if news or newp or newb:
+      self.write_names ()
+
+    a = np.empty (len(results), dtype = sink_dtype)
+    for f in result_dtype.names:
+      a[f] = results.rows[f]
+    a['backend'] = bmap[0]
+    a['station'] = smap[results.rows['station']]
+    a['phase']   = pmap[results.rows['phase']]
+
+    self.fd.write (a.tobytes ())
+    self.fd.flush ()
+    self.rows += len(a)
+
+  def truncate (self, rows):
+    """ drop all but the first rows, e.g. rows of unfinished work """
+    if rows < self.rows:
+      ll.warning ("sink: dropping {} rows after row {} in: {}".format (self.rows - rows, rows, self.binf))
+      self.fd.truncate (rows * sink_dtype.itemsize)
+      self.fd.seek (0, os.SEEK_END)
+      self.rows = rows
+
+  def sync (self):
+    """ make sure the rows written so far are on disk """
+    self.fd.flush ()
+    os.fsync (self.fd.fileno ())
+
+  def close (self):
+    if self.fd is not None:
+      self.fd.close ()
+      self.fd = None
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, *args):
+    self.close ()
+
+  def __del__ (self):
+    self.close ()
+
+  @staticmethod
+  def load (path, backend = None):
+    """
+    memory map the rows written so far. returns Results with the rows of
+    backend (all backends if None), the backend codes are dropped when
+    selecting a single backend.
+    """
+    names = ResultSink.read_names (path)
+    n     = os.path.getsize (path + '.bin') // sink_dtype.itemsize
+
+    if n > 0:
+      rows = np.memmap (path + '.bin', dtype = sink_dtype, mode = 'r', shape = (n,))
+    else:
+      rows = np.zeros (0, dtype = sink_dtype)
+
+    r = Results (names['stations'], names['phases'])
+    if backend is None:
+      r.rows = rows
+    else:
+      b = names['backends'].index (backend) if backend in names['backends'] else -1
+      r.rows = rows[rows['backend'] == b][list(result_dtype.names)]
+
+    return r
+
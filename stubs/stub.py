@@ -0,0 +1,111 @@
+#! /usr/bin/env python3
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Common behaviour of the stub executables (taup_time, taup_create and
+# hypomod) used for testing without the real programs.
+#
+## The stubs are configured with environment variables, every variable can
+## be given for all stubs (HYP_STUB_<KEY>) or for one of them, which takes
+## precedence (HYP_STUB_TAUP_TIME_<KEY>, HYP_STUB_TAUP_CREATE_<KEY> or
+## HYP_STUB_HYPOMOD_<KEY>):
+##
+##   LATENCY   startup latency in seconds (default: 0)
+##   JITTER    random extra latency, uniform in 0 .. JITTER seconds
+##   DELAY     latency in seconds for every calculation (taup_time requests)
+##   FAIL      probability (0 .. 1) of failing with exit code 1
+##   HANG      probability (0 .. 1) of hanging until killed
+##   SEED      random seed (default: random)
+##
+## FAIL and HANG are drawn at startup and for every taup_time request in
+## interactive mode.
+##
+## Travel times are calculated analytically with the flat layered model in
+## layered.py.
+
+import os, sys
+import time
+import random
+
+import numpy as np
+
+sys.path.append (os.path.abspath (os.path.join (os.path.dirname (__file__), '..')))
+
+class Stub:
+  def __init__ (self, name):
+    self.name   = name
+    self.prefix = 'HYP_STUB_' + name.upper () + '_'
+
+    seed = self.get ('SEED', None)
+    self.random = random.Random (int(seed) if seed is not None else None)
+
+    self.latency  = float (self.get ('LATENCY', 0.))
+    self.jitter   = float (self.get ('JITTER', 0.))
+    self.delay    = float (self.get ('DELAY', 0.))
+    self.fail     = float (self.get ('FAIL', 0.))
+    self.hang     = float (self.get ('HANG', 0.))
+
+  def get (self, key, default):
+    v = os.environ.get (self.prefix + key)
+    if v is None:
+      v = os.environ.get ('HYP_STUB_' + key, default)
+    return v
+
+  def chaos (self):
+    """ fail or hang at random """
+    if self.hang > 0 and self.random.random () < self.hang:
+      sys.stdout.flush ()
+      while True:
+        time.sleep (3600)
+
+    if self.fail > 0 and self.random.random () < self.fail:
+      sys.stdout.flush ()
+      sys.stderr.write ("%s (stub): simulated failure\n" % self.name)
+      sys.exit (1)
+
+  def start (self):
+    t = self.latency
+    if self.jitter > 0:
+      t += self.random.uniform (0, self.jitter)
+    if t > 0:
+      time.sleep (t)
+
+    self.chaos ()
+
+  def request (self):
+    if self.delay > 0:
+      time.sleep (self.delay)
+
+    self.chaos ()
+
+class Model:
+  """ minimal geometry for Layered: only the velocity model is used """
+  def __init__ (self, velocities):
+    self.velocities = velocities
+    self.stations   = []
+    self.earthquake = [0., 0., 0.]
+
+def layered (velocities):
+  from layered import Layered
+  return Layered (Model (velocities))
+
+def read_nd (text):
+  """ velocity model from TauP .nd text, as in vel.csv """
+  v = []
+  for l in text.splitlines ():
+    l = l.strip ()
+    if len(l) == 0:
+      continue
+
+    if l == 'mantle':
+      v[-1][3] = 'MOHO'
+    elif l == 'seafloor':
+      v[-1][3] = 'seafloor'
+    elif l in ['outer-core', 'inner-core', 'cmb', 'icocb']:
+      continue
+    else:
+      s = l.split ()
+      v.append ([float(s[0]), float(s[1]), float(s[2]), ''])
+
+  return v
+
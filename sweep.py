@@ -0,0 +1,198 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Parallel sweeps over geometries with isolated working directories
+#
+
+import os, sys
+import shutil
+import tempfile
+import multiprocessing
+import multiprocessing.util
+import signal
+
+import logging as ll
+
+from taup       import *
+from hypomod    import *
+from layered    import *
+from geometry   import *
+from modelstore import *
+from sink       import *
+from sandbox    import *
+from runner     import usage
+
+class Sweep:
+  """
+  Run the forward modelling backends for a list of sweep points in a
+  pool of processes. A sweep point is a (stations, earthquake) pair in
+  the same format as for Geometry.
+
+  The compiled TauP model is taken from the model store, where the
+  taup_time workers also run. Every worker process has a sandbox (see
+  SandboxPool) in outdir/points, staged for the first point, that it
+  checks out for every point. The backends write their files there, and
+  only the input files that differ from the last point are rewritten.
+  Results are returned in the order of the points.
+  """
+
+  backends = ['taup', 'hypomod', 'layered']
+
+  def __init__ (self, outdir, phasef, reference, velocities, processes = None,
+                backends = None, keep = False, storedir = None):
+    """
+    outdir:     directory for shared files and scratch directories
+    phasef:     TauP phase file
+    processes:  number of worker processes (default: number of cores)
+    backends:   backends to run (default: all in Sweep.backends)
+    keep:       keep the sandboxes of the workers when they exit
+    storedir:   directory of the TauP model store (default: ModelStore default)
+    """
+    self.outdir     = os.path.abspath (outdir)
+    self.phasef     = os.path.abspath (phasef)
+    self.reference  = reference
+    self.velocities = velocities
+    self.processes  = processes if processes is not None else os.cpu_count ()
+    self.backends   = backends if backends is not None else Sweep.backends
+    self.keep       = keep
+    self.storedir   = ModelStore (storedir).storedir
+
+    self.shared     = os.path.join (self.outdir, 'shared')
+    self.points     = os.path.join (self.outdir, 'points')
+
+    os.makedirs (self.shared, exist_ok = True)
+    os.makedirs (self.points, exist_ok = True)
+
+  def prepare (self, point):
+    """ link (and compile if needed) the TauP model in the shared directory """
+    if 'taup' in self.backends:
+      ll.info ("sweep: preparing shared TauP model..")
+      g = Geometry (self.reference, point[0], point[1], self.velocities)
+      TauP (self.shared, g, self.phasef, store = ModelStore (self.storedir))
+
+  def run (self, points, sink = None):
+    """
+    run all points, returns a list with a dict of backend -> Results for
+    each point. the event index of the rows is the index of the point.
+    the resource usage of the backend processes is added to runner.usage.
+
+    if sink (a ResultSink) is given the results of every point are
+    appended to it as soon as the point is finished, in any order, and
+    nothing is returned.
+    """
+    points = list(points)
+
+    if sink is None:
+      return [r for _e, r in self.imap (points, ordered = True)]
+
+    for _e, r in self.imap (points):
+      for b in self.backends:
+        sink.append (b, r[b])
+
+  def imap (self, points, events = None, ordered = False):
+    """
+    run all points, yields (event, dict of backend -> Results) for every
+    point as soon as it is finished (in the order of points if ordered).
+    events are the event indices of the points (default: the index of
+    the point), also used for naming the scratch directories.
+    """
+    points = list(points)
+    if len(points) == 0:
+      return
+
+    events = list(events) if events is not None else list(range (len(points)))
+
+    self.prepare (points[0])
+
+    ll.info ("sweep: running {} points on {} processes..".format (len(points), self.processes))
+    pool = multiprocessing.Pool (self.processes, initializer = _init_worker,
+                                 initargs = (self.config (), points[0]))
+    finished = False
+    try:
+      m = pool.imap if ordered else pool.imap_unordered
+      for e, r, u in m (_run_point, zip (events, points)):
+        usage.merge (u)
+        yield e, r
+
+      finished = True
+
+    finally:
+      # on errors, interrupts or when the caller stops early the workers are
+      # terminated, they stop their taup_time worker on SIGTERM (see
+      # _init_worker). wait for them so no taup_time is left behind.
+      if finished:
+        pool.close ()
+      else:
+        pool.terminate ()
+      pool.join ()
+
+  def config (self):
+    return { 'shared'     : self.shared,
+             'points'     : self.points,
+             'phasef'     : self.phasef,
+             'reference'  : self.reference,
+             'velocities' : self.velocities,
+             'backends'   : self.backends,
+             'storedir'   : self.storedir,
+             'keep'       : self.keep }
+
+## worker process state
+_state = None
+
+def _init_worker (config, point):
+  global _state
+  _state = dict(config)
+  _state['store'] = ModelStore (config['storedir'])
+
+  # Pool.terminate () sends SIGTERM, which would kill the process without
+  # running the finalizers below. exit instead so they stop taup_time and
+  # remove the sandbox.
+  signal.signal (signal.SIGTERM, _terminate_worker)
+
+  g = Geometry (config['reference'], point[0], point[1], config['velocities'])
+  _state['sandboxes'] = _sandboxes (config['points'], config['keep'], g)
+
+  if 'taup' in config['backends']:
+    # the taup_time worker is moved to the store directory of the model
+    # by TauP.
+    w = TauPWorker (config['shared'], config['phasef'])
+    multiprocessing.util.Finalize (w, w.stop, exitpriority = 10)
+    _state['taup_worker'] = w
+
+def _terminate_worker (signum, frame):
+  sys.exit (1)
+
+def _sandboxes (parent, keep, geometry):
+  """ a sandbox in a new directory in parent for this worker, removed on exit unless keep """
+  root = tempfile.mkdtemp (prefix = "w%d-" % os.getpid (), dir = parent)
+  if not keep:
+    multiprocessing.util.Finalize (None, shutil.rmtree, args = (root, True), exitpriority = 5)
+
+  return SandboxPool (1, root, geometry = geometry)
+
+def _run_point (args):
+  i, (stations, earthquake) = args
+  c = _state
+
+  g = Geometry (c['reference'], stations, earthquake, c['velocities'])
+
+  r = {}
+  with c['sandboxes'].sandbox (g) as h:
+    if 'taup' in c['backends']:
+      t = TauP (h.outdir, g, c['phasef'], worker = c['taup_worker'], store = c['store'])
+      t.calculate_times ()
+      r['taup'] = t.results (i)
+
+    if 'hypomod' in c['backends']:
+      h.calculate_times ()
+      r['hypomod'] = h.results (i)
+
+  if 'layered' in c['backends']:
+    l = Layered (g)
+    l.calculate_times ()
+    r['layered'] = l.results (i)
+
+  # child process usage is summed up in the main process
+  return i, r, usage.take ()
+
@@ -0,0 +1,338 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Declarative sweeps over distance, azimuth, depth, velocity model and backend
+#
+## A sweep is specified in a JSON file, e.g.:
+##
+##   {
+##     "reference" : [1.0, 0.0],
+##     "phases"    : "phases.dat",
+##     "models"    : { "gakkel" : "vel.csv" },
+##     "epicenter" : [10.0, 10.0],
+##     "distance"  : { "start" : 0.0, "stop" : 100.1, "step" : 5.0 },
+##     "azimuth"   : [180.0],
+##     "depth"     : [80.0],
+##     "backends"  : ["taup", "layered"]
+##   }
+##
+## every point has a single station (named STA, or "station") at distance
+## (km) and azimuth (degrees clockwise from north) from the epicenter (km
+## from reference), and the earthquake at depth (km, positive down) below
+## the epicenter. models are velocity model files (as vel.csv, relative to
+## the spec file) or velocity models given as lists of [depth, velp, vels,
+## identifier]. dimensions are either a list of values, a single value or
+## start, stop and step (as np.arange).
+##
+## Run with:
+##
+##   ./sweepspec.py spec.json -o out/sweep
+##
+## results are appended to out/sweep/results (see ResultSink) with the
+## index of the point as the event index, and finished tasks are recorded
+## in out/sweep/journal. running the same command again after an
+## interruption resumes where the sweep stopped.
+
+import os, sys
+import argparse
+import json
+import time
+import hashlib
+
+import numpy as np
+
+import logging as ll
+
+from geometry   import *
+from sweep      import *
+from sink       import *
+
+class SweepSpec:
+  """
+  A sweep specification (see above) expanded into points over the
+  product of the velocity models, depths, azimuths and distances, in that
+  order (the distance varies fastest). A task is a point and a backend,
+  numbered point * len(backends) + backend.
+  """
+
+  def __init__ (self, spec, root = '.'):
+    """ spec is the parsed JSON, root the directory relative paths are relative to """
+    self.spec = spec
+    self.root = root
+
+    if 'reference' not in spec:
+      raise ValueError ("sweepspec: no reference")
+
+    self.reference  = [float(v) for v in spec['reference']]
+    self.phasef     = self.path (spec.get ('phases', 'phases.dat'))
+    self.epicenter  = [float(v) for v in spec.get ('epicenter', [0., 0.])]
+    self.station    = spec.get ('station', 'STA')
+
+    self.distances  = self.values ('distance')
+    self.azimuths   = self.values ('azimuth', 0.)
+    self.depths     = self.values ('depth')
+
+    models = spec.get ('models')
+    if models is None or len(models) == 0:
+      raise ValueError ("sweepspec: no velocity models")
+
+    self.models     = sorted (models.keys ())
+    self.velocities = { m : self.velocity (models[m]) for m in self.models }
+
+    self.backends   = spec.get ('backends', Sweep.backends)
+    for b in self.backends:
+      if b not in Sweep.backends:
+        raise ValueError ("sweepspec: unknown backend: %s" % b)
+
+    self.shape = (len(self.models), len(self.depths), len(self.azimuths), len(self.distances))
+
+  @classmethod
+  def load (cls, f):
+    with open (f, 'r') as fd:
+      return cls (json.load (fd), os.path.dirname (os.path.abspath (f)))
+
+  def path (self, f):
+    return os.path.join (self.root, f)
+
+  def values (self, key, default = None):
+    """ values of a dimension """
+    v = self.spec.get (key, default)
+    if v is None:
+      raise ValueError ("sweepspec: no values for: %s" % key)
+
+    if isinstance (v, dict):
+      v = np.arange (float(v['start']), float(v['stop']), float(v['step']))
+    else:
+      v = np.atleast_1d (np.asarray (v, dtype = np.float64))
+
+    if len(v) == 0:
+      raise ValueError ("sweepspec: no values for: %s" % key)
+
+    return v
+
+  def velocity (self, m):
+    """ velocity model from a file name or a list of rows """
+    if isinstance (m, str):
+      return read_velocity (self.path (m))
+    return [[float(v[0]), float(v[1]), float(v[2]), v[3] if len(v) > 3 else ''] for v in m]
+
+  def key (self):
+    """
+    hash of everything the results depend on: the points, the velocity
+    models, the backends and the phase file.
+    """
+    h = hashlib.sha1 ()
+    h.update (json.dumps ([self.reference, self.epicenter, self.station, self.backends,
+                           [self.velocities[m] for m in self.models], self.models]).encode ('ascii'))
+    for a in [self.depths, self.azimuths, self.distances]:
+      h.update (a.tobytes ())
+
+    with open (self.phasef, 'rb') as fd:
+      h.update (fd.read ())
+
+    return h.hexdigest ()
+
+  def __len__ (self):
+    """ number of points """
+    return int(np.prod (self.shape))
+
+  def tasks (self):
+    return len(self) * len(self.backends)
+
+  def point (self, p):
+    """ model, depth, azimuth and distance of point p """
+    m, z, a, d = np.unravel_index (p, self.shape)
+    return self.models[m], self.depths[z], self.azimuths[a], self.distances[d]
+
+  def geometry (self, p):
+    """ stations and earthquake of point p, as a sweep point """
+    _m, z, a, d = self.point (p)
+    az = np.radians (a)
+
+    x = self.epicenter[0] + d * np.sin (az)
+    y = self.epicenter[1] + d * np.cos (az)
+    return [[self.station, x, y, 0.]], [self.epicenter[0], self.epicenter[1], -z]
+
+  def points (self, model):
+    """ range of the points with model """
+    n = len(self) // len(self.models)
+    m = self.models.index (model)
+    return range (m * n, (m + 1) * n)
+
+class Journal:
+  """
+  Crash safe record of finished tasks, in a text file with the key of the
+  sweep spec on the first line and then a line "task rows" for every
+  finished task, where rows is the number of rows in the result sink after
+  the results of the task were appended.
+
+  Finished tasks are written in batches (sync), after the result sink is
+  synced to disk, and the journal is synced to disk after. Rows in the
+  sink after the last recorded task are from tasks that were not recorded,
+  and are dropped when resuming. A partial last line is dropped on open.
+  """
+
+  def __init__ (self, path, key, restart = False):
+    self.path    = path
+    self.key     = key
+    self.done    = set ()
+    self.rows    = 0
+    self.pending = []
+
+    if restart or not os.path.exists (path):
+      tmpf = path + ".%d.tmp" % os.getpid ()
+      with open (tmpf, 'w') as fd:
+        fd.write (key + "\n")
+        fd.flush ()
+        os.fsync (fd.fileno ())
+      os.replace (tmpf, path)
+    else:
+      self.read ()
+
+    self.fd     = open (path, 'a')
+    self.synced = time.monotonic ()
+
+  def read (self):
+    with open (self.path, 'r+') as fd:
+      lines = fd.read ().split ("\n")
+
+      if lines[0] != self.key:
+        raise ValueError ("journal: %s is for another sweep spec (key: %s, expected: %s)" % (
+                          self.path, lines[0], self.key))
+
+      if len(lines[-1]) > 0:
+        # the last line was not finished
+        ll.warning ("journal: dropping partial line in: %s" % self.path)
+        fd.truncate (sum (len(l) + 1 for l in lines[:-1]))
+
+      for l in lines[1:-1]:
+        t, r = l.split ()
+        self.done.add (int(t))
+        self.rows = int(r)
+
+    ll.info ("journal: {} finished tasks in: {}".format (len(self.done), self.path))
+
+  def record (self, task, rows):
+    """ mark task as finished, with rows in the sink """
+    self.done.add (task)
+    self.pending.append ((task, rows))
+
+  def due (self, interval):
+    return len(self.pending) > 0 and time.monotonic () - self.synced >= interval
+
+  def sync (self, sink):
+    """ sync sink, then write and sync the tasks recorded since the last sync """
+    self.synced = time.monotonic ()
+    if len(self.pending) == 0:
+      return
+
+    sink.sync ()
+
+    self.fd.write ("".join ("%d %d\n" % tr for tr in self.pending))
+    self.fd.flush ()
+    os.fsync (self.fd.fileno ())
+
+    self.rows    = self.pending[-1][1]
+    self.pending = []
+
+  def close (self):
+    if self.fd is not None:
+      self.fd.close ()
+      self.fd = None
+
+class SweepRun:
+  """
+  Run the tasks of a sweep spec that are not recorded as finished in the
+  journal (outdir/journal), appending results to outdir/results. The
+  points of every velocity model are run with a Sweep (in outdir/models/
+  MODEL). Finished tasks are synced to the journal every sync seconds.
+  """
+
+  def __init__ (self, spec, outdir, processes = None, storedir = None, sync = 1.):
+    self.spec       = spec
+    self.outdir     = os.path.abspath (outdir)
+    self.processes  = processes
+    self.storedir   = storedir
+    self.sync       = sync
+
+    self.results    = os.path.join (self.outdir, 'results')
+    self.journalf   = os.path.join (self.outdir, 'journal')
+
+    os.makedirs (self.outdir, exist_ok = True)
+
+  def run (self, restart = False):
+    """ run all unfinished tasks (all tasks if restart), returns the number run """
+    spec = self.spec
+    nb   = len(spec.backends)
+
+    journal = Journal (self.journalf, spec.key (), restart)
+    sink    = ResultSink (self.results, truncate = restart)
+
+    if sink.rows < journal.rows:
+      sink.close ()
+      raise RuntimeError ("sweepspec: %s has fewer rows (%d) than recorded in the journal (%d)" % (
+                          sink.binf, sink.rows, journal.rows))
+
+    sink.truncate (journal.rows)
+
+    total = spec.tasks ()
+    n     = 0
+    ll.info ("sweepspec: {} of {} tasks finished".format (len(journal.done), total))
+
+    try:
+      for m in spec.models:
+        # points of this model with any unfinished backend
+        points = [p for p in spec.points (m)
+                  if any ((p * nb + b) not in journal.done for b in range (nb))]
+        if len(points) == 0:
+          continue
+
+        ll.info ("sweepspec: model: {}: {} points".format (m, len(points)))
+        sw = Sweep (os.path.join (self.outdir, 'models', m), spec.phasef, spec.reference,
+                    spec.velocities[m], processes = self.processes,
+                    backends = spec.backends, storedir = self.storedir)
+
+        for p, r in sw.imap ([spec.geometry (p) for p in points], points):
+          for b, backend in enumerate(spec.backends):
+            t = p * nb + b
+            if t in journal.done:
+              continue
+
+            sink.append (backend, r[backend])
+            journal.record (t, sink.rows)
+            n += 1
+
+          if journal.due (self.sync):
+            journal.sync (sink)
+            ll.info ("sweepspec: {} of {} tasks finished".format (len(journal.done), total))
+
+    finally:
+      journal.sync (sink)
+      journal.close ()
+      sink.close ()
+
+    ll.info ("sweepspec: {} tasks run, {} of {} finished".format (n, len(journal.done), total))
+    return n
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser (description = "Run a sweep specification, resuming an interrupted sweep.")
+
+  parser.add_argument ('spec',
+      help = 'Sweep specification (JSON).')
+  parser.add_argument ('-o', '--out', default = os.path.join ('out', 'sweep'),
+      help = 'Output directory for results, journal and scratch files (default: out/sweep).')
+  parser.add_argument ('-p', '--processes', default = None, type = int,
+      help = 'Number of worker processes (default: number of cores).')
+  parser.add_argument ('-m', '--model-store', default = None,
+      help = 'Directory for compiled TauP models (default: %s).' % ModelStore.default_storedir)
+  parser.add_argument ('--restart', action = 'store_true',
+      help = 'Discard results and journal of an earlier run and start over.')
+
+  args = parser.parse_args ()
+
+  ll.basicConfig (level = ll.INFO, format = "[%(levelname)-5.5s] %(message)s")
+
+  r = SweepRun (SweepSpec.load (args.spec), args.out, args.processes, args.model_store)
+  r.run (args.restart)
+
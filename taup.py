@@ -7,78 +7,372 @@
 
 
 import os, sys
+import time
 import numpy as np
 import scipy as sc
 
 import logging as ll
 
-from subprocess import check_call, check_output
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+
+from runner import Child, run, run_async, reap
+from results import Results
+
+import tracing
 
 class TauP:
-  times = None
+  times     = None
+  geometry  = None
+  seen      = {}
+
+  # in interactive mode taup_time asks for a new distance before
+  # every calculation, the output for one distance is therefore
+  # always preceded by this prompt.
+  prompt = 'Enter Distance'
+
+  # radius of earth used by taup_time to convert -km to degrees
+  radius = 6371.0
+
+  # content hash of the model linked from the store
+  model_key = None
 
-  def __init__ (self, outdir, geometry, phasef, regen_velocity = True):
+  def __init__ (self, outdir, geometry, phasef, regen_velocity = True, batch = True, worker = None, store = None):
     """
     Set up everything needed for running taup_time,
     file names are relative to outdir.
+
+    if batch is True travel times for all stations are calculated
+    with a single taup_time process. if a TauPWorker is given it
+    is used instead of starting new processes.
+
+    if a ModelStore is given the compiled model is taken from the
+    store, and regen_velocity is ignored.
     """
     ll.info ("== setting up TauP")
 
     self.outdir     = outdir
     self.phasef     = phasef
+    self.batch      = batch
+    self.worker     = worker
+    self.store      = store
     self.set_geometry (geometry, regen_velocity)
 
   def set_geometry (self, geometry, regen_velocity = True):
+    # parts of the geometry that changed since last time, everything
+    # for a new geometry.
+    stale = geometry.stale (self.seen) if geometry is self.geometry else set (geometry.parts)
+
     self.geometry   = geometry
+    self.seen       = geometry.revisions ()
     self.velocity   = geometry.velocities
     self.velf       = os.path.join (self.outdir, "taup_regional.nd")
     self.stations   = geometry.stations
     self.earthquake = geometry.earthquake
 
-    if regen_velocity:
+    if self.store is not None:
+      # only re-link if the velocity model changed
+      if 'velocity' in stale:
+        self.link_velocity_model ()
+    elif regen_velocity:
       self.create_velocity_model ()
 
+  def velocity_model (self):
+    """ the velocity model in TauP .nd format """
+    return self.nd (self.velocity)
+
+  @staticmethod
+  def nd (velocity):
+    """ velocity model (as in Geometry) in TauP .nd format """
+    nd = ""
+    for v in velocity:
+      # same precision as the HYPOMOD model, so that small changes to the
+      # velocities are not lost.
+      nd += "%.3f %.3f %.3f\n" % (v[0], v[1], v[2])
+      if v[3] == "seafloor":
+        nd += "seafloor\n"
+      elif v[3] == "MOHO":
+        nd += "mantle\n"
+
+    return nd
+
+  def link_velocity_model (self):
+    """ link the compiled model for the current velocity model from the store """
+    with tracing.span ('taup.link_model'):
+      key = self.store.link (self.velocity_model (), self.outdir,
+                             os.path.basename(self.velf).replace (".nd", ""))
+    self.model_key = key
+
+    # the worker runs in the store directory of the model, and is
+    # restarted if the model changed.
+    if self.worker is not None:
+      self.worker.set_outdir (self.store.path (key))
+
   def create_velocity_model (self):
     ll.info ("=> generate velocity model for TauP..: taup_regional.nd")
 
     with open (self.velf, 'w') as fd:
-      for v in self.velocity:
-        fd.write ("%1.1f %1.1f %1.1f\n" % (v[0], v[1], v[2]))
-        if v[3] == "seafloor":
-          fd.write ("seafloor\n")
-        elif v[3] == "MOHO":
-          fd.write ("mantle\n")
+      fd.write (self.velocity_model ())
 
     # generate taup model
-    check_output ("taup_create -nd taup_regional.nd", cwd = self.outdir, shell = True)
+    with tracing.span ('taup_create'):
+      run (['taup_create', '-nd', 'taup_regional.nd'], self.outdir)
+
+    # the worker has the old model loaded
+    if self.worker is not None:
+      self.worker.stop ()
 
   def calculate_times (self):
+    with tracing.span ('taup.calculate_times', stations = len(self.stations)):
+      if self.worker is not None or self.batch:
+        return self.calculate_times_batch ()
+
+      self.times = []
+      for s,d in zip(self.stations, self.geometry.distances):
+        for ph in self.calculate_time (s, d):
+          self.times.append (ph)
+
+      return self.times
+
+  def calculate_times_batch (self):
+    """
+    calculate travel times for all stations in one go, using the
+    persistent worker if available.
+    """
+    ll.info ("taup: calculating travel times for: {} stations (batched)".format(len(self.stations)))
+
+    if self.worker is None:
+      # parsed while taup_time is running
+      with tracing.span ('taup_time (streamed)', stations = len(self.stations)):
+        self.times = list(self.stream_times ())
+      return self.times
+
+    with tracing.span ('taup_time', stations = len(self.stations)):
+      blocks = self.calculate (-self.earthquake[2],
+                               [self.km2deg (d) for d in self.geometry.distances])
+
     self.times = []
-    for s,d in zip(self.stations, self.geometry.distances):
-      for ph in self.calculate_time (s, d):
-        self.times.append (ph)
+    with tracing.span ('taup.parse'):
+      for s, b in zip(self.stations, blocks):
+        with tracing.span ('taup.parse_station', station = s[0]):
+          for ph in self.parse_arrivals (b, s):
+            self.times.append (ph)
 
     return self.times
 
+  async def calculate_times_async (self, timeout = None):
+    """
+    calculate travel times for all stations with one batched taup_time
+    process run as an asyncio subprocess (the worker is not used).
+    """
+    ll.info ("taup: calculating travel times for: {} stations (async)".format(len(self.stations)))
 
-  def calculate_time (self, station, dist):
-    ll.info ("taup: calculating travel times for: {}".format(station[0]))
+    with tracing.span ('taup.calculate_times', stations = len(self.stations)):
+      distances = [self.km2deg (d) for d in self.geometry.distances]
+      cmd, inp  = self.batch_command (-self.earthquake[2], distances)
 
+      with tracing.span ('taup_time', stations = len(self.stations)):
+        out    = await run_async (cmd, self.outdir, inp, timeout)
+        blocks = self.split_batch (out.decode ('ascii'), len(distances))
 
-    cmd = "taup_time -mod {vel} -h {depth} -km {dist:.3f} -pf {pf}".format (
-           vel = os.path.basename(self.velf).replace (".nd", ""), depth = -self.earthquake[2],
-           dist = dist, pf = self.phasef)
+      self.times = []
+      with tracing.span ('taup.parse'):
+        for s, b in zip(self.stations, blocks):
+          with tracing.span ('taup.parse_station', station = s[0]):
+            for ph in self.parse_arrivals (b, s):
+              self.times.append (ph)
 
-    #print (cmd)
+      return self.times
+
+  def stream_times (self):
+    """
+    generator of arrivals ([station, phase, time, distance] as in
+    calculate_times) for all stations, parsed from the output of
+    taup_time as it is read.
+
+    without a worker a single batched taup_time is run (or one for each
+    station if batch is False), with a worker the arrivals are yielded
+    after each distance.
+    """
+    depth     = -self.earthquake[2]
+    distances = [self.km2deg (d) for d in self.geometry.distances]
 
-    out = check_output (cmd, cwd = self.outdir, shell = True)
-    out = out.decode ('ascii')
+    if self.worker is not None:
+      for s, d in zip (self.stations, distances):
+        for ph in self.parse_arrivals (self.worker.calculate (depth, [d])[0], s):
+          yield ph
 
-    out = out.splitlines ()
-    out = out[5:]
+    elif self.batch:
+      cmd, inp = self.batch_command (depth, distances)
+      yield from self.parse_stream (Child (cmd, self.outdir, inp).lines (), self.stations, True)
 
+    else:
+      for s, d in zip (self.stations, self.geometry.distances):
+        yield from self.parse_stream (Child (self.time_command (d), self.outdir).lines (), [s])
+
+  def parse_stream (self, lines, stations, prompts = False):
+    """
+    parse arrivals from an iterator over output lines of taup_time.
+
+    if prompts is True the lines are the output of a batched run, where
+    the output for each distance (and station in stations) follows a
+    prompt. otherwise all lines are for stations[0].
+
+    raises ValueError with the line number and line if a line can not be
+    parsed. lines is closed when done.
+    """
+    try:
+      for p in self.parse_lines (lines, stations, prompts):
+        yield p
+    finally:
+      if hasattr (lines, 'close'):
+        lines.close ()
+
+  def parse_lines (self, lines, stations, prompts):
+    i = -1 if prompts else 0
+    header = True
+    for n, l in enumerate(lines, 1):
+      if prompts and l.startswith (self.prompt):
+        i += 1
+        header = True
+
+        # anything after the prompt belongs to the next distance
+        l = l[l.find (':', len(self.prompt)) + 1:]
+
+      if i < 0 or i >= len(stations):
+        continue
+
+      if header:
+        header = not l.strip().startswith ('---')
+        continue
+
+      if len(l.strip()) > 0:
+        try:
+          p = self.parse_phase (l)
+        except (IndexError, ValueError):
+          raise ValueError ("taup: could not parse line %d of taup_time output: %r" % (n, l.rstrip ()))
+
+        p.insert (0, stations[i][0])
+        yield p
+
+    if prompts and i < len(stations) - 1:
+      raise RuntimeError ("taup: expected output for {} distances, got {}".format (len(stations), i + 1))
+
+  def results (self, event = 0):
+    """ travel times of the last calculation as Results """
+    station, phase, time, _dist = self.columns (self.times)
+    return Results.from_columns ([s[0] for s in self.stations], self.geometry.distances,
+                                 station, phase, time, event)
+
+  @staticmethod
+  def columns (times):
+    """ arrays of station, phase, time (s) and distance (degrees) of arrivals """
+    if len(times) == 0:
+      return np.array ([], dtype = str), np.array ([], dtype = str), np.zeros (0), np.zeros (0)
+
+    s, p, t, d = zip (*times)
+    return (np.array (s), np.array (p), np.array (t, dtype = np.float64),
+            np.array (d, dtype = np.float64))
+
+  def calculate (self, depth, distances):
+    """
+    calculate travel times from a source at depth (km) to a list of
+    distances (degrees), returns the output lines for each distance.
+    """
+    if self.worker is not None:
+      return self.worker.calculate (depth, distances)
+    else:
+      return self.run_batch (depth, distances)
+
+  def run_batch (self, depth, distances):
+    """
+    run one taup_time process for all distances: taup_time is started in
+    interactive mode with the source depth set, and the distances are
+    written to stdin. the output is split on the distance prompt, giving
+    one block per distance.
+    """
+    cmd, inp = self.batch_command (depth, distances)
+
+    out = run (cmd, self.outdir, inp)
+    return self.split_batch (out.decode ('ascii'), len(distances))
+
+  def batch_command (self, depth, distances):
+    """ arguments and stdin for a batched taup_time run """
+    cmd = ['taup_time', '-mod', os.path.basename(self.velf).replace (".nd", ""),
+           '-h', repr(float(depth)), '-pf', self.phasef]
+
+    inp = "".join ("{!r}\n".format (float(d)) for d in distances)
+    inp += "q\n"
+
+    return cmd, inp.encode ('ascii')
+
+  def split_batch (self, out, n):
+    """ split output of a batched run into lines for each of n distances """
+
+    # first block is the output before the first prompt, the last one
+    # is the prompt answered with 'q'.
+    blocks = out.split (self.prompt)[1:]
+    if len(blocks) < n:
+      raise RuntimeError ("taup: expected output for {} distances, got {}".format (n, len(blocks)))
+
+    return [b.splitlines () for b in blocks[:n]]
+
+  def traveltimes (self, dist, depth, phases):
+    """
+    travel times of the first arrival of each phase for arrays of
+    epicentral distance and source depth (km). one batch is run for
+    every distinct depth.
+
+    returns an array of shape (len(phases),) + shape of dist and depth,
+    missing arrivals are nan.
+    """
+    dist, depth = np.broadcast_arrays (np.asarray (dist, dtype = np.float64),
+                                       np.asarray (depth, dtype = np.float64))
+    x = dist.ravel ()
+    z = depth.ravel ()
+
+    t = np.full ((len(phases), len(x)), np.nan)
+    for h in np.unique (z):
+      i = np.flatnonzero (z == h)
+      blocks = self.calculate (h, [self.km2deg (d) for d in x[i]])
+      for j, b in zip (i, blocks):
+        for _s, name, tt, _d in self.parse_arrivals (b, [None]):
+          if name in phases:
+            k = phases.index (name)
+            if np.isnan (t[k, j]):
+              t[k, j] = tt
+
+    return t.reshape ((len(phases),) + dist.shape)
+
+  def km2deg (self, dist):
+    """ convert epicentral distance in km to degrees the way taup_time -km does """
+    return dist / self.radius * 180.0 / np.pi
+
+
+  def calculate_time (self, station, dist):
+    ll.info ("taup: calculating travel times for: {}".format(station[0]))
+
+
+    with tracing.span ('taup_time (streamed)', station = station[0]):
+      return list(self.parse_stream (Child (self.time_command (dist), self.outdir).lines (), [station]))
+
+  def time_command (self, dist):
+    """ arguments for a taup_time run for a single distance (km) """
+    return ['taup_time', '-mod', os.path.basename(self.velf).replace (".nd", ""),
+            '-h', "{}".format (-self.earthquake[2]), '-km', "{:.3f}".format (dist),
+            '-pf', self.phasef]
+
+  def parse_arrivals (self, lines, station):
+    """
+    parse the output of one calculation: arrivals follow the
+    header which ends with a line of dashes.
+    """
     ph = []
-    for l in out:
+    header = True
+    for l in lines:
+      if header:
+        header = not l.strip().startswith ('---')
+        continue
+
       if len(l.strip()) > 0:
         p = self.parse_phase (l)
         p.insert (0, station[0])
@@ -88,19 +382,119 @@ class TauP:
 
   def parse_phase (self, ph):
     """
-    parse a phase line
+    parse a phase line: returns name, travel time (s) and distance
+    (degrees)
     """
 
     l = ph.split ()
-    dist = l[0] # in degrees
+    dist = float(l[0]) # in degrees
     name = l[2]
-    time = l[3]
+    tt   = float(l[3])
+
+    return [name, tt, dist]
+
+class TauPWorker:
+  """
+  A long lived taup_time process in interactive mode. Distances and
+  source depths are written to stdin and the output is read back from
+  stdout up to the next prompt, so the JVM and the model is only loaded
+  once. The process is started on demand and restarted if it dies.
+  """
+
+  prompt = TauP.prompt.encode ('ascii')
+
+  def __init__ (self, outdir, phasef, model = 'taup_regional'):
+    self.outdir = outdir
+    self.phasef = phasef
+    self.model  = model
+    self.proc   = None
+    self.depth  = None
+
+  def set_outdir (self, outdir):
+    """ run in another directory (model), restarts the worker if changed """
+    if outdir != self.outdir:
+      self.stop ()
+      self.outdir = outdir
+
+  def start (self, depth):
+    ll.info ("taup: starting worker (model: %s).." % self.model)
+    cmd = ['taup_time', '-mod', self.model, '-h', repr(float(depth)), '-pf', self.phasef]
+    with tracing.span ('taup_time.start'):
+      self.t0   = time.perf_counter ()
+      self.proc = Popen (cmd, cwd = self.outdir, stdin = PIPE, stdout = PIPE,
+                         stderr = DEVNULL, bufsize = 0)
+      self.depth = depth
+      self.read ()
+
+  def stop (self, timeout = 5.):
+    if self.proc is None:
+      return
+
+    ll.debug ("taup: stopping worker..")
+    try:
+      self.proc.stdin.write (b"q\n")
+      self.proc.stdin.close ()
+      reap (self.proc, 'taup_time (worker)', self.t0, timeout)
+    except (OSError, TimeoutExpired):
+      self.proc.kill ()
+      reap (self.proc, 'taup_time (worker)', self.t0)
+
+    self.proc.stdout.close ()
+    self.proc  = None
+    self.depth = None
+
+  close = stop
+
+  def alive (self):
+    return self.proc is not None and self.proc.poll () is None
+
+  def read (self):
+    """
+    read output until the next distance prompt, returns the lines
+    written before the prompt.
+    """
+    buf = b''
+    fd  = self.proc.stdout.fileno ()
+    while True:
+      i = buf.find (self.prompt)
+      if i >= 0 and buf.find (b':', i) >= 0:
+        return buf[:i].decode ('ascii').splitlines ()
 
-    #print (time)
+      c = os.read (fd, 65536)
+      if len(c) == 0:
+        raise EOFError ("taup: worker exited")
 
-    return [name, time, dist]
+      buf += c
 
+  def request (self, depth, dist):
+    if not self.alive ():
+      self.stop ()
+      self.start (depth)
 
+    if depth != self.depth:
+      self.proc.stdin.write ("h\n{!r}\n".format (float(depth)).encode ('ascii'))
+      self.read ()
+      self.depth = depth
 
+    self.proc.stdin.write ("{!r}\n".format (float(dist)).encode ('ascii'))
+    return self.read ()
 
+  def calculate (self, depth, distances):
+    """
+    calculate travel times for a source at depth (km) to all distances
+    (degrees), returns the output lines for each distance.
+    """
+    out = []
+    for d in distances:
+      try:
+        out.append (self.request (depth, d))
+      except (OSError, EOFError):
+        ll.warning ("taup: worker died, restarting..")
+        self.stop ()
+        out.append (self.request (depth, d))
+
+    return out
+
+  def __del__ (self):
+    self.stop ()
 
@@ -0,0 +1,58 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test joining and binning of backend comparisons.
+
+import os, sys
+import logging as ll
+
+import numpy as np
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+from results import *
+from compare import *
+
+ll.basicConfig (level = ll.INFO)
+
+ll.info ('**=> bins are counted as by np.histogram, including the last edge')
+rs    = np.random.RandomState (0)
+edges = np.arange (0., 101., 25.)
+x     = np.concatenate ([rs.uniform (-10., 110., 1000), edges, [-1e-9, 100. + 1e-9]])
+g     = bin_index (x, edges)
+
+h, _e = np.histogram (x, edges)
+assert np.array_equal (np.bincount (g[g >= 0], minlength = len(edges) - 1), h)
+assert g[x == 100.][0] == len(edges) - 2
+assert g[x == 0.][0] == 0
+assert np.all (g[(x < 0.) | (x > 100.)] == -1)
+
+ll.info ('**=> join and group by distance')
+stations  = ['S%02d' % i for i in range (5)]
+distances = [0., 25., 50., 75., 100.]
+
+a = Results.from_rows ([[s, p, 1. + i + (p == 's'), 0.] for i, s in enumerate(stations) for p in ['p', 's']],
+                       stations, distances)
+# b has an extra phase, a later arrival of p and is missing station S01
+b = Results.from_rows ([[s, q, 1. + i + (q == 'S') - .1, 0.] for i, s in enumerate(stations)
+                        if s != 'S01' for q in ['P', 'S', 'Pn']] + [['S00', 'P', 5., 0.]],
+                       stations, distances)
+
+c = Comparison (a, b, { 'p' : 'P', 's' : 'S' })
+assert len(c) == 8
+np.testing.assert_allclose (c.residual, .1)
+
+st = c.stats (by = 'distance', bins = np.arange (0., distances[-1] + 25., 25.))
+n  = { d['group'] : d['n'] for d in st }
+assert sum (n.values ()) == len(c), n
+assert n[(75., 100.)] == 4, n
+assert (25., 50.) not in n, n
+
+st = c.stats (by = 'phase')
+assert [d['group'] for d in st] == ['p', 's']
+assert [d['n'] for d in st] == [4, 4]
+
+ll.info ('**=> done.')
@@ -0,0 +1,110 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test that changes to a geometry only mark the changed parts stale, and
+# that HYPOMOD only rewrites the input files depending on them.
+
+import os, sys
+import shutil
+import tempfile
+import logging as ll
+
+import numpy as np
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+from geometry import *
+from hypomod  import *
+
+import tracing
+
+ll.basicConfig (level = ll.INFO)
+
+stations   = [['GAK2', 10., 0., 0.], ['GAK3', 0., 15., 0.], ['GAK4', -50., -5., 0.]]
+velocities = [[0., 5., 3., 'surface'], [20., 6., 3.5, 'MOHO'], [20., 8., 4.5, ''], [80., 8., 4.5, '']]
+
+def written (f):
+  """ run f (), returns the HYPOMOD input files written """
+  tracing.start ()
+  f ()
+  return sorted (e['args']['file'] for e in tracing.stop () if e['name'] == 'hypomod.write')
+
+def changed (a, b):
+  """ files with different keys """
+  return sorted (f for f in a if a[f] != b[f])
+
+g = Geometry ([1., 0.], stations, [0., 0., -5.], velocities)
+
+ll.info ('**=> a new geometry is stale in all parts')
+assert g.stale ({}) == set (Geometry.parts)
+seen = g.revisions ()
+assert g.stale (seen) == set ()
+
+other = Geometry ([1., 0.], stations, [0., 0., -5.], velocities)
+assert g.stale (other.revisions ()) == set (Geometry.parts)
+
+d = tempfile.mkdtemp (prefix = 'geometry_stale-')
+h = Hypomod (d, g)
+assert sorted (h.written) == sorted (Hypomod.files)
+assert written (lambda: h.set_geometry (g)) == []
+
+ll.info ('**=> moving a station only changes the stations')
+keys = Hypomod.file_keys (g)
+g.move_station ('GAK3', 3., 15.)
+assert g.stale (seen) == set (['stations'])
+assert changed (keys, Hypomod.file_keys (g)) == ['stations.dat']
+assert written (lambda: h.set_geometry (g)) == ['stations.dat']
+seen = g.revisions ()
+
+# the same as a geometry set up with the station there
+moved = [list (s) for s in stations]
+moved[1][1] = 3.
+m = Geometry ([1., 0.], moved, [0., 0., -5.], velocities)
+assert np.allclose (g.distances, m.distances)
+assert np.allclose (g.sta['lon'], m.sta['lon']) and np.allclose (g.sta['lat'], m.sta['lat'])
+
+ll.info ('**=> moving the earthquake only changes the earthquake')
+keys = Hypomod.file_keys (g)
+g.move_earthquake (0., 0., -8.)
+assert g.stale (seen) == set (['earthquake'])
+assert changed (keys, Hypomod.file_keys (g)) == ['hyposat-parameter']
+assert written (lambda: h.set_geometry (g)) == ['hyposat-parameter']
+seen = g.revisions ()
+
+keys = Hypomod.file_keys (g)
+g.move_earthquake (2., -1., -8.)
+assert g.stale (seen) == set (['earthquake'])
+assert changed (keys, Hypomod.file_keys (g)) == ['hyposat-parameter']
+assert written (lambda: h.set_geometry (g)) == ['hyposat-parameter']
+seen = g.revisions ()
+
+m = Geometry ([1., 0.], moved, [2., -1., -8.], velocities)
+assert np.allclose (g.distances, m.distances)
+
+ll.info ('**=> setting the velocities only changes the velocity model')
+faster = [[v[0], v[1] * 1.1, v[2] * 1.1, v[3]] for v in velocities]
+keys = Hypomod.file_keys (g)
+g.set_velocities (faster)
+assert g.stale (seen) == set (['velocity'])
+assert changed (keys, Hypomod.file_keys (g)) == ['regional.vmod']
+assert written (lambda: h.set_geometry (g)) == ['regional.vmod']
+seen = g.revisions ()
+
+ll.info ('**=> files are not rewritten when a stale part has the same inputs')
+g.set_velocities ([list (v) for v in faster])
+assert g.stale (seen) == set (['velocity'])
+assert written (lambda: h.set_geometry (g)) == []
+
+g.move_station ('GAK3', 3., 15.)
+assert written (lambda: h.set_geometry (g)) == []
+
+ll.info ('**=> a new geometry only rewrites the files that differ')
+n = Geometry ([1., 0.], moved, [2., -1., -8.], velocities)
+assert written (lambda: h.set_geometry (n)) == ['regional.vmod']
+
+shutil.rmtree (d)
+
+ll.info ('**=> only the changed parts of the geometry are stale')
@@ -9,6 +9,7 @@
 ## TauP.
 
 import os, sys
+import shutil
 import logging as ll
 
 import numpy as np
@@ -26,7 +27,13 @@ from hyp_alg_comp   import *
 from taup           import *
 from hypomod        import *
 from ttlayer        import *
+from layered        import *
 from geometry       import *
+from sweep          import *
+from sweepspec      import *
+from results        import *
+from sink           import *
+from compare        import *
 
 phasef      = 'phases.dat'         # only used by TauP
 velf        = 'vel.csv'
@@ -35,71 +42,65 @@ geometryf   = 'geometry_setup.job' # only used for initial setup
 # set up HyComp
 hyc = HyComp ('out', geometryf, velf, phasef)
 
-## set up range to test
-s0 = 0.0   # km, start
-s1 = 100.1 # km, stop
-ds = 5.0  # km, delta
+## sweep over distances, see sweep.json
+spec = SweepSpec.load ('sweep.json')
 
-direction = np.array([0., -1.0]) # to move station
+# a single azimuth and depth: the station is moved along direction from
+# the epicenter.
+az        = np.radians (spec.azimuths[0])
+direction = np.array ([np.sin (az), np.cos (az)])
+eq        = np.array (spec.epicenter + [-spec.depths[0]])
+distances = spec.distances.tolist ()
 
-eq = np.array([10., 10., -80.])
+hyc.close ()
 
-reference   = hyc.geometry.reference
-velocities  = hyc.geometry.velocities
+## run all points in parallel, HYPOMOD is run once for all distances
+run = SweepRun (spec, os.path.join (hyc.outdir, 'sweep'))
+run.run (restart = True)
 
-distances = []
-ptimes    = []
-stimes    = []
+hypomod = Hypomod (hyc.outdir, hyc.geometry)
+hypomod.sweep (eq, distances, direction)
 
-first = True
+## results of all points, one event per point
+taup    = ResultSink.load (run.results, 'taup')
+layered = ResultSink.load (run.results, 'layered')
 
-for d in np.arange (s0, s1, ds):
-  ll.info ("compare: testing distance {}..".format (d))
+# every point has the single station STA, HYPOMOD has one station
+# (S0000, ..) per distance in the same order.
+hyp       = hypomod.results ()
+hyp_p     = hyp.first ([p for p in hyp.phases if p.startswith ('P')])
+hyp_s     = hyp.first ([p for p in hyp.phases if p.startswith ('S')])
 
-  sta = np.zeros((1,3))
-  sta[0,:2] = d * direction + eq[:2]
-  sta = sta.ravel()
-
-  # assert distance
-  dist = np.linalg.norm(eq[:2] - sta[:2])
-  np.testing.assert_equal (dist, d)
-  sta = [['STA', sta[0], sta[1], sta[2]]]
-  ll.debug (" => station: {}".format (sta))
-
-  ll.debug (" => setting up geometry..")
-  hyc.geometry.setup (reference, sta, eq, velocities)
-
-  hyc.calculate_ttimes (regen_velocity = first)
-  first = False
-
-  taup_times = hyc.taup_ttimes
-  hypomod_times = hyc.hypomod_ttimes
-
-  distances.append (d)
-
-  try:
-    pt = float(next(t[2] for t in taup_times if t[1] == 'p'))
-  except:
-    pt = np.nan
-
-  ptimes.append ([pt, hypomod_times[0][0][2]])
-
-  try:
-    st = float(next(t[2] for t in taup_times if t[1] == 's4.6p'))
-  except:
-    st = np.nan
-
-  stimes.append ([st, hypomod_times[0][1][2]])
+n         = len(spec)
+taup_p    = taup.first ('p', by = 'event', n = n)
+taup_s    = taup.first ('s4.6p', by = 'event', n = n)
+layered_p = layered.first ('P', by = 'event', n = n)
+layered_s = layered.first ('S', by = 'event', n = n)
 
 distances = np.array(distances)
-ptimes    = np.array(ptimes)
-stimes    = np.array(stimes)
+ptimes    = np.stack ([taup_p, hyp_p], 1)
+stimes    = np.stack ([taup_s, hyp_s], 1)
+ltimes    = np.stack ([layered_p, layered_s], 1)
 
 ttimes    = np.concatenate ([distances.reshape((len(distances),1)), ptimes, stimes], 1)
 
 print (distances)
 print (ptimes)
 print (stimes)
+print (ltimes)
+
+## the stub taup_time (stubs/) calculates its times with layered.py, so
+## the comparison would be of the layered model with itself. the layered
+## model is checked against analytic times in tests/layered_times.
+taup_time = shutil.which ('taup_time')
+if taup_time is not None and os.path.exists (os.path.join (
+    os.path.dirname (os.path.realpath (taup_time)), 'stub.py')):
+  ll.warning ("=> layered vs TauP: skipped, taup_time is a stub: %s" % taup_time)
+else:
+  ll.info ("=> layered vs TauP:")
+  cmp = Comparison (layered, taup, { 'P' : 'p', 'S' : 's4.6p' })
+  cmp.report (by = 'phase')
+  cmp.report (by = 'distance', bins = np.arange (0., distances[-1] + 25., 25.))
 
 ## plot travel times
 plt.figure ()
@@ -112,6 +113,9 @@ plt.plot (distances, ptimes[:,1], label = 'Hypomod (P)')
 plt.plot (distances, stimes[:,0], label = 'TauP (S)')
 plt.plot (distances, stimes[:,1], label = 'Hypomod (S)')
 
+plt.plot (distances, ltimes[:,0], '--', label = 'Layered (P)')
+plt.plot (distances, ltimes[:,1], '--', label = 'Layered (S)')
+
 plt.grid ()
 
 plt.xlabel ('Distance [km]')
@@ -0,0 +1,111 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test parsing of hypomod-out against the line by line parser it replaced.
+
+import os, sys
+import shutil
+import tempfile
+import logging as ll
+
+import numpy as np
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+from geometry import *
+from hypomod import *
+
+ll.basicConfig (level = ll.INFO)
+
+def old_parse_times (f, stations):
+  """ parse_times as it was before read_output """
+  stationlines = []
+  with open(f, 'r') as ofd:
+    start = False
+    for l in ofd.readlines ():
+      if 'Stat' in l:
+        start = True
+        continue
+
+      if start:
+        if 'Travel-time differences:' in l:
+          break
+        elif len(l.strip ()) > 0:
+          stationlines.append (l)
+
+  stationlines = [[k.strip() for k in l.split (' ') if len(k.strip()) > 0] for l in stationlines]
+
+  ttimes = []
+  for s in stations:
+    pht = []
+    for l in (ll for ll in stationlines if ll[0] == s[0]):
+      # station name, phase name, ttime
+      pht.append ([s[0], l[3], -float(l[8])])
+    ttimes.append (pht)
+
+  return ttimes
+
+def line (s, ph, delta, res):
+  return (" {:<5s} {:7.3f} {:6.2f} {:<8s} {:<6s} 00 00  0.000 {:8.3f} {:6.2f} -999.0 -999.0 -999.0 T__\n"
+          .format (s, delta, 45., ph, ph + 'g', res, 225.))
+
+def write_output (f, lines):
+  with open (f, 'w') as fd:
+    fd.write (" HYPOMOD\n\n Source: 0.136 1.135 depth: 5.00 km\n\n")
+    fd.write (" Stat  Delta   Azi   Phase   [used]    Onset time    Res    Baz     Res   Rayp   Res  Used\n")
+    for l in lines:
+      fd.write (l)
+    fd.write ("\n Travel-time differences:\n\n")
+    fd.write (" Stat  Phase 1  Phase 2    Diff\n")
+    fd.write (" GAK2  P        S           3.170\n")
+
+d = tempfile.mkdtemp (prefix = 'hypomod_output-')
+
+stations = [['GAK2', 10., 0., 0.], ['GAK3', 0., 15., 0.], ['GAK4', -5., -5., 0.]]
+g = Geometry ([1., 0.], stations, [0., 0., -5.],
+              [[0., 5., 3., 'surface'], [40., 5., 3., '']])
+h = Hypomod (d, g)
+f = os.path.join (d, 'hypomod-out')
+
+ll.info ('**=> single pass parser gives the same times as the old parser')
+rng   = np.random.default_rng (1)
+lines = []
+for s in ['GAK3', 'GAK2', 'XXX1', 'GAK3']:  # out of order, repeated and unknown stations
+  for ph in ['P', 'S', 'Pn']:
+    lines.append (line (s, ph, rng.uniform (0., 2.), -rng.uniform (0., 30.)))
+lines.insert (4, "\n")
+write_output (f, lines)
+
+assert h.parse_times () == old_parse_times (f, h.stations)
+assert h.malformed == []
+assert h.times[2] == []  # GAK4 has no lines
+
+out = h.read_output (f)
+assert len(out['time']) == 12
+assert out['index']['XXX1'] == [6, 7, 8]
+assert np.allclose (out['delta'], [float(l.split ()[1]) for l in lines if l.strip ()])
+
+r = h.results ()
+assert len(r) == 9  # the XXX1 lines are not among the stations
+
+ll.info ('**=> empty output gives no times')
+open (f, 'w').close ()
+assert h.parse_times () == old_parse_times (f, h.stations) == [[], [], []]
+
+ll.info ('**=> malformed lines are reported with their line numbers')
+lines = [line ('GAK2', 'P', 1., -5.),
+         " GAK2    0.191 224.98 S        Sn     00 00  0.000   -x.464\n",
+         line ('GAK3', 'P', 1., -6.),
+         " GAK4    0.063\n"]
+write_output (f, lines)
+
+t = h.parse_times ()
+assert h.malformed == [(7, lines[1].rstrip ()), (9, lines[3].rstrip ())]
+assert t == [[['GAK2', 'P', 5.]], [['GAK3', 'P', 6.]], []]
+
+shutil.rmtree (d)
+
+ll.info ('**=> hypomod-out parsed as before')
@@ -0,0 +1,73 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test the layered model against analytic travel times.
+
+import os, sys
+import logging as ll
+
+import numpy as np
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+from geometry import *
+from layered import *
+
+ll.basicConfig (level = ll.INFO)
+
+def model (velocity):
+  g = Geometry ([1., 0.], [['A', 10., 0., 0.]], [0., 0., -5.], velocity)
+  return Layered (g, ['P', 'S', 'Pg', 'Pn', 'PmP'])
+
+x = np.linspace (0., 200., 41)
+
+ll.info ('**=> uniform half space: direct wave is distance / velocity')
+l = model ([[0., 5., 3., 'surface'], [40., 5., 3., '']])
+for z in [0., 3., 17.]:
+  for w, v in [('P', 5.), ('S', 3.)]:
+    t = l.ttimes (x, z, w)
+    assert np.allclose (t['direct'], np.hypot (x, z) / v)
+    assert np.allclose (t['first'], t['direct'])
+    assert np.all (np.isinf (t['head']))
+
+ll.info ('**=> two layers: head wave and reflection off the interface')
+H, v1, v2 = 10., 6., 8.
+l = model ([[0., v1, 3.5, 'surface'], [H, v1, 3.5, 'MOHO'], [H, v2, 4.5, ''], [40., v2, 4.5, '']])
+for z in [0., 4., 9.]:
+  t  = l.ttimes (x, z, 'P')
+  ic = np.arcsin (v1 / v2)
+  xc = (2 * H - z) * np.tan (ic)
+  head = np.where (x >= xc, x / v2 + (2 * H - z) * np.cos (ic) / v1, np.inf)
+
+  assert np.allclose (t['direct'], np.hypot (x, z) / v1)
+  assert np.allclose (t['head'], head)
+  assert np.allclose (t['reflected'], np.hypot (x, 2 * H - z) / v1)
+  assert np.allclose (t['first'], np.minimum (t['direct'], head))
+
+  # the head wave overtakes the direct wave at the crossover distance
+  assert np.any (t['first'] < t['direct'])
+
+ll.info ('**=> source below the interface: refracted direct wave follows snell')
+z  = 25.
+ps = np.linspace (0., .999, 50) / v2   # ray parameters (s/km)
+c1 = np.sqrt (1. - (ps * v1)**2)
+c2 = np.sqrt (1. - (ps * v2)**2)
+xp = H * ps * v1 / c1 + (z - H) * ps * v2 / c2
+tp = H / (v1 * c1) + (z - H) / (v2 * c2)
+
+t = l.ttimes (xp, z, 'P')
+assert np.allclose (t['direct'], tp)
+assert np.all (np.isinf (t['head']))
+
+ll.info ('**=> traveltimes gives the same times by phase, nan where missing')
+tt = l.traveltimes (x, 4., ['P', 'Pg', 'Pn', 'PmP'])
+t  = l.ttimes (x, 4., 'P')
+assert np.allclose (tt[0], t['first'])
+assert np.allclose (tt[1], t['direct'])
+assert np.array_equal (np.isnan (tt[2]), np.isinf (t['head']))
+assert np.allclose (tt[3], t['reflected'])
+
+ll.info ('**=> layered times match analytic times')
@@ -0,0 +1,61 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test that the locator recovers synthetic events from exact picks.
+
+import os, sys
+import logging as ll
+
+import numpy as np
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+from geometry import *
+from layered import *
+from locator import *
+
+ll.basicConfig (level = ll.INFO)
+
+rs  = np.random.RandomState (4)
+v   = read_velocity ('../h_t_comp/vel.csv')
+sta = [['S%02d' % i, x, y, 0.] for i, (x, y) in enumerate (rs.uniform (-40., 40., (12, 2)))]
+g   = Geometry ([1., 0.], sta, [0., 0., -10.], v)
+
+l = Locator (g)
+b = l.bounds
+
+# events inside the grid and below the water layer
+E    = 50
+hypo = np.column_stack ([rs.uniform (b[0, 0], b[0, 1], E),
+                         rs.uniform (b[1, 0], b[1, 1], E),
+                         rs.uniform (5., 29., E)])
+t0   = rs.uniform (0., 100., E)
+
+ll.info ('**=> making synthetic picks with the layered backend')
+lay = Layered (g, ['P', 'S'])
+d   = np.hypot (g.sta['x'] - hypo[:, 0, None], g.sta['y'] - hypo[:, 1, None])
+t   = lay.traveltimes (d, np.repeat (hypo[:, 2, None], len(sta), axis = 1), ['P', 'S'])
+picks = np.moveaxis (t, 0, 1) + t0[:, None, None]
+
+ll.info ('**=> locating %d events' % E)
+loc = l.locate (picks)
+
+eh = np.hypot (loc['x'] - hypo[:, 0], loc['y'] - hypo[:, 1])
+ez = np.abs (loc['depth'] - hypo[:, 2])
+et = np.abs (loc['time'] - t0)
+
+ll.info ('**=> median error: %.3f km horizontal, %.3f km depth, %.3f s' %
+         (np.median (eh), np.median (ez), np.median (et)))
+
+good = (eh < .5) & (ez < 1.) & (et < .1)
+ll.info ('**=> recovered %d of %d events' % (good.sum (), E))
+
+assert np.median (eh) < .1
+assert np.median (ez) < .1
+assert np.median (et) < .01
+assert good.sum () >= E - 2
+
+ll.info ('**=> events are recovered within tolerance')
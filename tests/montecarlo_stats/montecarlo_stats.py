@@ -0,0 +1,71 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test the statistics of a small seeded Monte Carlo run of the layered
+# model against the stub HYPOMOD.
+
+import os, sys
+import shutil
+import tempfile
+import logging as ll
+
+import numpy as np
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+os.environ['PATH'] = os.path.abspath ('../../stubs') + os.pathsep + os.environ['PATH']
+
+from montecarlo import *
+
+ll.basicConfig (level = ll.INFO)
+
+d = tempfile.mkdtemp (prefix = 'montecarlo_stats-')
+
+stations   = [['GAK2', 10., 0., 0.], ['GAK3', 0., 15., 0.], ['GAK4', -50., -5., 0.]]
+velocities = [[0., 5., 3., 'surface'], [20., 6., 3.5, 'MOHO'], [20., 8., 4.5, ''], [80., 8., 4.5, '']]
+
+def montecarlo (**kw):
+  return MonteCarlo (d, '../../phases.dat', [1., 0.], stations, [0., 0., -5.], velocities,
+                     a = 'layered', b = 'hypomod', phases = { 'P' : 'P', 'S' : 'S' },
+                     bins = [0., 20., 100.], chunk = 2, processes = 2,
+                     storedir = os.path.join (d, 'store'), **kw)
+
+models, draws = 2, 3
+
+ll.info ('**=> every arrival is counted in its phase and distance bin')
+m = montecarlo (sigma_velocity = .05, seed = 1)
+s = m.run (models, draws)
+
+# GAK2 and GAK3 are closer than 20 km, GAK4 is further
+assert s.labels == [('P', (0., 20.)), ('P', (20., 100.)), ('S', (0., 20.)), ('S', (20., 100.))]
+assert s.n.tolist () == [2 * models * draws, models * draws] * 2
+for r in m.models:
+  assert r.n.tolist () == [2 * draws, draws] * 2
+
+assert np.all (np.isfinite (m.spread ()))
+assert np.all (m.spread () > 0)
+
+ll.info ('**=> runs with the same seed give the same statistics')
+m2 = montecarlo (sigma_velocity = .05, seed = 1)
+s2 = m2.run (models, draws)
+assert np.array_equal (s.n, s2.n)
+assert np.allclose (s.mean, s2.mean)
+assert np.allclose (s.m2, s2.m2)
+assert np.allclose (m.spread (), m2.spread ())
+
+ll.info ('**=> no spread between models with a single velocity model')
+m = montecarlo (sigma_velocity = 0., sigma_pick = 0., seed = 1)
+m.run (3, draws)
+assert np.allclose (m.spread (), 0.)
+
+# but there is pick noise within the models
+m = montecarlo (sigma_velocity = 0., sigma_pick = .05, seed = 1)
+s = m.run (3, draws)
+assert np.all (s.m2 > 0)
+
+shutil.rmtree (d)
+
+ll.info ('**=> monte carlo statistics counted by phase and distance bin')
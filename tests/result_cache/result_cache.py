@@ -0,0 +1,95 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test the on-disk result cache: round trip, keys, eviction and entries
+# removed by another process.
+
+import os, sys
+import pickle
+import tempfile
+import logging as ll
+
+import numpy as np
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+from cache import *
+
+ll.basicConfig (level = ll.INFO)
+
+d = tempfile.mkdtemp (prefix = 'result_cache_')
+c = ResultCache (d, max_entries = 10, max_bytes = 1024**2)
+
+ll.info ('**=> round trip')
+times = [['STA', 'P', 1.25, 0.1], ['STA', 'S', 2.5, 0.1]]
+k = c.key ('taup', ['taup_time', 1, 2], { 'depth' : 10., 'distances' : [0.1] })
+assert c.get (k) is None
+c.put (k, times)
+assert c.get (k) == times
+assert c.hits == 1 and c.misses == 1
+
+ll.info ('**=> keys depend on inputs, version and cache format')
+assert c.key ('taup', 1, { 'a' : 1, 'b' : 2 }) == c.key ('taup', 1, { 'b' : 2, 'a' : 1 })
+assert c.key ('taup', 1, { 'a' : 1 }) != c.key ('taup', 2, { 'a' : 1 })
+assert c.key ('taup', 1, { 'a' : 1 }) != c.key ('hypomod', 1, { 'a' : 1 })
+
+class NextFormat (ResultCache):
+  format_version = ResultCache.format_version + 1
+
+assert NextFormat (d).key ('taup', 1, { 'a' : 1 }) != c.key ('taup', 1, { 'a' : 1 })
+
+ll.info ('**=> eviction of least recently used entries')
+c.clear ()
+keys = [c.key ('taup', 1, i) for i in range (25)]
+for i, kk in enumerate(keys):
+  c.put (kk, i)
+  # distinct modification times for the recently used order
+  os.utime (c.path (kk), (i, i))
+
+  assert c.count <= c.max_entries
+  assert c.count == len(c.entries ())
+
+assert c.get (keys[-1]) == len(keys) - 1
+assert c.get (keys[0]) is None
+
+# overwriting an entry does not change the count
+n = c.count
+c.put (keys[-1], 'new')
+assert c.count == n and c.get (keys[-1]) == 'new'
+
+ll.info ('**=> entry removed by another process while reading is a miss')
+utime = os.utime
+def vanished (f, t):
+  os.remove (f)
+  utime (f, t)
+
+os.utime = vanished
+try:
+  m = c.misses
+  assert c.get (keys[-1]) is None
+  assert c.misses == m + 1
+finally:
+  os.utime = utime
+
+ll.info ('**=> failed write leaves no temporary file and keeps the count')
+n, size = c.count, c.size
+try:
+  c.put (c.key ('taup', 1, 'lambda'), lambda: 0)
+  assert False, "pickled a lambda"
+except (pickle.PicklingError, AttributeError):
+  pass
+
+assert c.count == n and c.size == size
+assert not any (f.endswith ('.tmp') for f in os.listdir (d))
+
+ll.info ('**=> reopening counts existing entries')
+c2 = ResultCache (d, max_entries = 10)
+assert c2.count == len(c2.entries ())
+assert c2.size  == sum (e[1] for e in c2.entries ())
+
+c.clear ()
+os.rmdir (d)
+ll.info ('**=> done.')
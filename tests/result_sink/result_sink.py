@@ -0,0 +1,85 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test the result sink: round trip of Results from several backends,
+# reopening for append, truncation and partial records.
+
+import os, sys
+import shutil
+import tempfile
+import logging as ll
+
+import numpy as np
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+from results import *
+from sink    import *
+
+ll.basicConfig (level = ll.INFO)
+
+d    = tempfile.mkdtemp (prefix = 'result_sink_')
+path = os.path.join (d, 'results')
+
+def same (a, b):
+  """ a and b have the same arrivals, by name """
+  assert len(a) == len(b), (len(a), len(b))
+  assert a.tolist () == b.tolist (), (a.tolist (), b.tolist ())
+  assert np.array_equal (a.rows['event'], b.rows['event'])
+
+ta = Results.from_rows ([['STA', 'p', 1.5, 0.], ['STB', 'p', 2.5, 0.], ['STB', 's4.6p', 4.25, 0.]],
+                        ['STA', 'STB'], [10., 20.], event = 0)
+ha = Results.from_rows ([['STB', 'P', 2.4], ['STB', 'S', 4.1], ['STC', 'P', 3.]],
+                        ['STB', 'STC'], [20., 30.], event = 0)
+tb = Results.from_rows ([['STC', 'p', 3.25, 0.]], ['STC'], [30.], event = 1)
+
+ll.info ('**=> round trip')
+with ResultSink (path) as s:
+  s.append ('taup', ta)
+  s.append ('hypomod', ha)
+  assert s.rows == 6
+
+same (ResultSink.load (path, 'taup'), ta)
+same (ResultSink.load (path, 'hypomod'), ha)
+assert len(ResultSink.load (path, 'layered')) == 0
+assert len(ResultSink.load (path)) == 6
+
+ll.info ('**=> reopen and append, with new names')
+with ResultSink (path) as s:
+  assert s.rows == 6
+  s.append ('taup', tb)
+
+t = ResultSink.load (path, 'taup')
+same (t.select (event = 0), ta)
+same (t.select (event = 1), tb)
+same (ResultSink.load (path, 'hypomod'), ha)
+
+ll.info ('**=> truncate')
+with ResultSink (path) as s:
+  s.truncate (3)
+  assert s.rows == 3
+
+same (ResultSink.load (path, 'taup'), ta)
+assert len(ResultSink.load (path, 'hypomod')) == 0
+
+ll.info ('**=> partial record is dropped')
+with open (path + '.bin', 'ab') as fd:
+  fd.write (b'\0' * (sink_dtype.itemsize // 2))
+
+with ResultSink (path) as s:
+  assert s.rows == 3
+  s.append ('hypomod', ha)
+
+same (ResultSink.load (path, 'taup'), ta)
+same (ResultSink.load (path, 'hypomod'), ha)
+
+ll.info ('**=> truncate on open')
+with ResultSink (path, truncate = True) as s:
+  assert s.rows == 0
+assert len(ResultSink.load (path)) == 0
+
+shutil.rmtree (d)
+ll.info ('**=> done.')
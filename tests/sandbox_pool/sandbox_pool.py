@@ -0,0 +1,108 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test checking out, checking in and mapping over HYPOMOD sandboxes, with
+# the stub HYPOMOD.
+
+import os, sys
+import time
+import shutil
+import tempfile
+import threading
+import logging as ll
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+os.environ['PATH'] = os.path.abspath ('../../stubs') + os.pathsep + os.environ['PATH']
+
+from geometry import *
+from hypomod  import *
+from sandbox  import *
+
+import tracing
+
+ll.basicConfig (level = ll.INFO)
+
+stations   = [['GAK2', 10., 0., 0.], ['GAK3', 0., 15., 0.], ['GAK4', -50., -5., 0.]]
+velocities = [[0., 5., 3., 'surface'], [20., 6., 3.5, 'MOHO'], [20., 8., 4.5, ''], [80., 8., 4.5, '']]
+
+def geometry (stations = stations, earthquake = [0., 0., -5.], velocities = velocities):
+  return Geometry ([1., 0.], stations, earthquake, velocities)
+
+def written (f):
+  """ check out with f (), returns the sandbox and the files written """
+  tracing.start ()
+  h = f ()
+  return h, [e['args']['file'] for e in tracing.stop () if e['name'] == 'hypomod.write']
+
+g0 = geometry ()
+p  = SandboxPool (3, geometry = g0)
+a, b, c = p.free
+
+ll.info ('**=> checkout of the staged geometry writes nothing')
+h, w = written (lambda: p.checkout (geometry ()))
+assert h is a and w == []
+p.checkin (h)
+
+ll.info ('**=> only the files of the changed parts are written')
+moved = [list (s) for s in stations]
+moved[1][1] += 3.
+g1 = geometry (moved)
+
+h, w = written (lambda: p.checkout (g1))
+assert h is b and w == ['stations.dat']
+p.checkin (h)
+
+ll.info ('**=> the sandbox with the most files up to date is preferred')
+h, w = written (lambda: p.checkout (geometry (moved)))
+assert h is b and w == []
+
+# the others are staged for g0
+h2, w = written (lambda: p.checkout (geometry (earthquake = [0., 0., -8.])))
+assert h2 in [a, c] and w == ['hyposat-parameter']
+
+p.checkin (h)
+p.checkin (h2)
+
+ll.info ('**=> checkout waits for a checkin when all sandboxes are out')
+out = [p.checkout (g0) for i in range (3)]
+assert len(p.free) == 0
+
+try:
+  p.checkout (g0, timeout = .1)
+  assert False, "checkout without a free sandbox"
+except TimeoutError:
+  pass
+
+got = []
+t = threading.Thread (target = lambda: got.append (p.checkout (g0, timeout = 10.)))
+t.start ()
+time.sleep (.1)
+assert len(got) == 0
+p.checkin (out[0])
+t.join ()
+assert got == [out[0]]
+
+for h in out[1:] + got:
+  p.checkin (h)
+assert sorted (map (id, p.free)) == sorted (map (id, [a, b, c]))
+
+ll.info ('**=> map gives the times of every geometry in order')
+gs = [geometry (earthquake = [0., 0., -z]) for z in [2., 5., 8., 11., 14.]]
+times = p.map (gs)
+
+d = tempfile.mkdtemp (prefix = 'sandbox_pool-')
+for g, tt in zip (gs, times):
+  assert tt == Hypomod (d, g).calculate_times ()
+
+assert times[0] != times[-1]
+assert len(p.free) == 3
+
+p.close ()
+assert not os.path.exists (p.root)
+shutil.rmtree (d)
+
+ll.info ('**=> sandboxes checked out, reused and mapped')
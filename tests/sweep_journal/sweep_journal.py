@@ -0,0 +1,111 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test the sweep journal and resuming an interrupted sweep.
+
+import os, sys
+import shutil
+import tempfile
+import logging as ll
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+from sweepspec import *
+
+ll.basicConfig (level = ll.INFO)
+
+def rows (results):
+  """ rows with names, sorted, sweeps finish points in any order """
+  return sorted ((int(r['event']), int(r['backend']), results.stations[r['station']],
+                  results.phases[r['phase']], float(r['time']), float(r['distance']))
+                 for r in results.rows)
+
+d = tempfile.mkdtemp (prefix = 'sweep_journal-')
+
+ll.info ('**=> journal records synced tasks and rows')
+jf = os.path.join (d, 'journal')
+s  = ResultSink (os.path.join (d, 'results'))
+j  = Journal (jf, 'key-1')
+j.record (0, 3)
+j.record (1, 6)
+assert j.due (0.)
+j.sync (s)
+assert not j.due (0.)
+j.record (2, 9)   # not synced
+j.close ()
+s.close ()
+
+j = Journal (jf, 'key-1')
+assert j.done == set ([0, 1])
+assert j.rows == 6
+j.close ()
+
+ll.info ('**=> partial last line is dropped')
+with open (jf, 'a') as fd:
+  fd.write ("2 9")
+
+j = Journal (jf, 'key-1')
+assert j.done == set ([0, 1])
+assert j.rows == 6
+j.close ()
+
+with open (jf, 'r') as fd:
+  assert fd.read () == "key-1\n0 3\n1 6\n"
+
+ll.info ('**=> journal of another spec is refused')
+try:
+  Journal (jf, 'key-2')
+  assert False, "opened journal with wrong key"
+except ValueError:
+  pass
+
+j = Journal (jf, 'key-2', restart = True)
+assert len(j.done) == 0 and j.rows == 0
+j.close ()
+
+ll.info ('**=> resumed sweep gives the same results as a clean sweep')
+spec = SweepSpec ({ 'reference' : [1.0, 0.0],
+                    'phases'    : 'phases.dat',
+                    'models'    : { 'gakkel' : 'vel.csv' },
+                    'epicenter' : [10.0, 10.0],
+                    'distance'  : { 'start' : 0.0, 'stop' : 50.1, 'step' : 10.0 },
+                    'azimuth'   : [0., 90.],
+                    'depth'     : [5.0, 10.0],
+                    'backends'  : ['layered'] }, root = '../h_t_comp')
+total = spec.tasks ()
+
+clean = os.path.join (d, 'clean')
+assert SweepRun (spec, clean, processes = 2).run () == total
+
+# interrupt: keep the first tasks in the journal and leave a partial line,
+# the sink has rows of tasks that were not recorded.
+resume = os.path.join (d, 'resume')
+assert SweepRun (spec, resume, processes = 2).run () == total
+
+rf = os.path.join (resume, 'journal')
+with open (rf, 'r') as fd:
+  lines = fd.read ().split ("\n")
+
+keep = 5
+with open (rf, 'w') as fd:
+  fd.write ("\n".join (lines[:keep + 1]) + "\n" + lines[keep + 1])
+
+assert SweepRun (spec, resume, processes = 2).run () == total - keep
+assert SweepRun (spec, resume, processes = 2).run () == 0
+
+a = ResultSink.load (os.path.join (clean, 'results'))
+b = ResultSink.load (os.path.join (resume, 'results'))
+assert len(a) > 0
+assert rows (a) == rows (b)
+
+ll.info ('**=> restart runs everything again')
+assert SweepRun (spec, resume, processes = 2).run (restart = True) == total
+b = ResultSink.load (os.path.join (resume, 'results'))
+assert rows (a) == rows (b)
+
+shutil.rmtree (d)
+
+ll.info ('**=> sweep journal ok')
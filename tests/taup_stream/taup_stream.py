@@ -0,0 +1,133 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Test parsing of streamed taup_time output and the taup_time worker, with
+# the stub taup_time and taup_create.
+
+import os, sys
+import shutil
+import random
+import tempfile
+import logging as ll
+
+sys.path.append (os.path.abspath('.'))
+sys.path.append (os.path.abspath('..'))
+sys.path.append (os.path.abspath('../..'))
+
+os.environ['PATH'] = os.path.abspath ('../../stubs') + os.pathsep + os.environ['PATH']
+
+from geometry   import *
+from taup       import *
+from modelstore import *
+from runner     import run
+
+ll.basicConfig (level = ll.INFO)
+
+d      = tempfile.mkdtemp (prefix = 'taup_stream-')
+phasef = os.path.abspath ('../../phases.dat')
+
+stations = [['GAK2', 10., 0., 0.], ['GAK3', 0., 15., 0.], ['GAK4', -50., -5., 0.]]
+g = Geometry ([1., 0.], stations, [0., 0., -5.],
+              [[0., 5., 3., 'surface'], [20., 6., 3.5, 'MOHO'], [20., 8., 4.5, ''], [80., 8., 4.5, '']])
+t = TauP (d, g, phasef, store = ModelStore (os.path.join (d, 'store')))
+
+depth     = -g.earthquake[2]
+distances = [t.km2deg (x) for x in g.distances]
+
+cmd, inp = t.batch_command (depth, distances)
+lines    = run (cmd, d, inp).decode ('ascii').splitlines (True)
+
+ll.info ('**=> streamed output is parsed as the batched output')
+times = list (t.parse_stream (iter (lines), t.stations, True))
+assert times == [p for s, b in zip (t.stations, t.split_batch ("".join (lines), len(distances)))
+                   for p in t.parse_arrivals (b, s)]
+assert set (p[0] for p in times) == set (s[0] for s in stations)
+
+ll.info ('**=> corrupt line is reported with its line number')
+# first arrival of the second distance
+n = [i for i, l in enumerate (lines) if l.strip ().startswith ('---')][1] + 2
+bad = list (lines)
+bad[n - 1] = bad[n - 1].replace ('.', ',', 1)
+try:
+  list (t.parse_stream (iter (bad), t.stations, True))
+  assert False, "corrupt line not detected"
+except ValueError as e:
+  assert ("line %d " % n) in str (e), e
+
+ll.info ('**=> too few prompts for the stations is an error')
+prompts = [i for i, l in enumerate (lines) if l.startswith (t.prompt)]
+try:
+  list (t.parse_stream (iter (lines[:prompts[2]]), t.stations, True))
+  assert False, "missing output not detected"
+except RuntimeError as e:
+  assert 'expected output for 3 distances, got 2' in str (e), e
+
+try:
+  t.split_batch ("".join (lines[:prompts[2]]), len(distances))
+  assert False, "missing output not detected"
+except RuntimeError as e:
+  assert 'expected output for 3 distances, got 2' in str (e), e
+
+# output for more distances than stations is ignored
+assert list (t.parse_stream (iter (lines), t.stations[:2], True)) == \
+       [p for p in times if p[0] != 'GAK4']
+
+def arrivals (blocks, stations = t.stations):
+  return [t.parse_arrivals (b, s) for s, b in zip (stations, blocks)]
+
+ll.info ('**=> worker gives the batched output, also after changing depth')
+w  = TauPWorker (t.store.path (t.model_key), phasef)
+bl = arrivals (t.split_batch ("".join (lines), len(distances)))
+assert arrivals (w.calculate (depth, distances)) == bl
+
+cmd, inp = t.batch_command (depth + 7., distances)
+bl7 = arrivals (t.split_batch (run (cmd, d, inp).decode ('ascii'), len(distances)))
+assert bl7 != bl
+assert arrivals (w.calculate (depth + 7., distances)) == bl7
+assert w.depth == depth + 7.
+assert arrivals (w.calculate (depth, distances[:1])) == bl[:1]
+
+ll.info ('**=> worker is restarted after it exited (EOF)')
+# a stub seed that starts, but fails the first request
+seed = 0
+while True:
+  r = random.Random (seed)
+  if r.random () >= .5 and r.random () < .5:
+    break
+  seed += 1
+
+def start_failing (w):
+  """ (re)start the worker with a stub that fails the first request """
+  w.stop ()
+  os.environ['HYP_STUB_TAUP_TIME_FAIL'] = '.5'
+  os.environ['HYP_STUB_TAUP_TIME_SEED'] = str (seed)
+  try:
+    w.start (depth)
+  finally:
+    del os.environ['HYP_STUB_TAUP_TIME_FAIL']
+    del os.environ['HYP_STUB_TAUP_TIME_SEED']
+
+start_failing (w)
+try:
+  w.request (depth, distances[0])
+  assert False, "worker did not fail"
+except EOFError:
+  pass
+
+# calculate restarts it
+start_failing (w)
+pid = w.proc.pid
+assert arrivals (w.calculate (depth, distances)) == bl
+assert w.alive () and w.proc.pid != pid
+
+ll.info ('**=> worker is restarted when it is not running')
+w.proc.kill ()
+w.proc.wait ()
+assert arrivals (w.calculate (depth, distances[1:]), t.stations[1:]) == bl[1:]
+assert w.alive ()
+
+w.stop ()
+shutil.rmtree (d)
+
+ll.info ('**=> taup_time output parsed and worker restarted')
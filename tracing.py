@@ -0,0 +1,114 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Lightweight tracing spans with Chrome trace export
+#
+## Usage:
+##
+##   import tracing
+##
+##   with tracing.span ('taup_time', station = 'GAK2'):
+##     ...
+##
+## Spans are only recorded after tracing.start (). tracing.save (f) writes
+## the recorded spans as a Chrome trace (JSON), which can be opened in
+## chrome://tracing or https://ui.perfetto.dev. Spans nest by time in
+## each thread, the keyword arguments are shown as arguments of the span.
+## Spans in an asyncio task get a row of their own, named after the task,
+## since the spans of concurrent tasks overlap in the same thread.
+
+import os, sys
+import json
+import time
+import asyncio
+import threading
+
+import logging as ll
+
+# recorded events, None when tracing is disabled
+events = None
+
+# rows of asyncio tasks: tid -> task name
+tasks = {}
+
+class NullSpan:
+  """ returned by span () when tracing is disabled """
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, *args):
+    return False
+
+null = NullSpan ()
+
+def tid ():
+  """ row of a span: the current asyncio task, or else the thread """
+  try:
+    t = asyncio.current_task ()
+  except RuntimeError:
+    t = None
+
+  if t is None:
+    return threading.get_ident ()
+
+  tasks[id(t)] = t.get_name ()
+  return id(t)
+
+class Span:
+  def __init__ (self, name, cat, args):
+    self.name = name
+    self.cat  = cat
+    self.args = args
+
+  def __enter__ (self):
+    self.t0 = time.perf_counter_ns ()
+    return self
+
+  def __exit__ (self, *args):
+    t1 = time.perf_counter_ns ()
+    if events is not None:
+      e = { 'name' : self.name, 'cat' : self.cat, 'ph' : 'X',
+            'ts'   : self.t0 / 1000., 'dur' : (t1 - self.t0) / 1000.,
+            'pid'  : os.getpid (), 'tid' : tid () }
+      if len(self.args) > 0:
+        e['args'] = self.args
+      events.append (e)
+    return False
+
+def span (name, cat = 'hyp', **args):
+  """ context manager timing a stage, a no-op unless tracing is started """
+  if events is None:
+    return null
+  return Span (name, cat, args)
+
+def enabled ():
+  return events is not None
+
+def start ():
+  """ start recording spans, earlier spans are dropped """
+  global events
+  events = []
+  tasks.clear ()
+
+def stop ():
+  """ stop recording, returns the recorded events """
+  global events
+  e, events = events, None
+  return e
+
+def save (f, e = None):
+  """ write events (default: recorded so far) as a Chrome trace to f """
+  if e is None:
+    e = events if events is not None else []
+
+  meta = [{ 'name' : 'process_name', 'ph' : 'M', 'pid' : os.getpid (),
+            'args' : { 'name' : os.path.basename (sys.argv[0]) or 'python' } }]
+  meta += [{ 'name' : 'thread_name', 'ph' : 'M', 'pid' : os.getpid (), 'tid' : t,
+             'args' : { 'name' : name } } for t, name in tasks.items ()]
+
+  with open (f, 'w') as fd:
+    json.dump ({ 'traceEvents' : meta + list(e), 'displayTimeUnit' : 'ms' }, fd)
+
+  ll.info ("tracing: {} spans written to: {}".format (len(e), f))
+
@@ -0,0 +1,166 @@
+#! /usr/bin/python
+#
+# author: Gaute Hope <eg@gaute.vetsj.com> / 2014-06-09
+#
+# Precomputed travel time tables with interpolated lookups
+#
+
+import os, sys
+import json
+import hashlib
+import numpy as np
+import scipy as sc
+
+from scipy.interpolate import RegularGridInterpolator
+
+import logging as ll
+
+class TTtable:
+  """
+  Travel times on a grid of epicentral distance x source depth (km) for
+  a list of phases, for a fixed velocity model. The table is filled once
+  using a backend and stored in tabledir, named by a hash of the velocity
+  model, phases, grid and backend. Arbitrary distances and depths are then
+  looked up by linear interpolation.
+
+  A backend is anything with a method:
+
+    traveltimes (dist, depth, phases)
+
+  returning an array of shape (len(phases),) + dist.shape with nan for
+  missing arrivals, e.g. TauP or Layered.
+  """
+
+  def __init__ (self, velocity, phases, distances, depths, backend = None, tabledir = 'tables'):
+    self.velocity   = velocity
+    self.phases     = list(phases)
+    self.distances  = np.asarray (distances, dtype = np.float64)
+    self.depths     = np.asarray (depths, dtype = np.float64)
+    self.backend    = backend
+    self.tabledir   = tabledir
+    self.times      = None
+
+    self.key    = self.hash ()
+    self.tablef = os.path.join (tabledir, "ttable_%s.npz" % self.key)
+
+  def hash (self):
+    """ hash of velocity model, phases, grid and backend """
+    h = hashlib.sha1 ()
+    h.update (json.dumps ([[float(v[0]), float(v[1]), float(v[2]), v[3]] for v in self.velocity]).encode ('ascii'))
+    h.update (json.dumps (self.phases).encode ('ascii'))
+    h.update (self.distances.tobytes ())
+    h.update (self.depths.tobytes ())
+    h.update (type(self.backend).__name__.encode ('ascii'))
+    return h.hexdigest ()
+
+  def load (self):
+    """ load table from disk, or build and store it if it does not exist """
+    if os.path.exists (self.tablef):
+      ll.info ("ttable: loading: %s" % self.tablef)
+      self.times = np.load (self.tablef)['times']
+    else:
+      self.build ()
+      self.save ()
+
+    self.setup_interpolators ()
+    return self
+
+  def build (self):
+    ll.info ("ttable: building table: {} phases, {} distances x {} depths..".format (
+             len(self.phases), len(self.distances), len(self.depths)))
+
+    if self.backend is None:
+      raise ValueError ("ttable: no backend to build table with")
+
+    dist, depth = np.meshgrid (self.distances, self.depths, indexing = 'ij')
+    self.times  = np.asarray (self.backend.traveltimes (dist, depth, self.phases), dtype = np.float64)
+
+  def save (self):
+    ll.info ("ttable: saving: %s" % self.tablef)
+    os.makedirs (self.tabledir, exist_ok = True)
+
+    # write to a temporary file first so that a concurrent reader never
+    # sees a partial table.
+    tmpf = self.tablef + ".%d.tmp.npz" % os.getpid ()
+    np.savez (tmpf, distances = self.distances, depths = self.depths,
+              phases = np.array (self.phases), times = self.times)
+    os.replace (tmpf, self.tablef)
+
+  def setup_interpolators (self):
+    # uniform grids are interpolated directly, which is much faster
+    self.uniform = all (len(a) > 1 and np.allclose (np.diff (a), a[1] - a[0])
+                        for a in [self.distances, self.depths])
+
+    self.interpolators = {}
+    for i, p in enumerate(self.phases):
+      self.interpolators[p] = RegularGridInterpolator (
+          (self.distances, self.depths), self.times[i], bounds_error = False,
+          fill_value = np.nan)
+
+  def lookup (self, dist, depth, phase):
+    """
+    interpolate travel times for phase at arrays of epicentral distance
+    and source depth (km), points outside the table are nan.
+    """
+    dist, depth = np.broadcast_arrays (np.asarray (dist, dtype = np.float64),
+                                       np.asarray (depth, dtype = np.float64))
+    if self.uniform:
+      return self.bilinear (dist, depth, self.times[self.phases.index (phase)])
+
+    pts = np.stack ([dist.ravel (), depth.ravel ()], axis = -1)
+    return self.interpolators[phase] (pts).reshape (dist.shape)
+
+  def bilinear (self, dist, depth, t):
+    """ linear interpolation in t on a uniform grid, as the interpolators """
+    d0, dd = self.distances[0], self.distances[1] - self.distances[0]
+    z0, dz = self.depths[0], self.depths[1] - self.depths[0]
+
+    u = (dist - d0) / dd
+    v = (depth - z0) / dz
+    inside = (u >= 0) & (u <= len(self.distances) - 1) & (v >= 0) & (v <= len(self.depths) - 1)
+
+    i = np.clip (np.floor (u), 0, len(self.distances) - 2).astype (np.intp)
+    j = np.clip (np.floor (v), 0, len(self.depths) - 2).astype (np.intp)
+    u = u - i
+    v = v - j
+
+    r = ((t[i, j] * (1 - v) + t[i, j + 1] * v) * (1 - u) +
+         (t[i + 1, j] * (1 - v) + t[i + 1, j + 1] * v) * u)
+    return np.where (inside, r, np.nan)
+
+  def traveltimes (self, dist, depth, phases):
+    """
+    interpolated travel times for each of phases, as the traveltimes
+    method of the backends, so that a table can be used as a backend.
+    """
+    return np.array ([self.lookup (dist, depth, p) for p in phases])
+
+  def error_report (self, n = 100, seed = 0):
+    """
+    compare interpolated travel times against direct backend calls at n
+    random points inside the table. returns a dict with mean, rms and max
+    absolute error for each phase.
+    """
+    ll.info ("ttable: interpolation error report (%d points).." % n)
+
+    rs    = np.random.RandomState (seed)
+    dist  = rs.uniform (self.distances[0], self.distances[-1], n)
+    depth = rs.uniform (self.depths[0], self.depths[-1], n)
+
+    direct = np.asarray (self.backend.traveltimes (dist, depth, self.phases), dtype = np.float64)
+
+    report = {}
+    for i, p in enumerate(self.phases):
+      e = np.abs (self.lookup (dist, depth, p) - direct[i])
+      e = e[np.isfinite (e)]
+
+      if len(e) > 0:
+        report[p] = { 'mean' : np.mean (e), 'rms' : np.sqrt (np.mean (e**2)),
+                      'max' : np.max (e), 'n' : len(e) }
+      else:
+        report[p] = { 'mean' : np.nan, 'rms' : np.nan, 'max' : np.nan, 'n' : 0 }
+
+      ll.info ("  {}: mean: {mean:.4f} s, rms: {rms:.4f} s, max: {max:.4f} s ({n} points)".format (p, **report[p]))
+
+    return report
+